@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# Benchmark of parse_log throughput on plain and compressed captures
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import bz2, gzip, lzma, optparse, os, sys, tempfile, time
+import numpy as np
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..'))
+import calibrate_shaper
+
+COMPRESSORS = [('csv', open), ('csv.gz', gzip.open), ('csv.bz2', bz2.open),
+               ('csv.xz', lzma.open)]
+
+def make_raw_log(duration, fs):
+    rng = np.random.default_rng(0)
+    t = np.arange(0., duration, 1. / fs)
+    data = np.column_stack([t] + [rng.normal(size=t.size) * 1000.
+                                  for _ in range(3)])
+    return "".join("%.6f,%.3f,%.3f,%.3f\n" % tuple(row) for row in data)
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--duration", type="float", default=60.,
+                    help="duration of the synthetic capture, sec")
+    opts.add_option("--fs", type="float", default=3200.,
+                    help="sampling rate of the synthetic capture, Hz")
+    opts.add_option("-r", "--repeat", type="int", default=3,
+                    help="number of runs to keep the best time of")
+    options, args = opts.parse_args()
+    text = make_raw_log(options.duration, options.fs).encode('ascii')
+    print("%-8s %10s %10s %12s %12s" % (
+        "format", "size, MB", "time, s", "MB/s (raw)", "samples/s"))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for ext, opener in COMPRESSORS:
+            logname = os.path.join(tmpdir, "raw." + ext)
+            with opener(logname, 'wb') as f:
+                f.write(text)
+            best = None
+            for _ in range(options.repeat):
+                start = time.perf_counter()
+                data = calibrate_shaper.parse_log(logname)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print("%-8s %10.2f %10.3f %12.1f %12.0f" % (
+                ext, os.path.getsize(logname) / 1e6, best,
+                len(text) / 1e6 / best, data.shape[0] / best))
+
+if __name__ == '__main__':
+    main()
@@ -6,25 +6,71 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 from __future__ import print_function
-import importlib, optparse, os, sys
+import copy, importlib, optparse, os, sys
 from textwrap import wrap
 import numpy as np, matplotlib
+import calibration_history
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
                              '..', 'klippy'))
 shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
+shaper_simulation = importlib.import_module('.shaper_simulation', 'extras')
+shaper_optimizer = importlib.import_module('.shaper_optimizer', 'extras')
 
 MAX_TITLE_LENGTH=65
+MAX_PEAKS_SHOWN=3
+# Resonances with a higher coherence between axes are reported as coupled
+COUPLING_COHERENCE=.8
+# Shaper frequencies are tested with this step in quick previews
+PREVIEW_FREQ_STEP=1.
+MAX_SWEEP_COLUMNS=3
+# Sweep heatmap cells are only annotated for grids up to this size
+MAX_SWEEP_ANNOTATIONS=150
 
-def parse_log(logname):
-    with open(logname) as f:
+# Compressed logs are detected by their magic numbers and decompressed
+# on the fly, in bounded-size chunks, while parsing
+COMPRESSED_FORMATS = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'),
+                      (b'\xfd7zXZ\x00', 'lzma')]
+
+def open_log(logname):
+    with open(logname, 'rb') as f:
+        magic = f.read(6)
+    for prefix, module_name in COMPRESSED_FORMATS:
+        if magic.startswith(prefix):
+            module = importlib.import_module(module_name)
+            return module.open(logname, 'rt')
+    return open(logname)
+
+class InvalidCaptureError(ValueError):
+    pass
+
+def check_capture(logname, data):
+    # Fails fast on corrupted raw captures, before any heavy processing
+    report = shaper_calibrate.validate_accelerometer_data(np, data)
+    if report.problems:
+        raise InvalidCaptureError("Invalid capture %s: %s" % (
+            logname, "; ".join(report.problems)))
+    for warning in report.warnings:
+        print("Warning: capture %s: %s" % (logname, warning), file=sys.stderr)
+    return report
+
+def parse_log(logname, dtype=None, validate=False):
+    with open_log(logname) as f:
         for header in f:
             if not header.startswith('#'):
                 break
-        if not header.startswith('freq,psd_x,psd_y,psd_z,psd_xyz'):
-            # Raw accelerometer data
-            return np.loadtxt(logname, comments='#', delimiter=',')
+    if not header.startswith('freq,psd_x,psd_y,psd_z,psd_xyz'):
+        # Raw accelerometer data. The timestamps (printer uptime) need
+        # double precision, so the samples are always loaded as float64
+        # and only the accelerations are analyzed in `dtype`.
+        with open_log(logname) as f:
+            data = np.loadtxt(f, comments='#', delimiter=',', dtype=float)
+        if validate:
+            check_capture(logname, data)
+        return data
     # Parse power spectral density data
-    data = np.loadtxt(logname, skiprows=1, comments='#', delimiter=',')
+    with open_log(logname) as f:
+        data = np.loadtxt(f, skiprows=1, comments='#', delimiter=',',
+                          dtype=dtype or float)
     calibration_data = shaper_calibrate.CalibrationData(
             freq_bins=data[:,0], psd_sum=data[:,4],
             psd_x=data[:,1], psd_y=data[:,2], psd_z=data[:,3])
@@ -40,43 +86,263 @@ def parse_log(logname):
 ######################################################################
 
 # Find the best shaper parameters
-def calibrate_shaper(datas, csv_output, *, shapers, damping_ratio, scv,
-                     shaper_freqs, max_smoothing, test_damping_ratios,
-                     max_freq):
-    helper = shaper_calibrate.ShaperCalibrate(printer=None)
+def load_calibration_data(helper, datas, max_freq, band_limited,
+                          spectrogram=False, cross_spectra=False,
+                          preview=False):
     if isinstance(datas[0], shaper_calibrate.CalibrationData):
+        # Merging is done in place, on a copy so that `datas` can be
+        # calibrated again (e.g. after a preview)
         calibration_data = datas[0]
+        if len(datas) > 1:
+            calibration_data = copy.deepcopy(calibration_data)
         for data in datas[1:]:
             calibration_data.add_data(data)
-    else:
-        # Process accelerometer data
-        calibration_data = helper.process_accelerometer_data(datas[0])
-        for data in datas[1:]:
-            calibration_data.add_data(helper.process_accelerometer_data(data))
-        calibration_data.normalize_to_frequencies()
+        return calibration_data
+    # Process accelerometer data
+    band_max_freq = max_freq if band_limited else None
+    calibration_data = helper.process_accelerometer_data(
+            datas[0], band_max_freq, spectrogram, cross_spectra, preview)
+    for data in datas[1:]:
+        calibration_data.add_data(helper.process_accelerometer_data(
+            data, band_max_freq, spectrogram, cross_spectra, preview))
+    calibration_data.normalize_to_frequencies()
+    return calibration_data
+
+def load_resonance_tests(helper, datas, max_freq, band_limited,
+                         spectrogram=False, cross_spectra=False,
+                         merge_repeats=False):
+    # Normalized frequency responses of all tests in the raw recordings
+    band_max_freq = max_freq if band_limited else None
+    tests = []
+    for data in datas:
+        tests.extend(helper.process_test_segments(
+            data, shaper_calibrate.find_test_segments(np, data),
+            band_max_freq, spectrogram, cross_spectra))
+    if merge_repeats:
+        tests = shaper_calibrate.merge_repeated_tests(tests)
+    for test in tests:
+        test.calibration_data.normalize_to_frequencies()
+    return tests
+
+def calibrate_shaper(datas, csv_output, *, shapers, damping_ratio, scv,
+                     shaper_freqs, max_smoothing, test_damping_ratios,
+                     max_freq, axes=None, bank_dir=None, fit_tables=None,
+                     band_limited=False, helper=None, dtype=None,
+                     spectrogram=False, bootstrap=0, confidence=.9,
+                     cross_spectra=False, preview=False, segment=False,
+                     merge_repeats=False, custom_impulses=0,
+                     custom_min_accel=None, custom_shapers=None,
+                     prune_test_freqs=True):
+    # A long-lived `helper` may be passed to reuse its shaper response bank.
+    # A `preview` gives a preliminary recommendation from a coarse frequency
+    # response and a coarse sweep of shaper frequencies. With `segment`, raw
+    # recordings of several tests are split into the tests, which are
+    # calibrated separately (and together, without the idle periods).
+    # With `custom_impulses`, a custom shaper with that many impulses is
+    # optimized for the measured resonances and fitted along with the
+    # built-in ones; if `custom_shapers` list is provided, its InputShaperCfg
+    # is appended to it (e.g. to simulate it). Unless `prune_test_freqs`
+    # is disabled, shapers are only fitted around the resonance peaks.
+    if helper is None:
+        helper = shaper_calibrate.ShaperCalibrate(
+                printer=None, bank_dir=bank_dir, dtype=dtype,
+                prune_test_freqs=prune_test_freqs)
+    if segment and not isinstance(datas[0], shaper_calibrate.CalibrationData):
+        tests = load_resonance_tests(
+                helper, datas, max_freq, band_limited,
+                spectrogram=spectrogram or bootstrap > 0,
+                cross_spectra=cross_spectra, merge_repeats=merge_repeats)
+        if not tests:
+            print("No resonance tests found")
+            return None, None, None
+        for i, test in enumerate(tests):
+            print_resonance_test(
+                    helper, i + 1, test, shapers=shapers,
+                    damping_ratio=damping_ratio, scv=scv,
+                    shaper_freqs=shaper_freqs, max_smoothing=max_smoothing,
+                    test_damping_ratios=test_damping_ratios,
+                    max_freq=max_freq)
+        datas = [test.calibration_data for test in tests]
+    # Bootstrapping resamples the spectra of individual windows
+    calibration_data = load_calibration_data(
+            helper, datas, max_freq, band_limited,
+            spectrogram=spectrogram or bootstrap > 0,
+            cross_spectra=cross_spectra, preview=preview)
 
+    if preview and (not shaper_freqs or isinstance(shaper_freqs, tuple)):
+        start, end, step = tuple(shaper_freqs or ()) or (None, None, None)
+        shaper_freqs = (start, end, step or PREVIEW_FREQ_STEP)
 
-    shaper, all_shapers = helper.find_best_shaper(
-            calibration_data, shapers=shapers, damping_ratio=damping_ratio,
-            scv=scv, shaper_freqs=shaper_freqs, max_smoothing=max_smoothing,
+    # The combined X+Y+Z response is always fitted, any extra axes are
+    # fitted in the same pass over the test frequencies
+    fit_axes = ['all'] + [axis for axis in axes or [] if axis != 'all']
+    for axis in fit_axes:
+        print("%s: %s" % ("Resonances" if axis == 'all' else
+                          "Resonances of axis %s" % (axis.upper(),),
+                          format_peaks(calibration_data.get_peaks(axis))))
+    if calibration_data.has_cross_spectra():
+        print_coupled_peaks(calibration_data)
+    custom_cfgs = []
+    if custom_impulses:
+        custom_cfgs.append(optimize_custom_shaper(
+                calibration_data, custom_impulses, max_smoothing,
+                custom_min_accel, scv=scv, damping_ratio=damping_ratio,
+                test_damping_ratios=test_damping_ratios, max_freq=max_freq))
+        if custom_shapers is not None:
+            custom_shapers.extend(custom_cfgs)
+    axes_shapers = helper.find_best_shaper_multi(
+            calibration_data, fit_axes, shapers=shapers,
+            damping_ratio=damping_ratio, scv=scv, shaper_freqs=shaper_freqs,
+            max_smoothing=max_smoothing,
             test_damping_ratios=test_damping_ratios, max_freq=max_freq,
-            logger=print)
+            logger=print, fit_tables=fit_tables, custom_shapers=custom_cfgs)
+    shaper, all_shapers = axes_shapers['all']
     if not shaper:
         print("No recommended shaper, possibly invalid value for --shapers=%s" %
               (','.join(shapers)))
         return None, None, None
-    print("Recommended shaper is %s @ %.1f Hz" % (shaper.name, shaper.freq))
+    print("%s shaper is %s @ %.1f Hz" % (
+        "Preliminary recommended" if preview else "Recommended",
+        shaper.name, shaper.freq))
+    for axis in fit_axes[1:]:
+        axis_shaper = axes_shapers[axis][0]
+        print("Recommended shaper for axis %s is %s @ %.1f Hz" % (
+            axis.upper(), axis_shaper.name, axis_shaper.freq))
+    if bootstrap > 0:
+        print_bootstrap(helper, calibration_data, bootstrap, confidence,
+                        shapers=shapers, damping_ratio=damping_ratio, scv=scv,
+                        shaper_freqs=shaper_freqs, max_smoothing=max_smoothing,
+                        test_damping_ratios=test_damping_ratios,
+                        max_freq=max_freq)
     if csv_output is not None:
         helper.save_calibration_data(
                 csv_output, calibration_data, all_shapers)
     return shaper.name, all_shapers, calibration_data
 
+def sweep_shaper_params(datas, csv_output, *, shapers, damping_ratios, scvs,
+                        max_smoothings, shaper_freqs, test_damping_ratios,
+                        max_freq, bank_dir=None, band_limited=False,
+                        dtype=None):
+    # Recommends a shaper for every combination of the swept parameters
+    helper = shaper_calibrate.ShaperCalibrate(printer=None, bank_dir=bank_dir,
+                                              dtype=dtype)
+    calibration_data = load_calibration_data(helper, datas, max_freq,
+                                             band_limited)
+    sweep = helper.sweep_shaper_params(
+            calibration_data, scvs, max_smoothings, damping_ratios,
+            shapers=shapers, shaper_freqs=shaper_freqs,
+            test_damping_ratios=test_damping_ratios, max_freq=max_freq)
+    for i, name in enumerate(sweep.names):
+        recommended = sweep.selected == i
+        if not recommended.any():
+            continue
+        freqs = sweep.freqs[recommended]
+        max_accels = sweep.max_accels[recommended]
+        print("Shaper '%s' is recommended for %d of %d parameter combinations"
+              " (frequency = %.1f..%.1f Hz, max_accel = %.0f..%.0f mm/sec^2)"
+              % (name, recommended.sum(), recommended.size, freqs.min(),
+                 freqs.max(), max_accels.min(), max_accels.max()))
+    if csv_output is not None:
+        helper.save_sweep(csv_output, sweep)
+    return sweep
+
+def optimize_custom_shaper(calibration_data, n_impulses, max_smoothing,
+                           min_accel, **optimizer_args):
+    shaper = shaper_optimizer.optimize_shaper(
+            np, calibration_data, n_impulses, max_smoothing=max_smoothing,
+            min_accel=min_accel, **optimizer_args)
+    print("Optimized custom shaper with %d impulses for %.1f Hz "
+          "(vibrations = %.1f%%)" % (len(shaper.A), shaper.ref_freq,
+                                     shaper.vibrs * 100.))
+    print("Custom shaper amplitudes: %s, times (in periods): %s" % (
+        ', '.join('%.4f' % (a,) for a in shaper.A),
+        ', '.join('%.4f' % (t * shaper.ref_freq,) for t in shaper.T)))
+    return shaper_optimizer.make_shaper_cfg(np, shaper)
+
+def get_custom_shaper_params(shaper_cfg, shapers):
+    # The impulses of a custom shaper at its fitted frequency
+    freq = next(s.freq for s in shapers if s.name == shaper_cfg.name)
+    A, T = shaper_cfg.init_func(freq, None)
+    return {'name': shaper_cfg.name, 'freq': float(freq), 'A': A, 'T': T}
+
+def print_resonance_test(helper, index, test, **fit_args):
+    segments = test.segments
+    if len(segments) > 1:
+        span = "%d repeats" % (len(segments),)
+    else:
+        span = "%.1f..%.1f sec" % (segments[0].start_time,
+                                   segments[0].end_time)
+    shaper, _ = helper.find_best_shaper(test.calibration_data, **fit_args)
+    print("Test %d (axis %s, %s): resonances: %s" % (
+        index, test.axis.upper(), span,
+        format_peaks(test.calibration_data.get_peaks(test.axis))))
+    if shaper is not None:
+        print("Recommended shaper for test %d is %s @ %.1f Hz" % (
+            index, shaper.name, shaper.freq))
+
+def format_peaks(peaks, max_peaks=MAX_PEAKS_SHOWN):
+    if not len(peaks.freqs):
+        return "none found"
+    return ", ".join("%.1f Hz (bandwidth %.1f Hz)" % (freq, bandwidth)
+                     for freq, bandwidth in zip(peaks.freqs[:max_peaks],
+                                                peaks.bandwidths[:max_peaks]))
+
+def print_coupled_peaks(calibration_data, max_peaks=MAX_PEAKS_SHOWN):
+    # A resonance showing up on several axes with a high coherence comes
+    # from the same source, e.g. a flexing frame or a racking gantry
+    freq_bins = calibration_data.freq_bins
+    for freq in calibration_data.get_peaks().freqs[:max_peaks]:
+        i = np.searchsorted(freq_bins, freq)
+        for pair in shaper_calibrate.CROSS_SPECTRA_PAIRS:
+            coherence = calibration_data.get_coherence(pair)[i]
+            if coherence >= COUPLING_COHERENCE:
+                print("Resonance at %.1f Hz is coupled between axes %s and %s"
+                      " (coherence %.2f)" % (freq, pair[0].upper(),
+                                             pair[1].upper(), coherence))
+
+def print_bootstrap(helper, calibration_data, n_replicates, confidence,
+                    **fit_args):
+    if not calibration_data.has_spectrogram():
+        print("Confidence intervals require raw accelerometer data")
+        return
+    best, bootstraps = helper.bootstrap_best_shaper(
+            calibration_data, n_replicates, **fit_args)
+    percent = confidence * 100.
+    for i, bootstrap in enumerate(bootstraps):
+        freq_ci = helper.get_confidence_interval(bootstrap.freqs, confidence)
+        vibrs_ci = helper.get_confidence_interval(bootstrap.vibrs, confidence)
+        accel_ci = helper.get_confidence_interval(bootstrap.max_accels,
+                                                  confidence)
+        print("Shaper '%s' %.0f%% confidence intervals: frequency = "
+              "%.1f..%.1f Hz, vibrations = %.1f..%.1f%%, max_accel = "
+              "%.0f..%.0f mm/sec^2 (recommended in %.0f%% of %d replicates)" % (
+                  bootstrap.name, percent, freq_ci[0], freq_ci[1],
+                  vibrs_ci[0] * 100., vibrs_ci[1] * 100.,
+                  accel_ci[0], accel_ci[1],
+                  (best == i).mean() * 100., n_replicates))
+
+def simulate_shapers(calibration_data, shapers, damping_ratio,
+                     motion_profile=None, custom_shapers=None):
+    velocities = None
+    if motion_profile is not None:
+        velocities = shaper_simulation.load_motion_profile(np, motion_profile)
+    result = shaper_simulation.simulate_fitted_shapers(
+            np, calibration_data, shapers, damping_ratio, velocities,
+            custom_shapers=custom_shapers)
+    for name, residual, max_error in zip(result.names,
+                                         result.residual_vibrations,
+                                         result.max_errors):
+        print("Simulated shaper '%s': residual vibrations = %.4f mm, "
+              "max positional error = %.4f mm" % (name, residual, max_error))
+    return result
+
 ######################################################################
 # Plot frequency response and suggested input shapers
 ######################################################################
 
 def plot_freq_response(lognames, calibration_data, shapers,
-                       selected_shaper, max_freq):
+                       selected_shaper, max_freq, fig=None):
+    # Draws on `fig` if provided, otherwise creates a new pyplot figure
     max_freq_bin = calibration_data.freq_bins.max()
     if max_freq > max_freq_bin:
         max_freq = max_freq_bin
@@ -90,7 +356,10 @@ def plot_freq_response(lognames, calibration_data, shapers,
     fontP = matplotlib.font_manager.FontProperties()
     fontP.set_size('x-small')
 
-    fig, ax = matplotlib.pyplot.subplots()
+    if fig is None:
+        fig, ax = matplotlib.pyplot.subplots()
+    else:
+        ax = fig.subplots()
     ax.set_xlabel('Frequency, Hz')
     ax.set_xlim([0, max_freq])
     ax.set_ylabel('Power spectral density')
@@ -99,6 +368,16 @@ def plot_freq_response(lognames, calibration_data, shapers,
     ax.plot(freqs, px, label='X', color='red')
     ax.plot(freqs, py, label='Y', color='green')
     ax.plot(freqs, pz, label='Z', color='blue')
+    # Annotate the most prominent resonances of the combined response
+    peaks = calibration_data.get_peaks()
+    for freq, amplitude in zip(peaks.freqs[:MAX_PEAKS_SHOWN],
+                               peaks.amplitudes[:MAX_PEAKS_SHOWN]):
+        if freq > max_freq:
+            continue
+        ax.plot(freq, amplitude, marker='v', color='purple')
+        ax.annotate("%.1f Hz" % (freq,), xy=(freq, amplitude),
+                    xytext=(0, 6), textcoords='offset points', ha='center',
+                    fontsize='x-small', color='purple')
 
     title = "Frequency response and shapers (%s)" % (', '.join(lognames))
     ax.set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
@@ -133,17 +412,266 @@ def plot_freq_response(lognames, calibration_data, shapers,
     fig.tight_layout()
     return fig
 
+def plot_spectrogram(lognames, calibration_data, max_freq, fig=None):
+    freqs = calibration_data.freq_bins
+    max_freq = min(max_freq, freqs.max())
+    band = freqs <= max_freq
+    times = calibration_data.spectrogram_times
+
+    if fig is None:
+        fig, axes = matplotlib.pyplot.subplots(3, 1, sharex=True)
+    else:
+        axes = fig.subplots(3, 1, sharex=True)
+    # The shared colorbar is not supported by the tight layout
+    fig.set_layout_engine('constrained')
+    title = "Spectrogram (%s)" % (', '.join(lognames))
+    axes[0].set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
+    spectrograms = [calibration_data.get_spectrogram(axis)[:, band]
+                    for axis in 'xyz']
+    # Share the color scale between the axes, limiting its dynamic range
+    vmax = max(spectrogram.max() for spectrogram in spectrograms)
+    norm = matplotlib.colors.LogNorm(vmin=vmax * 1e-4, vmax=vmax)
+    for ax, axis, spectrogram in zip(axes, 'XYZ', spectrograms):
+        mesh = ax.pcolormesh(times, freqs[band], spectrogram.T, norm=norm,
+                             shading='nearest', cmap='inferno')
+        ax.set_ylabel('%s, Hz' % (axis,))
+        ax.set_ylim([0, max_freq])
+    axes[-1].set_xlabel('Time, sec')
+    fig.colorbar(mesh, ax=list(axes), label='Power spectral density')
+    return fig
+
+def plot_datasets_overlay(datasets, max_freq, fig=None):
+    # `datasets` is a list of (name, calibration_data, shapers,
+    # selected_shaper) of independently analyzed captures
+    fontP = matplotlib.font_manager.FontProperties()
+    fontP.set_size('x-small')
+
+    if fig is None:
+        fig, ax = matplotlib.pyplot.subplots()
+    else:
+        ax = fig.subplots()
+    ax.set_xlabel('Frequency, Hz')
+    ax.set_ylabel('Power spectral density')
+
+    names = [name for name, _, _, _ in datasets]
+    title = "Frequency response comparison (%s)" % (', '.join(names))
+    ax.set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
+    ax.xaxis.set_minor_locator(matplotlib.ticker.MultipleLocator(5))
+    ax.yaxis.set_minor_locator(matplotlib.ticker.AutoMinorLocator())
+    ax.ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
+    ax.grid(which='major', color='grey')
+    ax.grid(which='minor', color='lightgrey')
+
+    ax2 = ax.twinx()
+    ax2.set_ylabel('Shaper vibration reduction (ratio)')
+    max_freq_bin = max_freq
+    for name, calibration_data, shapers, selected_shaper in datasets:
+        freqs = calibration_data.freq_bins
+        max_freq_bin = min(max_freq_bin, freqs.max())
+        psd = calibration_data.psd_sum[freqs <= max_freq]
+        line, = ax.plot(freqs[freqs <= max_freq], psd, label=name)
+        for shaper in shapers:
+            if shaper.name != selected_shaper:
+                continue
+            ax2.plot(freqs[:len(shaper.vals)], shaper.vals,
+                     linestyle='dashdot', color=line.get_color(),
+                     label="%s: %s (%.1f Hz, vibr=%.1f%%)" % (
+                         name, shaper.name.upper(), shaper.freq,
+                         shaper.vibrs * 100.))
+    ax.set_xlim([0, max_freq_bin])
+
+    ax.legend(loc='upper left', prop=fontP)
+    ax2.legend(loc='upper right', prop=fontP)
+
+    fig.tight_layout()
+    return fig
+
+def plot_coherence(lognames, calibration_data, max_freq, fig=None):
+    freqs = calibration_data.freq_bins
+    max_freq = min(max_freq, freqs.max())
+    band = freqs <= max_freq
+
+    fontP = matplotlib.font_manager.FontProperties()
+    fontP.set_size('x-small')
+
+    if fig is None:
+        fig, axes = matplotlib.pyplot.subplots(2, 1, sharex=True)
+    else:
+        axes = fig.subplots(2, 1, sharex=True)
+    title = "Cross-axis coupling (%s)" % (', '.join(lognames))
+    axes[0].set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
+    axes[0].set_ylabel('Cross-spectral density')
+    axes[0].ticklabel_format(axis='y', style='scientific', scilimits=(0,0))
+    axes[1].set_ylabel('Coherence')
+    axes[1].set_ylim([0., 1.05])
+    axes[1].set_xlabel('Frequency, Hz')
+    axes[1].set_xlim([0, max_freq])
+    for pair, color in zip(shaper_calibrate.CROSS_SPECTRA_PAIRS,
+                           ('orange', 'magenta', 'teal')):
+        label = "%s-%s" % (pair[0].upper(), pair[1].upper())
+        axes[0].plot(freqs[band], abs(calibration_data.get_csd(pair)[band]),
+                     label=label, color=color)
+        axes[1].plot(freqs[band], calibration_data.get_coherence(pair)[band],
+                     label=label, color=color)
+    axes[1].axhline(COUPLING_COHERENCE, color='grey', linestyle='dotted')
+    peaks = calibration_data.get_peaks()
+    for freq in peaks.freqs[:MAX_PEAKS_SHOWN]:
+        if freq <= max_freq:
+            for ax in axes:
+                ax.axvline(freq, color='purple', linestyle='dashed',
+                           linewidth=.8)
+    for ax in axes:
+        ax.xaxis.set_minor_locator(matplotlib.ticker.MultipleLocator(5))
+        ax.grid(which='major', color='grey')
+        ax.grid(which='minor', color='lightgrey')
+        ax.legend(loc='upper right', prop=fontP)
+
+    fig.tight_layout()
+    return fig
+
+def plot_shaper_scores(lognames, fit_tables, selected_shaper, fig=None):
+    fontP = matplotlib.font_manager.FontProperties()
+    fontP.set_size('x-small')
+
+    if fig is None:
+        fig, ax = matplotlib.pyplot.subplots()
+    else:
+        ax = fig.subplots()
+    ax.set_xlabel('Shaper frequency, Hz')
+    ax.set_ylabel('Shaper score')
+    ax.set_yscale('log')
+
+    title = "Shaper scores per frequency (%s)" % (', '.join(lognames))
+    ax.set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
+    ax.xaxis.set_minor_locator(matplotlib.ticker.MultipleLocator(5))
+    ax.grid(which='major', color='grey')
+    ax.grid(which='minor', color='lightgrey')
+
+    ax2 = ax.twinx()
+    ax2.set_ylabel('Remaining vibrations, %')
+    for table in fit_tables:
+        shaper = table.select()
+        linestyle = 'dashdot' if table.name == selected_shaper else 'solid'
+        line, = ax.plot(table.freqs, table.scores[:, 0], linestyle=linestyle,
+                        label="%s score" % (table.name.upper(),))
+        ax.plot([shaper.freq], [shaper.score], 'o', color=line.get_color())
+        ax2.plot(table.freqs, table.vibrs[:, 0] * 100., linestyle='dotted',
+                 color=line.get_color(),
+                 label="%s vibrations" % (table.name.upper(),))
+
+    ax.legend(loc='upper left', prop=fontP)
+    ax2.legend(loc='upper right', prop=fontP)
+
+    fig.tight_layout()
+    return fig
+
+def plot_simulation(lognames, result, selected_shaper, fig=None):
+    fontP = matplotlib.font_manager.FontProperties()
+    fontP.set_size('x-small')
+
+    if fig is None:
+        fig, axes = matplotlib.pyplot.subplots(2, 1, sharex=True)
+    else:
+        axes = fig.subplots(2, 1, sharex=True)
+    title = "Simulated vibrations with shapers (%s)" % (', '.join(lognames))
+    axes[0].set_title("\n".join(wrap(title, MAX_TITLE_LENGTH)))
+    axes[0].set_ylabel('Vibrations, mm')
+    axes[1].set_ylabel('Positional error, mm')
+    axes[1].set_xlabel('Time, sec')
+    for i, name in enumerate(result.names):
+        linestyle = 'dashdot' if name == selected_shaper else 'solid'
+        label = "%s (residual %.4f mm)" % (
+                name.upper(), result.residual_vibrations[i])
+        axes[0].plot(result.times, result.deflections[i], label=label,
+                     linestyle=linestyle, linewidth=.8)
+        axes[1].plot(result.times, result.errors[i], label=name.upper(),
+                     linestyle=linestyle, linewidth=.8)
+    for ax in axes:
+        ax.grid(which='major', color='grey')
+        ax.grid(which='minor', color='lightgrey')
+    axes[0].legend(loc='upper right', prop=fontP)
+
+    fig.tight_layout()
+    return fig
+
+def plot_sweep(lognames, sweep, fig=None):
+    # A heatmap of max_accel of the recommended shapers per damping ratio,
+    # the cells are annotated with the recommended shapers
+    n_plots = len(sweep.damping_ratios)
+    n_cols = min(n_plots, MAX_SWEEP_COLUMNS)
+    n_rows = (n_plots + n_cols - 1) // n_cols
+    if fig is None:
+        fig = matplotlib.pyplot.figure()
+    # The shared colorbar needs the constrained layout
+    fig.set_layout_engine('constrained')
+    axes = fig.subplots(n_rows, n_cols, squeeze=False, sharex=True,
+                        sharey=True).flatten()
+    title = "Recommended shapers per parameters (%s)" % (', '.join(lognames))
+    fig.suptitle("\n".join(wrap(title, MAX_TITLE_LENGTH)))
+    norm = matplotlib.colors.Normalize(vmin=sweep.max_accels.min(),
+                                       vmax=sweep.max_accels.max())
+    annotate = sweep.selected[0].size <= MAX_SWEEP_ANNOTATIONS
+    max_smoothings = ["%.3g" % (ms,) if np.isfinite(ms) else "none"
+                      for ms in sweep.max_smoothings]
+    for i, ax in enumerate(axes):
+        if i >= n_plots:
+            ax.set_visible(False)
+            continue
+        image = ax.imshow(sweep.max_accels[i], origin='lower', aspect='auto',
+                          norm=norm)
+        ax.set_title("damping_ratio = %.3f" % (sweep.damping_ratios[i],),
+                     fontsize='small')
+        ax.set_xticks(range(len(max_smoothings)))
+        ax.set_xticklabels(max_smoothings, rotation=90, fontsize='x-small')
+        ax.set_yticks(range(len(sweep.scvs)))
+        ax.set_yticklabels(["%.3g" % (scv,) for scv in sweep.scvs],
+                           fontsize='x-small')
+        if i % n_cols == 0:
+            ax.set_ylabel('Square corner velocity, mm/sec')
+        if i >= n_plots - n_cols:
+            ax.set_xlabel('Max smoothing')
+        if not annotate:
+            continue
+        for (j, k), selected in np.ndenumerate(sweep.selected[i]):
+            ax.text(k, j, "%s\n%.1f" % (sweep.names[selected],
+                                         sweep.freqs[i, j, k]),
+                    ha='center', va='center', fontsize=4, color='white')
+    fig.colorbar(image, ax=list(axes[:n_plots]),
+                 label='Max acceleration, mm/sec^2')
+    return fig
+
 ######################################################################
 # Startup
 ######################################################################
 
+def parse_sweep_values(value):
+    # A comma-separated list of floats, or an inclusive range in the format
+    # start:end:step
+    if ':' not in value:
+        return [float(s) for s in value.split(',')]
+    start, end, step = [float(s) for s in value.split(':')]
+    if start > end or step <= 0.:
+        raise ValueError("Invalid range %s" % (value,))
+    return list(np.arange(start, end + step * .5, step))
+
 def setup_matplotlib(output_to_file):
     global matplotlib
     if output_to_file:
         matplotlib.rcParams.update({'figure.autolayout': True})
         matplotlib.use('Agg')
     import matplotlib.pyplot, matplotlib.dates, matplotlib.font_manager
-    import matplotlib.ticker
+    import matplotlib.ticker, matplotlib.colors, matplotlib.figure
+
+def save_figure(filename, figsize, plot, *args):
+    # Extra graphs are drawn on figures of their own with the Agg canvas,
+    # so that the pyplot backend (e.g. of the interactive main graph) is
+    # left alone
+    setup_matplotlib(False)
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = matplotlib.figure.Figure(figsize=figsize, tight_layout=True)
+    FigureCanvasAgg(fig)
+    plot(*args, fig=fig)
+    fig.savefig(filename)
 
 def main():
     # Parse command-line arguments
@@ -153,6 +681,24 @@ def main():
                     default=None, help="filename of output graph")
     opts.add_option("-c", "--csv", type="string", dest="csv",
                     default=None, help="filename of output csv file")
+    opts.add_option("--spectrogram_output", type="string",
+                    dest="spectrogram_output", default=None,
+                    help="filename of output spectrogram graph (only for " +
+                    "raw accelerometer data)")
+    opts.add_option("--coherence_output", type="string",
+                    dest="coherence_output", default=None,
+                    help="filename of output graph of cross-axis coupling " +
+                    "(only for raw accelerometer data)")
+    opts.add_option("--scores_output", type="string", dest="scores_output",
+                    default=None, help="filename of output graph of shaper " +
+                    "scores vs. frequency")
+    opts.add_option("--simulate_output", type="string",
+                    dest="simulate_output", default=None,
+                    help="filename of output graph of simulated vibrations " +
+                    "with the fitted shapers")
+    opts.add_option("--motion_profile", type="string", dest="motion_profile",
+                    default=None, help="'time,position' CSV file of the " +
+                    "motion to simulate (a zig-zag toolpath by default)")
     opts.add_option("-f", "--max_freq", type="float", default=200.,
                     help="maximum frequency to plot")
     opts.add_option("-s", "--max_smoothing", type="float", dest="max_smoothing",
@@ -171,11 +717,74 @@ def main():
                     dest="test_damping_ratios", default=None,
                     help="a comma-separated list of damping ratios to test " +
                     "input shaper for")
+    opts.add_option("--axes", type="string", dest="axes", default=None,
+                    help="a comma-separated list of axes (x, y, z) to " +
+                    "recommend a separate shaper for")
+    opts.add_option("--band_limited", action="store_true",
+                    dest="band_limited", default=False,
+                    help="decimate raw accelerometer data to only analyze " +
+                    "frequencies up to --max_freq")
+    opts.add_option("--float32", action="store_true", dest="float32",
+                    default=False, help="run the analysis in single " +
+                    "precision to reduce memory usage")
+    opts.add_option("--sweep_scv", type="string", dest="sweep_scv",
+                    default=None, help="square corner velocities to sweep, " +
+                    "either a comma-separated list of floats, or a range in " +
+                    "the format start:end:step")
+    opts.add_option("--sweep_max_smoothing", type="string",
+                    dest="sweep_max_smoothing", default=None,
+                    help="max_smoothing values to sweep, in the same format")
+    opts.add_option("--sweep_damping_ratio", type="string",
+                    dest="sweep_damping_ratio", default=None,
+                    help="shaper damping_ratio values to sweep, in the same " +
+                    "format")
+    opts.add_option("--segment", action="store_true", dest="segment",
+                    default=False, help="split raw recordings of several " +
+                    "tests separated by idle periods into the tests")
+    opts.add_option("--merge_repeats", action="store_true",
+                    dest="merge_repeats", default=False,
+                    help="merge the repeated tests of the same axis")
+    opts.add_option("--custom_shaper", type="int", dest="custom_impulses",
+                    default=0, help="number of impulses of a custom shaper " +
+                    "to optimize for the measured resonances")
+    opts.add_option("--custom_min_accel", type="float",
+                    dest="custom_min_accel", default=None,
+                    help="minimum max_accel the custom shaper must allow")
+    opts.add_option("--preview", action="store_true", dest="preview",
+                    default=False, help="print a quick preliminary " +
+                    "recommendation before the full analysis")
+    opts.add_option("--bootstrap", type="int", dest="bootstrap", default=0,
+                    help="number of bootstrap replicates to estimate " +
+                    "confidence intervals of fitted shapers with")
+    opts.add_option("--confidence", type="float", dest="confidence",
+                    default=.9, help="confidence level of bootstrap " +
+                    "intervals")
+    opts.add_option("--history", type="string", dest="history",
+                    default=None, help="SQLite database to record the " +
+                    "calibration run in")
+    opts.add_option("--printer_id", type="string", dest="printer_id",
+                    default="default", help="printer to record the " +
+                    "calibration run for")
+    opts.add_option("--no_validate", action="store_false", dest="validate",
+                    default=True, help="do not reject invalid raw captures")
+    opts.add_option("--no_prune", action="store_false",
+                    dest="prune_test_freqs", default=True,
+                    help="fit shapers at all test frequencies, not only " +
+                    "around the resonance peaks")
+    opts.add_option("--bank_dir", type="string", dest="bank_dir",
+                    default=None, help="directory to persist precomputed " +
+                    "shaper responses in, reused across runs")
     options, args = opts.parse_args()
     if len(args) < 1:
         opts.error("Incorrect number of arguments")
     if options.max_smoothing is not None and options.max_smoothing < 0.05:
         opts.error("Too small max_smoothing specified (must be at least 0.05)")
+    if options.bootstrap < 0:
+        opts.error("Number of bootstrap replicates must be non-negative")
+    if not 0. < options.confidence < 1.:
+        opts.error("--confidence must be between 0 and 1")
+    if options.custom_impulses and options.custom_impulses < 2:
+        opts.error("A custom shaper must have at least 2 impulses")
 
     max_freq = options.max_freq
     if options.shaper_freq is None:
@@ -217,25 +826,133 @@ def main():
                        "--test_damping_ratios param")
     else:
         test_damping_ratios = None
+    if options.axes is None:
+        axes = None
+    else:
+        axes = options.axes.lower().split(',')
+        if any(axis not in ('x', 'y', 'z', 'all') for axis in axes):
+            opts.error("invalid axis in --axes param")
     if options.shapers is None:
         shapers = None
     else:
         shapers = options.shapers.lower().split(',')
 
+    sweep = any(value is not None for value in (
+        options.sweep_scv, options.sweep_max_smoothing,
+        options.sweep_damping_ratio))
+    if sweep:
+        try:
+            sweep_values = [
+                    parse_sweep_values(value) if value is not None
+                    else [default] for value, default in [
+                        (options.sweep_damping_ratio, options.damping_ratio),
+                        (options.sweep_scv, options.scv),
+                        (options.sweep_max_smoothing, options.max_smoothing)]]
+        except ValueError:
+            opts.error("--sweep_* params must be comma-separated lists of " +
+                       "floats or ranges in the format start:end:step")
+        if any(ms is not None and ms < 0.05 for ms in sweep_values[2]):
+            opts.error("Too small max_smoothing specified (must be at " +
+                       "least 0.05)")
+
     # Parse data
-    datas = [parse_log(fn) for fn in args]
+    dtype = np.float32 if options.float32 else None
+    try:
+        datas = [parse_log(fn, dtype, validate=options.validate)
+                 for fn in args]
+    except InvalidCaptureError as e:
+        opts.error(str(e))
+
+    if sweep:
+        damping_ratios, scvs, max_smoothings = sweep_values
+        result = sweep_shaper_params(
+                datas, options.csv, shapers=shapers,
+                damping_ratios=damping_ratios, scvs=scvs,
+                max_smoothings=max_smoothings, shaper_freqs=shaper_freqs,
+                test_damping_ratios=test_damping_ratios, max_freq=max_freq,
+                bank_dir=options.bank_dir, band_limited=options.band_limited,
+                dtype=dtype)
+        if not options.csv or options.output:
+            setup_matplotlib(options.output is not None)
+            fig = plot_sweep(args, result)
+            if options.output is None:
+                matplotlib.pyplot.show()
+            else:
+                fig.set_size_inches(12, 8)
+                fig.savefig(options.output)
+        return
 
     # Calibrate shaper and generate outputs
+    if options.preview:
+        calibrate_shaper(
+                datas, None, shapers=shapers,
+                damping_ratio=options.damping_ratio, scv=options.scv,
+                shaper_freqs=shaper_freqs,
+                max_smoothing=options.max_smoothing,
+                test_damping_ratios=test_damping_ratios, max_freq=max_freq,
+                bank_dir=options.bank_dir, band_limited=options.band_limited,
+                dtype=dtype, preview=True)
+    fit_tables = []
+    custom_shapers = []
     selected_shaper, shapers, calibration_data = calibrate_shaper(
             datas, options.csv, shapers=shapers,
             damping_ratio=options.damping_ratio,
             scv=options.scv, shaper_freqs=shaper_freqs,
             max_smoothing=options.max_smoothing,
             test_damping_ratios=test_damping_ratios,
-            max_freq=max_freq)
+            max_freq=max_freq, axes=axes, bank_dir=options.bank_dir,
+            fit_tables=fit_tables, band_limited=options.band_limited,
+            dtype=dtype, spectrogram=options.spectrogram_output is not None,
+            bootstrap=options.bootstrap, confidence=options.confidence,
+            cross_spectra=options.coherence_output is not None,
+            segment=options.segment, merge_repeats=options.merge_repeats,
+            custom_impulses=options.custom_impulses,
+            custom_min_accel=options.custom_min_accel,
+            custom_shapers=custom_shapers,
+            prune_test_freqs=options.prune_test_freqs)
     if selected_shaper is None:
         return
 
+    if options.history:
+        history = calibration_history.CalibrationHistory(options.history)
+        try:
+            history.record_run(
+                    options.printer_id, shapers, selected_shaper,
+                    calibration_data, max_freq=max_freq, params={
+                        'files': args, 'shapers': options.shapers,
+                        'damping_ratio': options.damping_ratio,
+                        'scv': options.scv, 'shaper_freq': options.shaper_freq,
+                        'max_smoothing': options.max_smoothing,
+                        'test_damping_ratios': test_damping_ratios,
+                        'max_freq': max_freq, 'custom_shapers': [
+                            get_custom_shaper_params(shaper_cfg, shapers)
+                            for shaper_cfg in custom_shapers]})
+        finally:
+            history.close()
+
+    if options.spectrogram_output:
+        if not calibration_data.has_spectrogram():
+            opts.error("Spectrogram requires raw accelerometer data")
+        save_figure(options.spectrogram_output, (8, 8), plot_spectrogram,
+                    args, calibration_data, max_freq)
+
+    if options.coherence_output:
+        if not calibration_data.has_cross_spectra():
+            opts.error("Coupling analysis requires raw accelerometer data")
+        save_figure(options.coherence_output, (8, 8), plot_coherence,
+                    args, calibration_data, max_freq)
+
+    if options.simulate_output:
+        result = simulate_shapers(calibration_data, shapers,
+                                  options.damping_ratio,
+                                  options.motion_profile, custom_shapers)
+        save_figure(options.simulate_output, (10, 8), plot_simulation,
+                    args, result, selected_shaper)
+
+    if options.scores_output:
+        save_figure(options.scores_output, (8, 6), plot_shaper_scores,
+                    args, fit_tables, selected_shaper)
+
     if not options.csv or options.output:
         # Draw graph
         setup_matplotlib(options.output is not None)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# Local history of shaper calibration runs
+#
+# Every run is stored in an SQLite database with its parameters, the
+# selected shaper and the results of all fitted shapers, along with a
+# downsampled frequency response. Runs are indexed by printer and time, so
+# that trends over thousands of runs are answered from the indexes alone.
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections, json, optparse, sqlite3, time, zlib
+import numpy as np
+
+SCHEMA_VERSION = 1
+
+# The stored PSDs are resampled to this step, in Hz
+PSD_FREQ_STEP = 1.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    printer_id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    params TEXT NOT NULL,
+    selected_shaper TEXT,
+    selected_freq REAL,
+    psd_freq_step REAL,
+    psd BLOB
+);
+CREATE TABLE IF NOT EXISTS shapers (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    freq REAL NOT NULL,
+    vibrs REAL NOT NULL,
+    smoothing REAL NOT NULL,
+    score REAL NOT NULL,
+    max_accel REAL NOT NULL,
+    PRIMARY KEY (run_id, name)
+) WITHOUT ROWID;
+-- Covers the frequency drift queries of the selected shapers
+CREATE INDEX IF NOT EXISTS runs_by_printer ON runs(
+    printer_id, timestamp, selected_shaper, selected_freq);
+"""
+
+HistoryRun = collections.namedtuple(
+        'HistoryRun',
+        ('printer_id', 'timestamp', 'params', 'selected_shaper', 'shapers',
+         'calibration_data'))
+
+def encode_psd(calibration_data, max_freq):
+    # X, Y and Z PSDs resampled to PSD_FREQ_STEP, as compressed float32
+    freqs = np.arange(0., max_freq, PSD_FREQ_STEP)
+    psds = np.array([np.interp(freqs, calibration_data.freq_bins,
+                               calibration_data.get_psd(axis))
+                     for axis in 'xyz'], dtype='<f4')
+    return zlib.compress(psds.tobytes())
+
+def decode_psd(blob, freq_step):
+    psds = np.frombuffer(zlib.decompress(blob), dtype='<f4').reshape(3, -1)
+    return np.arange(psds.shape[1]) * freq_step, psds
+
+class CalibrationHistory:
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise ValueError("Unsupported calibration history version %d" % (
+                version,))
+        with self.db:
+            self.db.executescript(SCHEMA)
+            self.db.execute("PRAGMA user_version = %d" % (SCHEMA_VERSION,))
+    def close(self):
+        self.db.close()
+    def _insert_run(self, run, max_freq):
+        selected = [s for s in run.shapers if s.name == run.selected_shaper]
+        psd = None
+        if run.calibration_data is not None:
+            psd = encode_psd(run.calibration_data, max_freq)
+        cursor = self.db.execute(
+                "INSERT INTO runs (printer_id, timestamp, params,"
+                " selected_shaper, selected_freq, psd_freq_step, psd)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)", (
+                    run.printer_id, run.timestamp,
+                    json.dumps(run.params or {}, sort_keys=True),
+                    run.selected_shaper,
+                    float(selected[0].freq) if selected else None,
+                    PSD_FREQ_STEP if psd is not None else None, psd))
+        run_id = cursor.lastrowid
+        self.db.executemany(
+                "INSERT INTO shapers (run_id, name, freq, vibrs, smoothing,"
+                " score, max_accel) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, s.name, float(s.freq), float(s.vibrs),
+                  float(s.smoothing), float(s.score), float(s.max_accel))
+                 for s in run.shapers])
+        return run_id
+    def record_runs(self, runs, max_freq=200.):
+        # Bulk insert of HistoryRun-s in a single transaction
+        with self.db:
+            return [self._insert_run(run, max_freq) for run in runs]
+    def record_run(self, printer_id, shapers, selected_shaper,
+                   calibration_data=None, params=None, timestamp=None,
+                   max_freq=200.):
+        run = HistoryRun(printer_id, time.time() if timestamp is None
+                         else timestamp, params, selected_shaper, shapers,
+                         calibration_data)
+        return self.record_runs([run], max_freq)[0]
+    def get_frequency_drift(self, printer_id, since=None, until=None):
+        # (timestamp, selected shaper, frequency) of the runs of the printer
+        return self.db.execute(
+                "SELECT timestamp, selected_shaper, selected_freq FROM runs"
+                " WHERE printer_id = ? AND timestamp >= ? AND timestamp <= ?"
+                " ORDER BY timestamp", (
+                    printer_id, -float('inf') if since is None else since,
+                    float('inf') if until is None else until)).fetchall()
+    def get_shaper_trend(self, printer_id, shaper_name, since=None,
+                         until=None):
+        # (timestamp, freq, vibrs, smoothing, max_accel) of a shaper fitted
+        # in the runs of the printer
+        return self.db.execute(
+                "SELECT r.timestamp, s.freq, s.vibrs, s.smoothing, s.max_accel"
+                " FROM runs r JOIN shapers s ON s.run_id = r.id"
+                " WHERE r.printer_id = ? AND r.timestamp >= ?"
+                " AND r.timestamp <= ? AND s.name = ? ORDER BY r.timestamp", (
+                    printer_id, -float('inf') if since is None else since,
+                    float('inf') if until is None else until,
+                    shaper_name)).fetchall()
+    def get_printers(self):
+        return [row[0] for row in self.db.execute(
+            "SELECT DISTINCT printer_id FROM runs ORDER BY printer_id")]
+    def get_params(self, run_id):
+        row = self.db.execute("SELECT params FROM runs WHERE id = ?",
+                              (run_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+    def get_psd(self, run_id):
+        # Frequencies and the (X, Y, Z) PSDs of the run, if stored
+        row = self.db.execute(
+                "SELECT psd, psd_freq_step FROM runs WHERE id = ?",
+                (run_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return decode_psd(row[0], row[1])
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <history database> <printer id>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("--days", type="float", dest="days", default=None,
+                    help="only show the runs of the last days")
+    opts.add_option("--shaper", type="string", dest="shaper", default=None,
+                    help="show the trend of this shaper instead of the " +
+                    "selected ones")
+    options, args = opts.parse_args()
+    if len(args) != 2:
+        opts.error("Incorrect number of arguments")
+
+    history = CalibrationHistory(args[0])
+    since = None
+    if options.days is not None:
+        since = time.time() - options.days * 86400.
+    try:
+        if options.shaper is None:
+            for timestamp, name, freq in history.get_frequency_drift(
+                    args[1], since):
+                print("%s %s @ %.1f Hz" % (
+                    time.strftime("%Y-%m-%d %H:%M", time.localtime(timestamp)),
+                    name, freq or 0.))
+        else:
+            for timestamp, freq, vibrs, smoothing, max_accel in \
+                    history.get_shaper_trend(args[1], options.shaper, since):
+                print("%s %s @ %.1f Hz (vibrations = %.1f%%, smoothing ~= "
+                      "%.3f, max_accel <= %.0f mm/sec^2)" % (
+                          time.strftime("%Y-%m-%d %H:%M",
+                                        time.localtime(timestamp)),
+                          options.shaper, freq, vibrs * 100., smoothing,
+                          max_accel))
+    finally:
+        history.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# Headless shaper calibration service
+#
+# Serves calibration jobs over a local HTTP/JSON API. Jobs are queued and
+# dispatched to a pool of warm worker processes, each keeping its own
+# ShaperCalibrate instance (and its shaper response bank) between jobs.
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import base64, collections, concurrent.futures, contextlib, io, itertools
+import json, math, optparse, os, queue, threading, time, traceback
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import calibrate_shaper
+
+MAX_FINISHED_JOBS = 1000
+LATENCY_WINDOW = 1000
+# Longest time a request may wait for a job to finish
+MAX_WAIT_TIME = 3600.
+
+JOB_PARAMS = ('shapers', 'damping_ratio', 'scv', 'shaper_freqs',
+              'max_smoothing', 'test_damping_ratios', 'max_freq', 'axes',
+              'band_limited', 'plot')
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_list_of(value, check):
+    return isinstance(value, list) and all(check(item) for item in value)
+
+def _is_str(value):
+    return isinstance(value, str)
+
+def _is_shaper_freqs(value):
+    # Either a list of frequencies or a {start, end, step} range
+    if isinstance(value, dict):
+        return (not set(value) - {'start', 'end', 'step'} and
+                all(v is None or _is_number(v) for v in value.values()))
+    return _is_list_of(value, _is_number)
+
+# Checks of the job params, which may also be null (the defaults)
+JOB_PARAM_CHECKS = {
+    'shapers': ("a list of shaper names",
+                lambda v: _is_list_of(v, _is_str)),
+    'damping_ratio': ("a number", _is_number),
+    'scv': ("a number", _is_number),
+    'shaper_freqs': ("a list of frequencies or a {start, end, step} object",
+                     _is_shaper_freqs),
+    'max_smoothing': ("a number", _is_number),
+    'test_damping_ratios': ("a list of numbers",
+                            lambda v: _is_list_of(v, _is_number)),
+    'max_freq': ("a number", _is_number),
+    'axes': ("a list of axis names", lambda v: _is_list_of(v, _is_str)),
+    'band_limited': ("a boolean", lambda v: isinstance(v, bool)),
+    'plot': ("a boolean", lambda v: isinstance(v, bool)),
+}
+
+######################################################################
+# Worker processes
+######################################################################
+
+_helper = None
+
+def _init_worker(bank_dir):
+    global _helper
+    _helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(
+            printer=None, bank_dir=bank_dir)
+    calibrate_shaper.setup_matplotlib(True)
+
+def _render_png(lognames, calibration_data, shapers, selected_shaper,
+                max_freq):
+    fig = calibrate_shaper.plot_freq_response(
+            lognames, calibration_data, shapers, selected_shaper, max_freq)
+    fig.set_size_inches(8, 6)
+    out = io.BytesIO()
+    fig.savefig(out, format='png')
+    calibrate_shaper.matplotlib.pyplot.close(fig)
+    return out.getvalue()
+
+def run_job(params):
+    shaper_freqs = params.get('shaper_freqs') or []
+    if isinstance(shaper_freqs, dict):
+        shaper_freqs = (shaper_freqs.get('start'), shaper_freqs.get('end'),
+                        shaper_freqs.get('step'))
+    max_freq = params.get('max_freq') or 200.
+    datas = [calibrate_shaper.parse_log(fn, validate=True)
+             for fn in params['files']]
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        selected_shaper, shapers, calibration_data = \
+                calibrate_shaper.calibrate_shaper(
+                        datas, None, shapers=params.get('shapers'),
+                        damping_ratio=params.get('damping_ratio'),
+                        scv=params.get('scv') or 5.,
+                        shaper_freqs=shaper_freqs,
+                        max_smoothing=params.get('max_smoothing'),
+                        test_damping_ratios=params.get('test_damping_ratios'),
+                        max_freq=max_freq, axes=params.get('axes'),
+                        band_limited=params.get('band_limited', False),
+                        helper=_helper)
+    result = {'log': log.getvalue(), 'selected_shaper': selected_shaper,
+              'shapers': []}
+    if selected_shaper is None:
+        return result
+    for shaper in shapers:
+        result['shapers'].append({
+            'name': shaper.name, 'freq': float(shaper.freq),
+            'vibrs': float(shaper.vibrs),
+            'smoothing': float(shaper.smoothing),
+            'score': float(shaper.score),
+            'max_accel': float(shaper.max_accel)})
+    if params.get('plot'):
+        lognames = [os.path.basename(fn) for fn in params['files']]
+        png = _render_png(lognames, calibration_data, shapers,
+                          selected_shaper, max_freq)
+        result['png'] = base64.b64encode(png).decode('ascii')
+    return result
+
+######################################################################
+# Job queue
+######################################################################
+
+class CalibrationService:
+    def __init__(self, workers=None, bank_dir=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.workers, initializer=_init_worker, initargs=(bank_dir,))
+        self.job_queue = queue.Queue()
+        # Jobs are only handed to the pool when a worker is free, so that
+        # the queue depth reflects the jobs really waiting for a worker
+        self.free_workers = threading.Semaphore(self.workers)
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.start_time = time.time()
+        self.completed = self.failed = 0
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+    def submit(self, params):
+        files = params.get('files')
+        if not files or not _is_list_of(files, _is_str):
+            raise ValueError("Job must specify a non-empty list of 'files'")
+        unknown = set(params) - set(JOB_PARAMS) - {'files'}
+        if unknown:
+            raise ValueError("Unknown job params: %s" % (
+                ', '.join(sorted(unknown)),))
+        for name, value in params.items():
+            if name in JOB_PARAM_CHECKS and value is not None:
+                description, check = JOB_PARAM_CHECKS[name]
+                if not check(value):
+                    raise ValueError("Job param '%s' must be %s" % (
+                        name, description))
+        job = {'id': next(self.job_ids), 'status': 'queued', 'params': params,
+               'submit_time': time.time(), 'done': threading.Event()}
+        with self.lock:
+            self.jobs[job['id']] = job
+        self.job_queue.put(job)
+        return job['id']
+    def _dispatch(self):
+        while True:
+            job = self.job_queue.get()
+            if job is None:
+                return
+            self.free_workers.acquire()
+            with self.lock:
+                job['status'] = 'running'
+                job['start_time'] = time.time()
+            try:
+                future = self.executor.submit(run_job, job['params'])
+            except Exception as e:
+                # E.g. a broken pool, the job fails without running and
+                # its worker slot is released
+                future = concurrent.futures.Future()
+                future.set_exception(e)
+            future.add_done_callback(
+                    lambda future, job=job: self._finish(job, future))
+    def _finish(self, job, future):
+        self.free_workers.release()
+        with self.lock:
+            job['end_time'] = time.time()
+            try:
+                job['result'] = future.result()
+                job['status'] = 'done'
+                self.completed += 1
+            except Exception as e:
+                job['error'] = "".join(traceback.format_exception_only(
+                    type(e), e)).strip()
+                job['status'] = 'failed'
+                self.failed += 1
+            self.latencies.append(job['end_time'] - job['submit_time'])
+            # Forget the oldest finished jobs
+            while len(self.jobs) > MAX_FINISHED_JOBS:
+                oldest = next(iter(self.jobs.values()))
+                if not oldest['done'].is_set():
+                    break
+                self.jobs.popitem(last=False)
+        job['done'].set()
+    def get_job(self, job_id, timeout=None):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if timeout:
+            job['done'].wait(timeout)
+        with self.lock:
+            status = {'id': job['id'], 'status': job['status']}
+            if 'start_time' in job:
+                status['queue_time'] = job['start_time'] - job['submit_time']
+            if 'end_time' in job:
+                status['run_time'] = job['end_time'] - job['start_time']
+                status['latency'] = job['end_time'] - job['submit_time']
+            for key in ('result', 'error'):
+                if key in job:
+                    status[key] = job[key]
+        return status
+    def get_metrics(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            running = sum(1 for job in self.jobs.values()
+                          if job['status'] == 'running')
+            uptime = time.time() - self.start_time
+            metrics = {'workers': self.workers,
+                       'queue_depth': self.job_queue.qsize(),
+                       'running': running, 'completed': self.completed,
+                       'failed': self.failed, 'uptime': uptime,
+                       'throughput': (self.completed + self.failed) / uptime}
+        if latencies:
+            metrics['latency'] = {
+                    'mean': sum(latencies) / len(latencies),
+                    'p50': latencies[len(latencies) // 2],
+                    'p95': latencies[int(len(latencies) * .95)],
+                    'max': latencies[-1]}
+        return metrics
+    def shutdown(self):
+        self.job_queue.put(None)
+        self.dispatcher.join()
+        self.executor.shutdown()
+
+######################################################################
+# HTTP/JSON API
+######################################################################
+
+class CalibrationRequestHandler(BaseHTTPRequestHandler):
+    # POST /jobs               - queue a job, returns its id
+    # GET  /jobs/<id>[?wait=s] - job status and result
+    # POST /calibrate          - queue a job and wait for its result
+    # GET  /metrics            - queue depth, latency and throughput
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def _read_job(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = json.loads(self.rfile.read(length) or b'{}')
+        if not isinstance(params, dict):
+            raise ValueError("Job must be a JSON object")
+        return self.server.service.submit(params)
+    def do_POST(self):
+        if self.path not in ('/jobs', '/calibrate'):
+            return self._reply(404, {'error': "Unknown path %s" % (self.path,)})
+        try:
+            job_id = self._read_job()
+        except ValueError as e:
+            return self._reply(400, {'error': str(e)})
+        if self.path == '/jobs':
+            return self._reply(202, {'id': job_id})
+        self._reply(200, self.server.service.get_job(job_id,
+                                                     timeout=MAX_WAIT_TIME))
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        if path == '/metrics':
+            return self._reply(200, self.server.service.get_metrics())
+        if path.startswith('/jobs/'):
+            timeout = None
+            try:
+                if query.startswith('wait='):
+                    timeout = float(query[len('wait='):])
+                    if not math.isfinite(timeout) or timeout < 0.:
+                        raise ValueError(timeout)
+                    timeout = min(timeout, MAX_WAIT_TIME)
+            except ValueError:
+                return self._reply(400, {'error': "Invalid wait time"})
+            try:
+                job = self.server.service.get_job(int(path[len('/jobs/'):]),
+                                                  timeout)
+            except ValueError:
+                job = None
+            if job is None:
+                return self._reply(404, {'error': "Unknown job"})
+            return self._reply(200, job)
+        self._reply(404, {'error': "Unknown path %s" % (self.path,)})
+
+def start_server(service, port=0, verbose=False):
+    # Only listens on localhost, the service reads files from local disk
+    server = ThreadingHTTPServer(('127.0.0.1', port),
+                                 CalibrationRequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+def call_service(url, path, payload=None, timeout=3600.):
+    # Minimal client for the service API
+    data = None
+    if payload is not None:
+        data = json.dumps(payload).encode('utf-8')
+    req = urllib.request.Request(url + path, data=data,
+                                 headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read())
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-p", "--port", type="int", dest="port", default=8765,
+                    help="localhost port to listen on")
+    opts.add_option("-w", "--workers", type="int", dest="workers",
+                    default=None, help="number of worker processes")
+    opts.add_option("--bank_dir", type="string", dest="bank_dir",
+                    default=None, help="directory to persist precomputed " +
+                    "shaper responses in, reused across runs")
+    opts.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                    default=False, help="log every HTTP request")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+
+    service = CalibrationService(options.workers, options.bank_dir)
+    server = start_server(service, options.port, options.verbose)
+    print("Serving calibration jobs on http://127.0.0.1:%d with %d workers" % (
+        server.server_address[1], service.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+if __name__ == '__main__':
+    main()
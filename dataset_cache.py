@@ -0,0 +1,114 @@
+# In-memory cache of analyzed resonance captures for the GUI.
+
+import collections
+import contextlib
+import hashlib
+import io
+import threading
+from typing import Any, Callable, List, NamedTuple, Optional
+
+import calibrate_shaper
+
+HASH_CHUNK_SIZE: int = 1 << 20
+
+
+class Dataset(NamedTuple):
+    """An analyzed capture: its frequency response and fitted shapers."""
+    name: str
+    key: str
+    calibration_data: Any
+    shapers: List[Any]
+    selected_shaper: Optional[str]
+    log: str
+    preview: bool = False
+
+
+def file_hash(filename: str) -> str:
+    """
+    Returns the SHA-1 digest of the file contents, read in bounded chunks.
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_file(filename: str) -> Any:
+    """
+    Parses and validates a single capture.
+    """
+    return calibrate_shaper.parse_log(filename, validate=True)
+
+
+def analyze_file(filename: str, max_freq: float, preview: bool = False,
+                 data: Any = None) -> Dataset:
+    """
+    Analyzes a single capture with the default calibration parameters,
+    capturing the printed output. The capture is parsed unless its parsed
+    `data` is passed. A preview is a quick, coarse analysis of the capture.
+    """
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        datas = [parse_file(filename) if data is None else data]
+        selected_shaper, shapers, calibration_data = calibrate_shaper.calibrate_shaper(
+            datas,
+            None,  # csv_output
+            shapers=None,
+            damping_ratio=None,
+            scv=5.0,
+            shaper_freqs=[],
+            max_smoothing=None,
+            test_damping_ratios=None,
+            max_freq=max_freq,
+            preview=preview
+        )
+    return Dataset(filename, '', calibration_data, shapers or [],
+                   selected_shaper, log.getvalue(), preview)
+
+
+class DatasetCache:
+    """
+    A bounded LRU cache of analyzed captures keyed by the hash of the file
+    contents, so that renamed or re-selected files are not analyzed again.
+    """
+    def __init__(self, max_entries: int = 16,
+                 analyze: Callable[..., Dataset] = analyze_file,
+                 parse: Callable[[str], Any] = parse_file):
+        self.max_entries = max_entries
+        self.analyze = analyze
+        self.parse = parse
+        self.lock = threading.Lock()
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, filename: str, max_freq: float = 200.,
+            on_preview: Optional[Callable[[Dataset], None]] = None) -> Dataset:
+        """
+        Returns the analyzed dataset for the file, analyzing it only if it
+        is not cached yet. When the file has to be analyzed, `on_preview`
+        first receives a quick preview of the analysis, both of them share
+        the parsed capture.
+        """
+        key = "%s:%g" % (file_hash(filename), max_freq)
+        with self.lock:
+            dataset = self.entries.get(key)
+            if dataset is not None:
+                self.entries.move_to_end(key)
+                return dataset._replace(name=filename)
+        if on_preview is None:
+            dataset = self.analyze(filename, max_freq)
+        else:
+            data = self.parse(filename)
+            on_preview(self.analyze(filename, max_freq, preview=True,
+                                    data=data)._replace(key=key))
+            dataset = self.analyze(filename, max_freq, data=data)
+        dataset = dataset._replace(key=key)
+        with self.lock:
+            self.entries[key] = dataset
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return dataset
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
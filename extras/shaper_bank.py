@@ -0,0 +1,190 @@
+# Precomputed bank of input shaper frequency responses
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections, hashlib, logging, math, os
+
+# Bump whenever the layout or the computation of the tables changes, so
+# that stale tables persisted on disk are never reused
+BANK_VERSION = 3
+
+MAX_CACHED_TABLES = 32
+# Tables persisted in the bank directory are evicted, least recently used
+# first, above that total size
+MAX_BANK_DIR_SIZE = 256 << 20
+
+# Tables are kept on a canonical frequency grid with BANK_FREQ_STEP
+# spacing, extended in BANK_GRID_SPAN increments to cover the freq_bins of
+# the PSDs, and interpolated onto them
+BANK_FREQ_STEP = .5
+BANK_GRID_SPAN = 100.
+
+def estimate_shaper_spectra(np, shapers, test_damping_ratio, freq_bins):
+    # Vectorized version of ShaperCalibrate._estimate_shaper for a series of
+    # shapers with the same number of impulses (one shaper per output row),
+    # as the (real, imag) parts of the complex responses with phases
+    # relative to the shaper centers. Unlike the magnitudes, these are smooth
+    # in frequency even around the zeros of the responses, so they can be
+    # interpolated linearly between the bins of a coarse grid.
+    A = np.array([shaper[0] for shaper in shapers], dtype=np.float64)
+    T = np.array([shaper[1] for shaper in shapers], dtype=np.float64)
+    inv_D = 1. / A.sum(axis=-1)
+    T_center = (A * T).sum(axis=-1, keepdims=True) * inv_D[:, None]
+
+    omega = 2. * math.pi * freq_bins
+    damping = test_damping_ratio * omega
+    omega_d = omega * math.sqrt(1. - test_damping_ratio**2)
+    # Dimensions: shapers x freq_bins x impulses
+    W = A[:, None, :] * np.exp(-damping[None, :, None]
+                               * (T[:, -1:] - T)[:, None, :])
+    phase = omega_d[None, :, None] * (T - T_center)[:, None, :]
+    S = (W * np.sin(phase)).sum(axis=-1) * inv_D[:, None]
+    C = (W * np.cos(phase)).sum(axis=-1) * inv_D[:, None]
+    return C, S
+
+def get_bank_grid(np, freq_bins):
+    # The canonical frequency grid covering `freq_bins`, with a spare bin
+    # for the interpolation at its end
+    max_freq = float(np.max(freq_bins)) if len(freq_bins) else 0.
+    span = max(math.ceil(max_freq / BANK_GRID_SPAN), 1) * BANK_GRID_SPAN
+    return np.arange(int(round(span / BANK_FREQ_STEP)) + 2) * BANK_FREQ_STEP
+
+class ShaperResponseBank:
+    # Shaper responses do not depend on the measured PSD, only on the shaper,
+    # the test frequencies, the test damping ratios and the freq_bins. The
+    # bank keeps them as tables of the complex responses ((real, imag) x
+    # test damping ratios x test frequencies x canonical grid), in memory
+    # and, optionally, as memory-mapped files in `bank_dir`, and
+    # interpolates them onto the freq_bins of the PSDs. So the tables are
+    # reused by the captures with different sample counts or durations.
+    def __init__(self, numpy, bank_dir=None, max_cached=MAX_CACHED_TABLES,
+                 max_dir_size=MAX_BANK_DIR_SIZE):
+        self.numpy = numpy
+        self.bank_dir = bank_dir
+        self.max_cached = max_cached
+        self.max_dir_size = max_dir_size
+        self._tables = collections.OrderedDict()
+    def _get_key(self, shaper_cfg, damping_ratio, test_freqs,
+                 test_damping_ratios, grid, dtype):
+        np = self.numpy
+        h = hashlib.sha1()
+        # Custom shapers may share a name, so the impulses (at 1 Hz) are
+        # a part of the key as well
+        A, T = shaper_cfg.init_func(1., damping_ratio)
+        h.update(("%d:%s:%r:%r:%r:%r:%s" % (
+            BANK_VERSION, shaper_cfg.name, float(damping_ratio),
+            [float(dr) for dr in test_damping_ratios],
+            [float(a) for a in A], [float(t) for t in T],
+            np.dtype(dtype).str)).encode())
+        test_freqs = np.ascontiguousarray(test_freqs, dtype=np.float64)
+        h.update(b"%d:" % (test_freqs.shape[0],))
+        h.update(test_freqs.tobytes())
+        h.update(b"%d:%r" % (len(grid), float(grid[-1])))
+        return "v%d-%s-%s" % (BANK_VERSION, shaper_cfg.name, h.hexdigest())
+    def _get_path(self, key):
+        return os.path.join(self.bank_dir, key + ".npy")
+    def _load(self, key, shape, dtype):
+        np = self.numpy
+        path = self._get_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            table = np.load(path, mmap_mode='r')
+        except (IOError, ValueError) as e:
+            logging.warning("Failed to load shaper response bank '%s': %s",
+                            path, str(e))
+            return None
+        if table.shape != shape or table.dtype != dtype:
+            return None
+        try:
+            # Marks the table as recently used for the eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return table
+    def _store(self, key, table):
+        path = self._get_path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            os.makedirs(self.bank_dir, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                self.numpy.save(f, table)
+            os.replace(tmp_path, path)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to store shaper response bank '%s': %s",
+                            path, str(e))
+            return
+        self._evict(path)
+    def _evict(self, keep_path):
+        # Removes the least recently used tables above MAX_BANK_DIR_SIZE
+        try:
+            paths = [os.path.join(self.bank_dir, name)
+                     for name in os.listdir(self.bank_dir)
+                     if name.startswith('v') and name.endswith('.npy')]
+            stats = [(os.stat(path), path) for path in paths]
+        except OSError as e:
+            logging.warning("Failed to list shaper response bank '%s': %s",
+                            self.bank_dir, str(e))
+            return
+        total_size = sum(st.st_size for st, _ in stats)
+        for st, path in sorted(stats, key=lambda item: item[0].st_mtime):
+            if total_size <= self.max_dir_size:
+                break
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= st.st_size
+    def compute(self, shaper_cfg, damping_ratio, test_freqs,
+                test_damping_ratios, freq_bins, dtype=None):
+        # The complex responses ((real, imag) x test damping ratios x test
+        # frequencies x freq_bins) are always computed in double precision,
+        # `dtype` only affects the storage of the table
+        np = self.numpy
+        freq_bins = np.asarray(freq_bins, dtype=np.float64)
+        shapers = [shaper_cfg.init_func(test_freq, damping_ratio)
+                   for test_freq in test_freqs]
+        spectra = [estimate_shaper_spectra(np, shapers, dr, freq_bins)
+                   for dr in test_damping_ratios]
+        return np.array([[spectrum[part] for spectrum in spectra]
+                         for part in range(2)], dtype=dtype or np.float64)
+    def get_table(self, shaper_cfg, damping_ratio, test_freqs,
+                  test_damping_ratios, grid, dtype=None):
+        dtype = self.numpy.dtype(dtype or self.numpy.float64)
+        key = self._get_key(shaper_cfg, damping_ratio, test_freqs,
+                            test_damping_ratios, grid, dtype)
+        table = self._tables.get(key)
+        if table is not None:
+            self._tables.move_to_end(key)
+            return table
+        shape = (2, len(test_damping_ratios), len(test_freqs), len(grid))
+        if self.bank_dir is not None:
+            table = self._load(key, shape, dtype)
+        if table is None:
+            table = self.compute(shaper_cfg, damping_ratio, test_freqs,
+                                 test_damping_ratios, grid, dtype)
+            if self.bank_dir is not None:
+                self._store(key, table)
+        self._tables[key] = table
+        while len(self._tables) > self.max_cached:
+            self._tables.popitem(last=False)
+        return table
+    def get_responses(self, shaper_cfg, damping_ratio, test_freqs,
+                      test_damping_ratios, freq_bins, dtype=None, rows=None):
+        # Shaper responses (test damping ratios x test frequencies x
+        # freq_bins), optionally only for the `rows` of test frequencies,
+        # interpolated from the table on the canonical grid
+        np = self.numpy
+        freq_bins = np.asarray(freq_bins, dtype=np.float64)
+        grid = get_bank_grid(np, freq_bins)
+        table = self.get_table(shaper_cfg, damping_ratio, test_freqs,
+                               test_damping_ratios, grid, dtype)
+        if rows is not None:
+            table = table[:, :, rows]
+        pos = freq_bins * (1. / BANK_FREQ_STEP)
+        inds = np.minimum(pos.astype(np.int64), len(grid) - 2)
+        w = (pos - inds).astype(table.dtype)
+        lower, upper = table[..., inds], table[..., inds + 1]
+        parts = lower + (upper - lower) * w
+        return np.sqrt(parts[0]**2 + parts[1]**2)
@@ -3,22 +3,123 @@
 # Copyright (C) 2020-2024  Dmitry Butyugin <dmbutyugin@google.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import collections, importlib, logging, math, multiprocessing, traceback
+import collections, concurrent.futures, importlib, logging, math
+import multiprocessing, traceback
 shaper_defs = importlib.import_module('.shaper_defs', 'extras')
+shaper_bank = importlib.import_module('.shaper_bank', 'extras')
 
 MIN_FREQ = 5.
 MAX_FREQ = 200.
 WINDOW_T_SEC = 0.5
+# Quick previews use twice shorter windows (a coarser frequency grid) and
+# only every PREVIEW_WINDOW_STRIDE-th of them
+PREVIEW_WINDOW_T_SEC = 0.25
+PREVIEW_WINDOW_STRIDE = 4
 MAX_SHAPER_FREQ = 150.
+# Just some empirically chosen value which produces good projections
+# for max_accel without much smoothing
+TARGET_SMOOTHING = 0.12
+# Acceleration at which the smoothing of shapers is compared
+SMOOTHING_ACCEL = 5000.
 
 TEST_DAMPING_RATIOS=[0.075, 0.1, 0.15]
 
+# The Welch windows overlap by half, so bootstrap replicates resample
+# blocks of consecutive windows (about n^(1/3) of them, but at least
+# MIN_BOOTSTRAP_BLOCK) to keep the correlation of the neighboring windows
+MIN_BOOTSTRAP_BLOCK = 2
+
 AUTOTUNE_SHAPERS = ['zv', 'mzv', 'ei', '2hump_ei', '3hump_ei']
 
+# Limits the size of temporary arrays when applying shaper responses
+MAX_CHUNK_SIZE = 1 << 22
+
+# Anti-aliasing filter parameters for band-limited frequency response
+DECIMATION_MIN_RATE_RATIO = 2.5
+DECIMATION_ATTENUATION_DB = 80.
+
+# Limits of raw accelerometer captures accepted for processing
+MAX_TIMESTAMP_JITTER = .5
+MAX_GAP_RATIO = 2.5
+MAX_DROPPED_SAMPLES_RATIO = .01
+MAX_CLIPPED_SAMPLES_RATIO = .001
+# Samples are clipped if held at the extreme value of an axis for at least
+# that many consecutive samples (single extremes of a coarsely quantized
+# quiet axis are not)
+MIN_CLIPPED_RUN = 4
+MIN_AXIS_STD = 1.
+
+# Test segments of multi-test recordings are detected from the energy of
+# short frames: frames above SEGMENT_ENERGY_RATIO times the noise floor
+# (the SEGMENT_NOISE_PERCENTILE of frame energies) are active. Shorter idle
+# gaps do not split a test, and shorter segments are dropped.
+SEGMENT_FRAME_T_SEC = .1
+SEGMENT_NOISE_PERCENTILE = 5.
+SEGMENT_ENERGY_RATIO = 4.
+MIN_IDLE_GAP_T_SEC = 1.
+MIN_SEGMENT_T_SEC = 1.
+# Every worker processing a test segment holds its whole spectrogram
+MAX_SEGMENT_WORKERS = 4
+
+# Pairs of axes to compute cross-spectral densities for
+CROSS_SPECTRA_PAIRS = ('xy', 'xz', 'yz')
+
+# Resonance peaks less prominent than this fraction of the PSD maximum
+# are not indexed
+PEAK_MIN_PROMINENCE = .05
+# Shapers are only fitted at the test frequencies within this ratio of the
+# indexed resonance peak bands: further away, a shaper either leaves the
+# peaks unreduced or suppresses them with much more smoothing
+PEAK_TEST_FREQ_RATIO = 2.
+
 ######################################################################
 # Frequency response calculation and shaper auto-tuning
 ######################################################################
 
+ResonancePeaks = collections.namedtuple(
+        'ResonancePeaks', ('freqs', 'amplitudes', 'prominences', 'bandwidths'))
+
+def find_resonance_peaks(np, freq_bins, psd, min_prominence=None):
+    # Local maxima of the PSD with their prominences and bandwidths (full
+    # width at half prominence), by decreasing prominence. All candidate
+    # peaks are processed at once using (peaks x freq_bins) masks.
+    if min_prominence is None:
+        min_prominence = PEAK_MIN_PROMINENCE * psd.max()
+    n = len(psd)
+    peaks = ((psd[1:-1] > psd[:-2]) & (psd[1:-1] >= psd[2:])).nonzero()[0] + 1
+    inds = np.arange(n)
+    heights = psd[peaks][:, None]
+    before = inds < peaks[:, None]
+    after = inds > peaks[:, None]
+    # A peak extends on both sides up to the closest higher points, its
+    # prominence is the height above the higher of the two minima there
+    higher = psd > heights
+    left_end = np.where(higher & before, inds, -1).max(axis=1, keepdims=True)
+    right_end = np.where(higher & after, inds, n).min(axis=1, keepdims=True)
+    left = before & (inds > left_end)
+    right = after & (inds < right_end)
+    prominences = heights[:, 0] - np.maximum(
+            np.where(left, psd, np.inf).min(axis=1),
+            np.where(right, psd, np.inf).min(axis=1))
+    prominent = (prominences >= min_prominence) & (prominences > 0.)
+    peaks, heights, prominences = (
+            peaks[prominent], heights[prominent], prominences[prominent])
+    left, right = left[prominent], right[prominent]
+    # Interpolated crossings of the half prominence level on both sides
+    below = psd < heights - prominences[:, None] * .5
+    half = heights[:, 0] - prominences * .5
+    i = np.where(left & below, inds, -1).max(axis=1)
+    left_freqs = freq_bins[i] + (freq_bins[i+1] - freq_bins[i]) * (
+            (half - psd[i]) / (psd[i+1] - psd[i]))
+    i = np.where(right & below, inds, n).min(axis=1)
+    right_freqs = freq_bins[i] - (freq_bins[i] - freq_bins[i-1]) * (
+            (half - psd[i]) / (psd[i-1] - psd[i]))
+    order = np.argsort(-prominences, kind='stable')
+    return ResonancePeaks(
+            freqs=freq_bins[peaks][order], amplitudes=heights[order, 0],
+            prominences=prominences[order],
+            bandwidths=(right_freqs - left_freqs)[order])
+
 class CalibrationData:
     def __init__(self, freq_bins, psd_sum, psd_x, psd_y, psd_z):
         self.freq_bins = freq_bins
@@ -30,6 +131,14 @@ class CalibrationData:
         self._psd_map = {'x': self.psd_x, 'y': self.psd_y, 'z': self.psd_z,
                          'all': self.psd_sum}
         self.data_sets = 1
+        # Optional per-window spectra (time x freq_bins) of the Welch's
+        # algorithm, and the times of the window centers
+        self.spectrogram_times = None
+        self._spectrogram_map = {}
+        # Lazily computed resonance peaks of every axis
+        self._peaks = {}
+        # Optional complex cross-spectral densities of pairs of axes
+        self._csd_map = {}
     def add_data(self, other):
         np = self.numpy
         joined_data_sets = self.data_sets + other.data_sets
@@ -40,27 +149,343 @@ class CalibrationData:
                     self.freq_bins, other.freq_bins, other_psd)
             psd *= self.data_sets
             psd[:] = (psd + other_normalized) * (1. / joined_data_sets)
+        if self.has_cross_spectra() and other.has_cross_spectra():
+            for pair, csd in self._csd_map.items():
+                other_normalized = other.data_sets * np.interp(
+                        self.freq_bins, other.freq_bins, other.get_csd(pair))
+                csd *= self.data_sets
+                csd[:] = (csd + other_normalized) * (1. / joined_data_sets)
+        else:
+            self._csd_map = {}
         self.data_sets = joined_data_sets
+        self._peaks = {}
+        if self.has_spectrogram() and other.has_spectrogram():
+            self._append_spectrogram(other)
+        else:
+            self.spectrogram_times = None
+            self._spectrogram_map = {}
+    def _append_spectrogram(self, other):
+        # Spectrograms of the joined data sets follow each other in time
+        np = self.numpy
+        times = self.spectrogram_times
+        other_times = other.spectrogram_times
+        time_step = times[1] - times[0] if len(times) > 1 else 0.
+        self.spectrogram_times = np.concatenate([
+            times, other_times - other_times[0] + times[-1] + time_step])
+        for axis, spectrogram in self._spectrogram_map.items():
+            other_spectrogram = other.get_spectrogram(axis)
+            if not np.array_equal(self.freq_bins, other.freq_bins):
+                other_spectrogram = np.array([
+                    np.interp(self.freq_bins, other.freq_bins, spectrum)
+                    for spectrum in other_spectrogram], dtype=spectrogram.dtype)
+            self._spectrogram_map[axis] = np.concatenate(
+                    [spectrogram, other_spectrogram])
     def set_numpy(self, numpy):
         self.numpy = numpy
+    def set_spectrogram(self, times, spectrogram_x, spectrogram_y,
+                        spectrogram_z):
+        self.spectrogram_times = times
+        self._spectrogram_map = {
+                'x': spectrogram_x, 'y': spectrogram_y, 'z': spectrogram_z,
+                'all': spectrogram_x + spectrogram_y + spectrogram_z}
+    def has_spectrogram(self):
+        return self.spectrogram_times is not None
+    def set_cross_spectra(self, csd_xy, csd_xz, csd_yz):
+        self._csd_map = dict(zip(CROSS_SPECTRA_PAIRS,
+                                 (csd_xy, csd_xz, csd_yz)))
+    def has_cross_spectra(self):
+        return bool(self._csd_map)
+    def get_csd(self, pair='xy'):
+        return self._csd_map[pair]
+    def get_coherence(self, pair='xy'):
+        # Magnitude-squared coherence, close to 1 at the frequencies where
+        # the vibrations of both axes come from the same source
+        psd_a, psd_b = self.get_psd(pair[0]), self.get_psd(pair[1])
+        csd = self._csd_map[pair]
+        return (csd.real**2 + csd.imag**2) / self.numpy.maximum(
+                psd_a * psd_b, self.numpy.finfo(psd_a.dtype).tiny)
     def normalize_to_frequencies(self):
-        for psd in self._psd_list:
+        # Cross-spectra are normalized like the PSDs, so the coherence does
+        # not change
+        for psd in (self._psd_list + list(self._spectrogram_map.values()) +
+                    list(self._csd_map.values())):
             # Avoid division by zero errors
             psd /= self.freq_bins + .1
             # Remove low-frequency noise
             low_freqs = self.freq_bins < 2. * MIN_FREQ
-            psd[low_freqs] *= self.numpy.exp(
+            psd[..., low_freqs] *= self.numpy.exp(
                     -(2. * MIN_FREQ / (self.freq_bins[low_freqs] + .1))**2 + 1.)
+        self._peaks = {}
     def get_psd(self, axis='all'):
         return self._psd_map[axis]
+    def get_peaks(self, axis='all'):
+        peaks = self._peaks.get(axis)
+        if peaks is None:
+            peaks = self._peaks[axis] = find_resonance_peaks(
+                    self.numpy, self.freq_bins, self.get_psd(axis))
+        return peaks
+    def get_spectrogram(self, axis='all'):
+        return self._spectrogram_map[axis]
+    def __getstate__(self):
+        # numpy module cannot be pickled, it is re-imported when unpickling
+        state = self.__dict__.copy()
+        state['numpy'] = 'numpy' in state
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state['numpy']:
+            self.numpy = importlib.import_module('numpy')
+        else:
+            del self.numpy
 
 
 CalibrationResult = collections.namedtuple(
         'CalibrationResult',
         ('name', 'freq', 'vals', 'vibrs', 'smoothing', 'score', 'max_accel'))
 
+class ShaperFitTable:
+    # Columnar results of fitting a shaper at all tested frequencies, in the
+    # increasing order of frequencies. `vibrs` and `scores` have a column per
+    # fitted PSD, shaper `vals` are only computed for the requested results.
+    def __init__(self, name, freqs, vibrs, smoothing, scores, max_accels,
+                 responses, smoothing_limited):
+        self.name = name
+        self.freqs = freqs
+        self.vibrs = vibrs
+        self.smoothing = smoothing
+        self.scores = scores
+        self.max_accels = max_accels
+        self.smoothing_limited = smoothing_limited
+        self._responses = responses
+    def get_vals(self, index):
+        return self._responses[:, index, :].max(axis=0)
+    def get_result(self, index, target=0):
+        return CalibrationResult(
+                name=self.name, freq=self.freqs[index],
+                vals=self.get_vals(index), vibrs=self.vibrs[index, target],
+                smoothing=self.smoothing[index],
+                score=self.scores[index, target],
+                max_accel=self.max_accels[index])
+    def select_indices(self):
+        # Indices of the selected frequencies for all fitted PSDs at once
+        n_freqs, n_targets = self.vibrs.shape
+        targets = list(range(n_targets))
+        # The best frequency for the shaper, preferring higher frequencies
+        # if several of them reduce vibrations equally well
+        best = n_freqs - 1 - self.vibrs[::-1].argmin(axis=0)
+        if self.smoothing_limited:
+            return best
+        # Try to find an 'optimal' shapper configuration: the one that is not
+        # much worse than the 'best' one, but gives much less smoothing
+        candidate_scores = self.scores.copy()
+        candidate_scores[self.vibrs >= self.vibrs[best, targets] * 1.1] = \
+                float('inf')
+        optimal = candidate_scores.argmin(axis=0)
+        better = candidate_scores[optimal, targets] < self.scores[best, targets]
+        return optimal * better + best * ~better
+    def select(self, target=0):
+        return self.get_result(self.select_indices()[target], target)
+
+ShaperBootstrap = collections.namedtuple(
+        'ShaperBootstrap',
+        ('name', 'freqs', 'vibrs', 'smoothing', 'scores', 'max_accels'))
+
+ShaperSweep = collections.namedtuple(
+        'ShaperSweep',
+        ('damping_ratios', 'scvs', 'max_smoothings', 'names', 'selected',
+         'freqs', 'vibrs', 'smoothing', 'max_accels'))
+
+def get_smoothing_coeffs(np, shapers):
+    # Both offsets of ShaperCalibrate._get_shaper_smoothing are linear in
+    # scv and accel: offset_90 = c_scv * scv + c_90 * accel, offset_180 =
+    # c_180 * accel. Returns the coefficients for a series of shapers with
+    # the same number of impulses.
+    A = np.array([shaper[0] for shaper in shapers], dtype=np.float64)
+    T = np.array([shaper[1] for shaper in shapers], dtype=np.float64)
+    A /= A.sum(axis=-1, keepdims=True)
+    dT = T - (A * T).sum(axis=-1, keepdims=True)
+    A_after = np.where(dT >= 0., A, 0.)
+    c_scv = math.sqrt(2.) * (A_after * dT).sum(axis=-1)
+    c_90 = math.sqrt(2.) * .5 * (A_after * dT**2).sum(axis=-1)
+    c_180 = .5 * (A * dT**2).sum(axis=-1)
+    return c_scv, c_90, c_180
+
+def get_block_bootstrap_counts(np, rng, n_windows, n_replicates):
+    # Moving-block bootstrap: every replicate joins randomly chosen blocks
+    # of consecutive windows, at least n_windows of them in total. Returns
+    # how many times every window is used by every replicate (replicates x
+    # windows).
+    block = min(max(int(round(n_windows ** (1. / 3.))), MIN_BOOTSTRAP_BLOCK),
+                n_windows)
+    n_starts = n_windows - block + 1
+    n_blocks = -(-n_windows // block)
+    start_counts = rng.multinomial(n_blocks, [1. / n_starts] * n_starts,
+                                   size=n_replicates)
+    counts = np.zeros((n_replicates, n_windows), dtype=start_counts.dtype)
+    for offset in range(block):
+        counts[:, offset:offset+n_starts] += start_counts
+    return counts
+
+def _get_shaper_scores(smoothing, vibrations):
+    # The score trying to minimize vibrations, but also accounting
+    # the growth of smoothing. The formula itself does not have any
+    # special meaning, it simply shows good results on real user data
+    return smoothing * (vibrations**1.5 + vibrations * .2 + .01)
+
+def _is_better_shaper(score, smoothing, best_score, best_smoothing):
+    # Either the shaper significantly improves the score (by 20%), or
+    # it improves the score and smoothing (by 5% and 10% resp.). Works
+    # both for single results and element-wise for arrays of them.
+    return ((score * 1.2 < best_score) |
+            ((score * 1.05 < best_score) & (smoothing * 1.1 < best_smoothing)))
+
+CaptureReport = collections.namedtuple(
+        'CaptureReport',
+        ('n_samples', 'duration', 'sampling_freq', 'jitter', 'gaps',
+         'dropped_samples', 'non_monotonic', 'clipped', 'axis_std',
+         'problems', 'warnings'))
+
+def validate_accelerometer_data(np, data):
+    # Cheap checks of raw (time, accel_x, accel_y, accel_z) samples, meant
+    # to reject corrupted captures before computing the frequency response.
+    # Clipping is only reported in `warnings`, as it distorts the response
+    # but does not invalidate it.
+    if data.ndim != 2 or data.shape[1] != 4:
+        return CaptureReport(len(data), 0., 0., 0., 0, 0, 0, (), (), [
+            "expected (time, accel_x, accel_y, accel_z) samples"], [])
+    problems = []
+    n = data.shape[0]
+    if n < 2 or not np.isfinite(data).all():
+        if n < 2:
+            problems.append("too few samples (%d)" % (n,))
+        else:
+            problems.append("%d non-finite values" % (
+                n * 4 - np.isfinite(data).sum(),))
+        return CaptureReport(n, 0., 0., 0., 0, 0, 0, (), (), problems, [])
+    dt = np.diff(data[:, 0].astype(float))
+    duration = float(data[-1, 0]) - float(data[0, 0])
+    non_monotonic = int((dt <= 0.).sum())
+    median_dt = float(np.median(dt))
+    sampling_freq = 1. / median_dt if median_dt > 0. else 0.
+    if median_dt > 0.:
+        gaps = dt > MAX_GAP_RATIO * median_dt
+        regular = (dt > 0.) & ~gaps
+        jitter = float(dt[regular].std() / median_dt) if regular.any() else 0.
+        dropped = int(np.maximum(
+            np.round(dt[gaps] / median_dt) - 1., 0.).sum())
+        n_gaps = int(gaps.sum())
+    else:
+        jitter, dropped, n_gaps = 0., 0, 0
+    # Clipped samples are held at the minimum or the maximum of an axis in
+    # runs of at least MIN_CLIPPED_RUN samples. The runs of all 6 extremes
+    # are found at once in the flattened rows, padded to separate them.
+    # Reductions over contiguous per-axis rows are much faster.
+    accels = np.ascontiguousarray(data[:, 1:].T)
+    at_extremes = np.zeros((6, n + 2), dtype=np.int8)
+    at_extremes[:3, 1:-1] = accels == accels.min(axis=1, keepdims=True)
+    at_extremes[3:, 1:-1] = accels == accels.max(axis=1, keepdims=True)
+    edges = np.diff(at_extremes.ravel())
+    starts, ends = (edges > 0).nonzero()[0], (edges < 0).nonzero()[0]
+    runs = ends - starts
+    clipped = np.bincount(starts // (n + 2) % 3,
+                          weights=np.where(runs >= MIN_CLIPPED_RUN, runs, 0),
+                          minlength=3)
+    clipped = tuple(int(c) for c in clipped)
+    axis_std = tuple(float(std) for std in accels.std(axis=1))
+
+    if non_monotonic:
+        problems.append("%d non-monotonic timestamps" % (non_monotonic,))
+    if sampling_freq <= 0.:
+        problems.append("invalid sampling rate")
+    else:
+        if jitter > MAX_TIMESTAMP_JITTER:
+            problems.append("timestamp jitter of %.0f%% of the sampling "
+                            "interval" % (jitter * 100.,))
+        if dropped > MAX_DROPPED_SAMPLES_RATIO * n:
+            problems.append("%d samples dropped (gaps: %d)" % (dropped,
+                                                                n_gaps))
+        # The frequency response needs more samples than a single window
+        window = 1 << int(sampling_freq * WINDOW_T_SEC - 1).bit_length()
+        if n <= window:
+            problems.append("capture too short (%.2f sec)" % (duration,))
+    warnings = []
+    for axis, count, std in zip('xyz', clipped, axis_std):
+        if std < MIN_AXIS_STD:
+            problems.append("axis %s is dead (std %.3g mm/sec^2)" % (
+                axis, std))
+        elif count > MAX_CLIPPED_SAMPLES_RATIO * n:
+            warnings.append("axis %s clipped in %d samples" % (axis, count))
+    return CaptureReport(
+            n_samples=n, duration=duration, sampling_freq=sampling_freq,
+            jitter=jitter, gaps=n_gaps, dropped_samples=dropped,
+            non_monotonic=non_monotonic, clipped=clipped, axis_std=axis_std,
+            problems=problems, warnings=warnings)
+
+TestSegment = collections.namedtuple(
+        'TestSegment', ('start', 'end', 'start_time', 'end_time', 'axis'))
+
+ResonanceTest = collections.namedtuple(
+        'ResonanceTest', ('axis', 'segments', 'calibration_data'))
+
+def find_test_segments(np, data):
+    # Splits raw (time, accel_x, accel_y, accel_z) samples into resonance
+    # tests separated by idle periods. Returns TestSegment-s with the
+    # [start, end) sample ranges, their times and the axis of the most
+    # energy. The noise floor is estimated from the quietest frames, which
+    # are only idle if there are idle gaps between the tests. Otherwise
+    # they may be e.g. the low-amplitude start of a single sweep (the test
+    # acceleration grows with frequency), so the whole recording is taken
+    # as a single test.
+    n = data.shape[0]
+    sampling_freq = (n - 1) / (float(data[-1, 0]) - float(data[0, 0]))
+    frame = max(int(sampling_freq * SEGMENT_FRAME_T_SEC), 2)
+    n_frames = n // frame
+    if not n_frames:
+        return []
+    # Energy of every axis per frame (axes x frames), the remaining samples
+    # belong to the last frame
+    accels = np.ascontiguousarray(data[:n_frames * frame, 1:].T)
+    axis_energy = accels.reshape(3, n_frames, frame).var(axis=-1)
+    energy = axis_energy.sum(axis=0)
+    active = energy > SEGMENT_ENERGY_RATIO * np.percentile(
+            energy, SEGMENT_NOISE_PERCENTILE)
+    edges = np.diff(active.astype(np.int8), prepend=0, append=0)
+    starts, ends = (edges > 0).nonzero()[0], (edges < 0).nonzero()[0]
+    if not len(starts):
+        return []
+    # Join the tests separated by too short idle gaps
+    min_gap = MIN_IDLE_GAP_T_SEC * sampling_freq
+    joined = (starts[1:] - ends[:-1]) * frame < min_gap
+    starts = starts[np.concatenate([[True], ~joined])]
+    ends = ends[np.concatenate([~joined, [True]])]
+    if len(starts) == 1:
+        starts, ends = np.array([0]), np.array([n_frames])
+    long_enough = (ends - starts) * frame >= MIN_SEGMENT_T_SEC * sampling_freq
+    starts, ends = starts[long_enough], ends[long_enough]
+    cumulative = np.concatenate([np.zeros((3, 1)), axis_energy.cumsum(axis=1)],
+                                axis=1)
+    axes = (cumulative[:, ends] - cumulative[:, starts]).argmax(axis=0)
+    starts = starts * frame
+    ends = np.where(ends == n_frames, n, ends * frame)
+    return [TestSegment(int(start), int(end), float(data[start, 0]),
+                        float(data[end - 1, 0]), 'xyz'[axis])
+            for start, end, axis in zip(starts, ends, axes)]
+
+def merge_repeated_tests(tests):
+    # Joins the ResonanceTest-s of the same axis into the first of them
+    merged = {}
+    for test in tests:
+        if test.axis in merged:
+            merged[test.axis].calibration_data.add_data(test.calibration_data)
+            merged[test.axis].segments.extend(test.segments)
+        else:
+            merged[test.axis] = ResonanceTest(
+                    test.axis, list(test.segments), test.calibration_data)
+    return list(merged.values())
+
 class ShaperCalibrate:
-    def __init__(self, printer):
+    def __init__(self, printer, bank_dir=None, dtype=None,
+                 prune_test_freqs=True):
         self.printer = printer
         self.error = printer.command_error if printer else Exception
         try:
@@ -70,6 +495,14 @@ class ShaperCalibrate:
                     "Failed to import `numpy` module, make sure it was "
                     "installed via `~/klippy-env/bin/pip install` (refer to "
                     "docs/Measuring_Resonances.md for more details).")
+        # Floating point type of the whole analysis, float32 halves the
+        # memory and bandwidth requirements at a slight loss of accuracy
+        self.dtype = self.numpy.dtype(dtype or self.numpy.float64)
+        self.response_bank = shaper_bank.ShaperResponseBank(
+                self.numpy, bank_dir)
+        # Shapers are only fitted at the test frequencies around the
+        # resonance peaks (see get_test_freq_range)
+        self.prune_test_freqs = prune_test_freqs
 
     def background_process_exec(self, method, args):
         if self.printer is None:
@@ -117,37 +550,102 @@ class ShaperCalibrate:
         return self.numpy.lib.stride_tricks.as_strided(
                 x, shape=shape, strides=strides, writeable=False)
 
-    def _psd(self, x, fs, nfft):
-        # Calculate power spectral density (PSD) using Welch's algorithm
+    def _window_ffts(self, x, nfft, window_stride=1):
+        # FFTs (freqs x windows) of the overlapping windows used by Welch's
+        # algorithm, and the compensation for windowing loss. Only every
+        # `window_stride`-th window is used.
         np = self.numpy
-        window = np.kaiser(nfft, 6.)
-        # Compensation for windowing loss
+        window = np.kaiser(nfft, 6.).astype(x.dtype)
         scale = 1.0 / (window**2).sum()
 
         # Split into overlapping windows of size nfft
         overlap = nfft // 2
-        x = self._split_into_windows(x, nfft, overlap)
+        x = self._split_into_windows(x, nfft, overlap)[:, ::window_stride]
 
         # First detrend, then apply windowing function
         x = window[:, None] * (x - np.mean(x, axis=0))
 
         # Calculate frequency response for each window using FFT
-        result = np.fft.rfft(x, n=nfft, axis=0)
-        result = np.conjugate(result) * result
+        return np.fft.rfft(x, n=nfft, axis=0), scale
+
+    def _window_spectra(self, fft_a, fft_b, fs, scale):
+        # (Cross) power spectral densities of every window
+        result = self.numpy.conjugate(fft_a) * fft_b
         result *= scale / fs
         # For one-sided FFT output the response must be doubled, except
         # the last point for unpaired Nyquist frequency (assuming even nfft)
         # and the 'DC' term (0 Hz)
         result[1:-1,:] *= 2.
+        return result
+
+    def _psd(self, x, fs, nfft, keep_windows=False, keep_ffts=False,
+             window_stride=1):
+        # Calculate power spectral density (PSD) using Welch's algorithm.
+        # With `keep_windows`, the PSD of every window (windows x freqs) is
+        # returned as well, and with `keep_ffts` - the window FFTs and their
+        # scale, to compute cross-spectra with other signals.
+        np = self.numpy
+        ffts, scale = self._window_ffts(x, nfft, window_stride)
+        result = self._window_spectra(ffts, ffts, fs, scale)
 
         # Welch's algorithm: average response over windows
         psd = result.real.mean(axis=-1)
 
         # Calculate the frequency bins
-        freqs = np.fft.rfftfreq(nfft, 1. / fs)
-        return freqs, psd
+        freqs = np.fft.rfftfreq(nfft, 1. / fs).astype(x.dtype)
+        res = (freqs, psd)
+        if keep_windows:
+            res += (np.ascontiguousarray(result.real.T),)
+        if keep_ffts:
+            res += ((ffts, scale),)
+        return res
+
+    def _get_decimation_factor(self, fs, nfft, max_freq):
+        # Only power of 2 factors dividing nfft are used, so the decimated
+        # signal has exactly the same frequency bins below max_freq
+        q = 1
+        while (fs / (2 * q) >= DECIMATION_MIN_RATE_RATIO * max_freq
+               and nfft % (2 * q) == 0):
+            q *= 2
+        return q
+
+    def _design_lowpass(self, fs, q, max_freq):
+        # Kaiser-windowed sinc low-pass FIR filter for decimation by `q`.
+        # Its transition band ends at fs/q - max_freq, so that no aliases
+        # land below max_freq after decimation.
+        np = self.numpy
+        fs_out = fs / q
+        transition = (fs_out - 2. * max_freq) / fs
+        A = DECIMATION_ATTENUATION_DB
+        beta = 0.1102 * (A - 8.7)
+        ntaps = int(math.ceil((A - 8.) / (2.285 * 2. * math.pi * transition)))
+        ntaps |= 1
+        cutoff = .5 * fs_out / fs
+        n = np.arange(ntaps) - (ntaps - 1) // 2
+        taps = 2. * cutoff * np.sinc(2. * cutoff * n) * np.kaiser(ntaps, beta)
+        return (taps / taps.sum()).astype(self.dtype)
+
+    def _decimate(self, x, taps, q):
+        # Filter the signal with zero phase delay and keep every q-th sample;
+        # only the retained samples are computed
+        np = self.numpy
+        pad = (len(taps) - 1) // 2
+        x = np.pad(x, pad, mode='reflect')
+        n_out = (x.shape[-1] - len(taps)) // q + 1
+        windows = np.lib.stride_tricks.as_strided(
+                x, shape=(n_out, len(taps)),
+                strides=(q * x.strides[-1], x.strides[-1]), writeable=False)
+        return windows.dot(taps)
 
-    def calc_freq_response(self, raw_values):
+    def calc_freq_response(self, raw_values, max_freq=None,
+                           spectrogram=False, cross_spectra=False,
+                           preview=False):
+        # If max_freq is specified, the frequency response is only computed
+        # for frequencies up to max_freq, the signal is decimated (when the
+        # sampling rate allows) to compute fewer and smaller FFTs. With
+        # `spectrogram`, the per-window spectra are kept as well, and with
+        # `cross_spectra` - the cross-spectral densities between the axes.
+        # A `preview` is a coarse estimate from a subset of shorter windows.
         np = self.numpy
         if raw_values is None:
             return None
@@ -157,32 +655,97 @@ class ShaperCalibrate:
             samples = raw_values.get_samples()
             if not samples:
                 return None
-            data = np.array(samples)
+            data = np.array(samples, dtype=np.float64)
 
         N = data.shape[0]
-        T = data[-1,0] - data[0,0]
+        T = float(data[-1,0]) - float(data[0,0])
         SAMPLING_FREQ = N / T
         # Round up to the nearest power of 2 for faster FFT
-        M = 1 << int(SAMPLING_FREQ * WINDOW_T_SEC - 1).bit_length()
+        window_t_sec, window_stride = WINDOW_T_SEC, 1
+        if preview:
+            window_t_sec = PREVIEW_WINDOW_T_SEC
+            window_stride = PREVIEW_WINDOW_STRIDE
+        M = 1 << int(SAMPLING_FREQ * window_t_sec - 1).bit_length()
         if N <= M:
             return None
+        # Timestamps are only used above, in their own precision
+        axes_data = [data[:,i].astype(self.dtype, copy=False)
+                     for i in (1, 2, 3)]
+
+        q = 1
+        if max_freq:
+            q = self._get_decimation_factor(SAMPLING_FREQ, M, max_freq)
+        if q > 1:
+            taps = self._design_lowpass(SAMPLING_FREQ, q, max_freq)
+            axes_data = [self._decimate(x, taps, q) for x in axes_data]
+            SAMPLING_FREQ /= q
+            M //= q
 
         # Calculate PSD (power spectral density) of vibrations per
         # frequency bins (the same bins for X, Y, and Z)
-        fx, px = self._psd(data[:,1], SAMPLING_FREQ, M)
-        fy, py = self._psd(data[:,2], SAMPLING_FREQ, M)
-        fz, pz = self._psd(data[:,3], SAMPLING_FREQ, M)
-        return CalibrationData(fx, px+py+pz, px, py, pz)
+        fx, px, *sx = self._psd(axes_data[0], SAMPLING_FREQ, M, spectrogram,
+                                cross_spectra, window_stride)
+        fy, py, *sy = self._psd(axes_data[1], SAMPLING_FREQ, M, spectrogram,
+                                cross_spectra, window_stride)
+        fz, pz, *sz = self._psd(axes_data[2], SAMPLING_FREQ, M, spectrogram,
+                                cross_spectra, window_stride)
+        band = slice(None)
+        if max_freq:
+            band = fx <= max_freq
+            fx, px, py, pz = fx[band], px[band], py[band], pz[band]
+        calibration_data = CalibrationData(fx, px+py+pz, px, py, pz)
+        if cross_spectra:
+            # The window FFTs of the auto-spectra are reused, so only their
+            # products need to be computed
+            ffts = {'x': sx.pop(), 'y': sy.pop(), 'z': sz.pop()}
+            csds = []
+            for pair in CROSS_SPECTRA_PAIRS:
+                (fft_a, scale), (fft_b, _) = ffts[pair[0]], ffts[pair[1]]
+                csd = self._window_spectra(fft_a, fft_b, SAMPLING_FREQ, scale)
+                csds.append(csd.mean(axis=-1)[band])
+            calibration_data.set_cross_spectra(*csds)
+        if spectrogram:
+            # Windows are shifted by half of their size
+            n_windows = sx[0].shape[0]
+            times = (np.arange(n_windows) * (M // 2 * window_stride)
+                     + M * .5) / SAMPLING_FREQ
+            calibration_data.set_spectrogram(
+                    times, sx[0][:, band], sy[0][:, band], sz[0][:, band])
+        return calibration_data
 
-    def process_accelerometer_data(self, data):
+    def process_accelerometer_data(self, data, max_freq=None,
+                                   spectrogram=False, cross_spectra=False,
+                                   preview=False):
         calibration_data = self.background_process_exec(
-                self.calc_freq_response, (data,))
+                self.calc_freq_response,
+                (data, max_freq, spectrogram, cross_spectra, preview))
         if calibration_data is None:
             raise self.error(
                     "Internal error processing accelerometer data %s" % (data,))
         calibration_data.set_numpy(self.numpy)
         return calibration_data
 
+    def process_test_segments(self, data, segments, max_freq=None,
+                              spectrogram=False, cross_spectra=False,
+                              workers=None):
+        # Computes the frequency response of every test segment of `data`
+        # in parallel (numpy releases the GIL in FFTs and array operations),
+        # returns a ResonanceTest per segment
+        if self.printer is not None:
+            # Klippy runs every calculation in a separate process already
+            workers = 1
+        elif not workers:
+            workers = max(min(len(segments), MAX_SEGMENT_WORKERS,
+                              multiprocessing.cpu_count()), 1)
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            calibration_datas = list(executor.map(
+                lambda segment: self.process_accelerometer_data(
+                    data[segment.start:segment.end], max_freq, spectrogram,
+                    cross_spectra), segments))
+        return [ResonanceTest(segment.axis, [segment], calibration_data)
+                for segment, calibration_data in zip(segments,
+                                                     calibration_datas)]
+
     def _estimate_shaper(self, shaper, test_damping_ratio, test_freqs):
         np = self.numpy
 
@@ -202,14 +765,42 @@ class ShaperCalibrate:
         vals = self._estimate_shaper(shaper, test_damping_ratio, freq_bins)
         # The input shaper can only reduce the amplitude of vibrations by
         # SHAPER_VIBRATION_REDUCTION times, so all vibrations below that
-        # threshold can be igonred
-        vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+        # threshold can be igonred. `psd` may also be a matrix of stacked
+        # PSDs (one per row), then the vibrations are estimated per row.
+        vibr_threshold = (psd.max(axis=-1, keepdims=True) /
+                          shaper_defs.SHAPER_VIBRATION_REDUCTION)
         remaining_vibrations = self.numpy.maximum(
-                vals * psd - vibr_threshold, 0).sum()
-        all_vibrations = self.numpy.maximum(psd - vibr_threshold, 0).sum()
+                vals * psd - vibr_threshold, 0).sum(axis=-1)
+        all_vibrations = self.numpy.maximum(
+                psd - vibr_threshold, 0).sum(axis=-1)
         return (remaining_vibrations / all_vibrations, vals)
 
-    def _get_shaper_smoothing(self, shaper, accel=5000, scv=5.):
+    def _estimate_remaining_vibrations_table(self, responses, psds):
+        # Same as _estimate_remaining_vibrations, but for a whole table of
+        # shaper responses (test damping ratios x test frequencies x
+        # freq_bins) and a matrix of PSDs, pessimized over damping ratios
+        np = self.numpy
+        vibr_threshold = (psds.max(axis=-1, keepdims=True) /
+                          shaper_defs.SHAPER_VIBRATION_REDUCTION)
+        # Shaper responses never exceed 1, so the frequency ranges where all
+        # PSDs stay below the threshold (away from the resonance peaks) do
+        # not contribute to the vibrations and are skipped
+        active = (psds > vibr_threshold).any(axis=0).nonzero()[0]
+        psds = psds[:, active]
+        all_vibrations = np.maximum(psds - vibr_threshold, 0).sum(axis=-1)
+        n_freqs = responses.shape[1]
+        vibrations = np.zeros(shape=(n_freqs, psds.shape[0]),
+                              dtype=psds.dtype)
+        step = max(MAX_CHUNK_SIZE // (responses.shape[0] * psds.size), 1)
+        for i in range(0, n_freqs, step):
+            remaining_vibrations = np.maximum(
+                    responses[:, i:i+step, None, active] * psds
+                    - vibr_threshold, 0).sum(axis=-1)
+            vibrations[i:i+step] = (
+                    remaining_vibrations / all_vibrations).max(axis=0)
+        return vibrations
+
+    def _get_shaper_smoothing(self, shaper, accel=SMOOTHING_ACCEL, scv=5.):
         half_accel = accel * .5
 
         A, T = shaper
@@ -229,14 +820,65 @@ class ShaperCalibrate:
         offset_180 *= inv_D
         return max(offset_90, offset_180)
 
+    def _get_smoothing_coeffs(self, shapers):
+        return get_smoothing_coeffs(self.numpy, shapers)
+
+    def _find_max_accels(self, c_scv, c_90, c_180, scv):
+        # Closed-form find_shaper_max_accel from the smoothing coefficients
+        np = self.numpy
+        with np.errstate(divide='ignore'):
+            max_accels = np.minimum((TARGET_SMOOTHING - c_scv * scv) / c_90,
+                                    TARGET_SMOOTHING / c_180)
+        return np.maximum(max_accels, 0.)
+
     def fit_shaper(self, shaper_cfg, calibration_data, shaper_freqs,
                    damping_ratio, scv, max_smoothing, test_damping_ratios,
                    max_freq):
-        np = self.numpy
+        return self.fit_shaper_multi(
+                shaper_cfg, calibration_data, ['all'], shaper_freqs,
+                damping_ratio, scv, max_smoothing, test_damping_ratios,
+                max_freq)[0]
 
-        damping_ratio = damping_ratio or shaper_defs.DEFAULT_DAMPING_RATIO
-        test_damping_ratios = test_damping_ratios or TEST_DAMPING_RATIOS
+    def fit_shaper_multi(self, shaper_cfg, calibration_data, axes,
+                         shaper_freqs, damping_ratio, scv, max_smoothing,
+                         test_damping_ratios, max_freq):
+        table = self.fit_shaper_table(
+                shaper_cfg, calibration_data, axes, shaper_freqs,
+                damping_ratio, scv, max_smoothing, test_damping_ratios,
+                max_freq)
+        return [table.select(target) for target in range(len(axes))]
+
+    def fit_shaper_table(self, shaper_cfg, calibration_data, axes,
+                         shaper_freqs, damping_ratio, scv, max_smoothing,
+                         test_damping_ratios, max_freq):
+        # Stack the PSDs of all requested axes into a single matrix, so that
+        # the shaper response is computed once and applied to all of them
+        psds = self.numpy.array([calibration_data.get_psd(axis)
+                                 for axis in axes], dtype=self.dtype)
+        test_freq_range = None
+        if self.prune_test_freqs and (not shaper_freqs
+                                      or isinstance(shaper_freqs, tuple)):
+            test_freq_range = self.get_test_freq_range(calibration_data, axes)
+        return self.fit_shaper_psds(
+                shaper_cfg, calibration_data.freq_bins, psds, shaper_freqs,
+                damping_ratio, scv, max_smoothing, test_damping_ratios,
+                max_freq, test_freq_range)
+
+    def get_test_freq_range(self, calibration_data, axes):
+        # The range of test frequencies around the resonance peak bands of
+        # all axes, or None if some axis has no peaks to prune around
+        all_peaks = [calibration_data.get_peaks(axis) for axis in axes]
+        if not all(len(peaks.freqs) for peaks in all_peaks):
+            return None
+        freq_start = min((peaks.freqs - peaks.bandwidths).min()
+                         for peaks in all_peaks)
+        freq_end = max((peaks.freqs + peaks.bandwidths).max()
+                       for peaks in all_peaks)
+        return (freq_start / PEAK_TEST_FREQ_RATIO,
+                freq_end * PEAK_TEST_FREQ_RATIO)
 
+    def _get_test_freqs(self, shaper_cfg, shaper_freqs):
+        np = self.numpy
         if not shaper_freqs:
             shaper_freqs = (None, None, None)
         if isinstance(shaper_freqs, tuple):
@@ -247,51 +889,87 @@ class ShaperCalibrate:
             test_freqs = np.arange(freq_start, freq_end, freq_step)
         else:
             test_freqs = np.array(shaper_freqs)
+        return test_freqs
+
+    def _prune_test_freqs(self, shaper_cfg, test_freqs, test_freq_range,
+                          damping_ratio, scv, max_smoothing):
+        # Indices of the test frequencies within `test_freq_range`
+        np = self.numpy
+        freq_start, freq_end = test_freq_range
+        if max_smoothing:
+            shaper = shaper_cfg.init_func(min(freq_end, test_freqs.max()),
+                                          damping_ratio)
+            if self._get_shaper_smoothing(shaper, scv=scv) > max_smoothing:
+                # Higher frequencies are needed to stay within max_smoothing
+                freq_end = test_freqs.max()
+        rows = ((test_freqs >= freq_start)
+                & (test_freqs <= freq_end)).nonzero()[0]
+        return rows if len(rows) else np.arange(len(test_freqs))
 
+    def _fit_vibrations(self, shaper_cfg, freq_bins, psds, test_freqs,
+                        damping_ratio, test_damping_ratios, max_freq,
+                        rows=None):
+        # Shaper responses and the remaining vibrations of every row of
+        # `psds` (PSDs x freq_bins) at all test frequencies, or only at the
+        # `rows` of them. The bank tables always cover all test frequencies,
+        # so that they are shared by all captures.
         max_freq = max(max_freq or MAX_FREQ, test_freqs.max())
 
-        freq_bins = calibration_data.freq_bins
-        psd = calibration_data.psd_sum[freq_bins <= max_freq]
+        psds = psds[:, freq_bins <= max_freq]
         freq_bins = freq_bins[freq_bins <= max_freq]
 
-        best_res = None
-        results = []
-        for test_freq in test_freqs[::-1]:
-            shaper_vibrations = 0.
-            shaper_vals = np.zeros(shape=freq_bins.shape)
-            shaper = shaper_cfg.init_func(test_freq, damping_ratio)
-            shaper_smoothing = self._get_shaper_smoothing(shaper, scv=scv)
-            if max_smoothing and shaper_smoothing > max_smoothing and best_res:
-                return best_res
-            # Exact damping ratio of the printer is unknown, pessimizing
-            # remaining vibrations over possible damping values
-            for dr in test_damping_ratios:
-                vibrations, vals = self._estimate_remaining_vibrations(
-                        shaper, dr, freq_bins, psd)
-                shaper_vals = np.maximum(shaper_vals, vals)
-                if vibrations > shaper_vibrations:
-                    shaper_vibrations = vibrations
-            max_accel = self.find_shaper_max_accel(shaper, scv)
-            # The score trying to minimize vibrations, but also accounting
-            # the growth of smoothing. The formula itself does not have any
-            # special meaning, it simply shows good results on real user data
-            shaper_score = shaper_smoothing * (shaper_vibrations**1.5 +
-                                               shaper_vibrations * .2 + .01)
-            results.append(
-                    CalibrationResult(
-                        name=shaper_cfg.name, freq=test_freq, vals=shaper_vals,
-                        vibrs=shaper_vibrations, smoothing=shaper_smoothing,
-                        score=shaper_score, max_accel=max_accel))
-            if best_res is None or best_res.vibrs > results[-1].vibrs:
-                # The current frequency is better for the shaper.
-                best_res = results[-1]
-        # Try to find an 'optimal' shapper configuration: the one that is not
-        # much worse than the 'best' one, but gives much less smoothing
-        selected = best_res
-        for res in results[::-1]:
-            if res.vibrs < best_res.vibrs * 1.1 and res.score < selected.score:
-                selected = res
-        return selected
+        # Exact damping ratio of the printer is unknown, pessimizing
+        # remaining vibrations over possible damping values
+        responses = self.response_bank.get_responses(
+                shaper_cfg, damping_ratio, test_freqs, test_damping_ratios,
+                freq_bins, self.dtype, rows)
+        vibrations = self._estimate_remaining_vibrations_table(
+                responses, psds)
+        return responses, vibrations
+
+    def fit_shaper_psds(self, shaper_cfg, freq_bins, psds, shaper_freqs,
+                        damping_ratio, scv, max_smoothing,
+                        test_damping_ratios, max_freq, test_freq_range=None):
+        # Fits the shaper to every row of `psds` (PSDs x freq_bins). The test
+        # frequencies are pruned to `test_freq_range` (see
+        # get_test_freq_range), if it is given.
+        np = self.numpy
+
+        damping_ratio = damping_ratio or shaper_defs.DEFAULT_DAMPING_RATIO
+        test_damping_ratios = test_damping_ratios or TEST_DAMPING_RATIOS
+        test_freqs = self._get_test_freqs(shaper_cfg, shaper_freqs)
+        rows = None
+        if test_freq_range is not None:
+            rows = self._prune_test_freqs(
+                    shaper_cfg, test_freqs, test_freq_range, damping_ratio,
+                    scv, max_smoothing)
+        responses, vibrations = self._fit_vibrations(
+                shaper_cfg, freq_bins, psds, test_freqs, damping_ratio,
+                test_damping_ratios, max_freq, rows)
+        if rows is not None:
+            test_freqs = test_freqs[rows]
+
+        n_freqs = len(test_freqs)
+        smoothing = np.zeros(shape=n_freqs)
+        max_accels = np.zeros(shape=n_freqs)
+        first_freq, smoothing_limited = 0, False
+        for i in range(n_freqs - 1, -1, -1):
+            shaper = shaper_cfg.init_func(test_freqs[i], damping_ratio)
+            smoothing[i] = self._get_shaper_smoothing(shaper, scv=scv)
+            if (max_smoothing and smoothing[i] > max_smoothing
+                    and i < n_freqs - 1):
+                first_freq, smoothing_limited = i + 1, True
+                break
+            max_accels[i] = self.find_shaper_max_accel(shaper, scv)
+        vibrations = vibrations[first_freq:]
+        smoothing = smoothing[first_freq:]
+        scores = _get_shaper_scores(smoothing[:, None], vibrations)
+        return ShaperFitTable(
+                name=shaper_cfg.name, freqs=test_freqs[first_freq:],
+                vibrs=vibrations, smoothing=smoothing, scores=scores,
+                max_accels=max_accels[first_freq:],
+                responses=responses[:, first_freq:],
+                smoothing_limited=smoothing_limited)
 
     def _bisect(self, func):
         left = right = 1.
@@ -312,9 +990,6 @@ class ShaperCalibrate:
         return left
 
     def find_shaper_max_accel(self, shaper, scv):
-        # Just some empirically chosen value which produces good projections
-        # for max_accel without much smoothing
-        TARGET_SMOOTHING = 0.12
         max_accel = self._bisect(lambda test_accel: self._get_shaper_smoothing(
             shaper, test_accel, scv) <= TARGET_SMOOTHING)
         return max_accel
@@ -322,32 +997,212 @@ class ShaperCalibrate:
     def find_best_shaper(self, calibration_data, shapers=None,
                          damping_ratio=None, scv=None, shaper_freqs=None,
                          max_smoothing=None, test_damping_ratios=None,
-                         max_freq=None, logger=None):
-        best_shaper = None
-        all_shapers = []
+                         max_freq=None, logger=None, fit_tables=None,
+                         custom_shapers=None):
+        return self.find_best_shaper_multi(
+                calibration_data, ['all'], shapers=shapers,
+                damping_ratio=damping_ratio, scv=scv,
+                shaper_freqs=shaper_freqs, max_smoothing=max_smoothing,
+                test_damping_ratios=test_damping_ratios, max_freq=max_freq,
+                logger=logger, fit_tables=fit_tables,
+                custom_shapers=custom_shapers)['all']
+
+    def find_best_shaper_multi(self, calibration_data, axes, shapers=None,
+                               damping_ratio=None, scv=None, shaper_freqs=None,
+                               max_smoothing=None, test_damping_ratios=None,
+                               max_freq=None, logger=None, fit_tables=None,
+                               custom_shapers=None):
+        # If `fit_tables` list is provided, the per-frequency results of all
+        # fitted shapers are appended to it (e.g. to plot them). Any
+        # `custom_shapers` (InputShaperCfg-s) are always fitted as well, but
+        # never recommended, as Klipper cannot be configured with them.
+        best_shapers = {axis: None for axis in axes}
+        all_shapers = {axis: [] for axis in axes}
+        shapers = shapers or AUTOTUNE_SHAPERS
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in shapers]
+        custom_shapers = list(custom_shapers or [])
+        for i, shaper_cfg in enumerate(shaper_cfgs + custom_shapers):
+            # All axes are fitted in a single pass over test frequencies
+            table = self.background_process_exec(
+                    self.fit_shaper_table, (
+                        shaper_cfg, calibration_data, axes, shaper_freqs,
+                        damping_ratio, scv, max_smoothing,
+                        test_damping_ratios, max_freq))
+            if fit_tables is not None:
+                fit_tables.append(table)
+            for target, axis in enumerate(axes):
+                shaper = table.select(target)
+                if logger is not None:
+                    prefix = "Axis %s: " % (axis,) if len(axes) > 1 else ""
+                    logger(prefix + "Fitted shaper '%s' frequency = %.1f Hz "
+                           "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
+                               shaper.name, shaper.freq, shaper.vibrs * 100.,
+                               shaper.smoothing))
+                    logger(prefix + "To avoid too much smoothing with '%s', "
+                           "suggested max_accel <= %.0f mm/sec^2" % (
+                               shaper.name,
+                               round(shaper.max_accel / 100.) * 100.))
+                all_shapers[axis].append(shaper)
+                if i >= len(shaper_cfgs):
+                    continue
+                best_shaper = best_shapers[axis]
+                if best_shaper is None or _is_better_shaper(
+                        shaper.score, shaper.smoothing,
+                        best_shaper.score, best_shaper.smoothing):
+                    best_shapers[axis] = shaper
+        return {axis: (best_shapers[axis], all_shapers[axis]) for axis in axes}
+
+    def bootstrap_best_shaper(self, calibration_data, n_replicates,
+                              axis='all', shapers=None, damping_ratio=None,
+                              scv=None, shaper_freqs=None, max_smoothing=None,
+                              test_damping_ratios=None, max_freq=None,
+                              seed=None):
+        # Refits the shapers to bootstrap replicates of the PSD, obtained by
+        # resampling blocks of the per-window spectra of the Welch's method
+        # with replacement (see get_block_bootstrap_counts). Returns the
+        # index of the recommended shaper for every replicate and the
+        # per-replicate results of every fitted shaper.
+        np = self.numpy
+        if not calibration_data.has_spectrogram():
+            raise self.error("Bootstrapping requires per-window spectra")
+        spectra = calibration_data.get_spectrogram(axis)
+        n_windows = spectra.shape[0]
+        rng = np.random.default_rng(seed)
+        # Every replicate is an average of the resampled windows, so all of
+        # them are computed as a single product of the resampling counts
+        # and the window spectra
+        counts = get_block_bootstrap_counts(np, rng, n_windows, n_replicates)
+        psds = (counts.astype(self.dtype) @ spectra.astype(
+            self.dtype, copy=False)) / counts.sum(
+                axis=1, keepdims=True).astype(self.dtype)
+        replicates = list(range(n_replicates))
+        bootstraps = []
+        best = best_score = best_smoothing = None
         shapers = shapers or AUTOTUNE_SHAPERS
         for shaper_cfg in shaper_defs.INPUT_SHAPERS:
             if shaper_cfg.name not in shapers:
                 continue
-            shaper = self.background_process_exec(self.fit_shaper, (
-                shaper_cfg, calibration_data, shaper_freqs, damping_ratio,
-                scv, max_smoothing, test_damping_ratios, max_freq))
-            if logger is not None:
-                logger("Fitted shaper '%s' frequency = %.1f Hz "
-                       "(vibrations = %.1f%%, smoothing ~= %.3f)" % (
-                           shaper.name, shaper.freq, shaper.vibrs * 100.,
-                           shaper.smoothing))
-                logger("To avoid too much smoothing with '%s', suggested "
-                       "max_accel <= %.0f mm/sec^2" % (
-                           shaper.name, round(shaper.max_accel / 100.) * 100.))
-            all_shapers.append(shaper)
-            if (best_shaper is None or shaper.score * 1.2 < best_shaper.score or
-                    (shaper.score * 1.05 < best_shaper.score and
-                        shaper.smoothing * 1.1 < best_shaper.smoothing)):
-                # Either the shaper significantly improves the score (by 20%),
-                # or it improves the score and smoothing (by 5% and 10% resp.)
-                best_shaper = shaper
-        return best_shaper, all_shapers
+            # All replicates are fitted in a single pass over test frequencies
+            table = self.background_process_exec(
+                    self.fit_shaper_psds, (
+                        shaper_cfg, calibration_data.freq_bins, psds,
+                        shaper_freqs, damping_ratio, scv, max_smoothing,
+                        test_damping_ratios, max_freq))
+            selected = table.select_indices()
+            bootstrap = ShaperBootstrap(
+                    name=shaper_cfg.name, freqs=table.freqs[selected],
+                    vibrs=table.vibrs[selected, replicates],
+                    smoothing=table.smoothing[selected],
+                    scores=table.scores[selected, replicates],
+                    max_accels=table.max_accels[selected])
+            if best is None:
+                best = np.zeros(n_replicates, dtype=int)
+                best_score = bootstrap.scores
+                best_smoothing = bootstrap.smoothing
+            else:
+                better = _is_better_shaper(bootstrap.scores,
+                                           bootstrap.smoothing,
+                                           best_score, best_smoothing)
+                best[better] = len(bootstraps)
+                best_score = np.where(better, bootstrap.scores, best_score)
+                best_smoothing = np.where(better, bootstrap.smoothing,
+                                          best_smoothing)
+            bootstraps.append(bootstrap)
+        return best, bootstraps
+
+    def _select_sweep_indices(self, vibrs, smoothing, max_smoothings):
+        # ShaperFitTable.select_indices for a grid of fits (scvs x
+        # max_smoothings) of the same `vibrs`, with `smoothing` given per
+        # scv (scvs x test frequencies)
+        np = self.numpy
+        n_freqs = len(vibrs)
+        # As in fit_shaper_psds, only the frequencies above the highest one
+        # (but the last) with too much smoothing are tested
+        exceeds = smoothing[:, None, :-1] > max_smoothings[:, None]
+        first_freq = (exceeds * np.arange(1, n_freqs)).max(axis=-1, initial=0)
+        limited = first_freq > 0
+        tested = np.arange(n_freqs) >= first_freq[..., None]
+        best = n_freqs - 1 - np.where(tested, vibrs, np.inf)[..., ::-1].argmin(
+                axis=-1)
+        scores = np.broadcast_to(_get_shaper_scores(smoothing[:, None], vibrs),
+                                 tested.shape)
+        candidate_scores = np.where(
+                tested & (vibrs < vibrs[best][..., None] * 1.1), scores,
+                np.inf)
+        optimal = candidate_scores.argmin(axis=-1)
+        better = ~limited & (
+                np.take_along_axis(candidate_scores, optimal[..., None], -1)
+                < np.take_along_axis(scores, best[..., None], -1))[..., 0]
+        return np.where(better, optimal, best)
+
+    def sweep_shaper_params(self, calibration_data, scvs, max_smoothings,
+                            damping_ratios, shapers=None, shaper_freqs=None,
+                            test_damping_ratios=None, max_freq=None):
+        # Recommends a shaper for every combination of the damping ratios,
+        # scvs and max_smoothings (None for no limit), as find_best_shaper
+        # would. The vibrations only depend on the damping ratio and the
+        # smoothing is linear in scv, so the per-frequency tables are
+        # computed once per damping ratio and shaper, and the selection is
+        # evaluated for the whole grid at once.
+        np = self.numpy
+        damping_ratios = np.array([dr or shaper_defs.DEFAULT_DAMPING_RATIO
+                                   for dr in damping_ratios])
+        scvs = np.array(scvs, dtype=np.float64)
+        max_smoothings = np.array([ms or np.inf for ms in max_smoothings])
+        test_damping_ratios = test_damping_ratios or TEST_DAMPING_RATIOS
+        psds = np.array([calibration_data.get_psd('all')], dtype=self.dtype)
+        shaper_cfgs = [shaper_cfg for shaper_cfg in shaper_defs.INPUT_SHAPERS
+                       if shaper_cfg.name in (shapers or AUTOTUNE_SHAPERS)]
+        grid = (len(damping_ratios), len(scvs), len(max_smoothings))
+        selected = np.zeros(grid, dtype=int)
+        freqs, vibrs, smoothing, max_accels, scores = [
+                np.zeros(grid) for _ in range(5)]
+        # Any shaper is better than none
+        smoothing[:] = scores[:] = np.inf
+        scv_indices = np.arange(len(scvs))[:, None]
+        for i, damping_ratio in enumerate(damping_ratios):
+            for j, shaper_cfg in enumerate(shaper_cfgs):
+                test_freqs = self._get_test_freqs(shaper_cfg, shaper_freqs)
+                _, shaper_vibrs = self.background_process_exec(
+                        self._fit_vibrations, (
+                            shaper_cfg, calibration_data.freq_bins, psds,
+                            test_freqs, damping_ratio, test_damping_ratios,
+                            max_freq))
+                shaper_vibrs = shaper_vibrs[:, 0]
+                c_scv, c_90, c_180 = self._get_smoothing_coeffs(
+                        [shaper_cfg.init_func(test_freq, damping_ratio)
+                         for test_freq in test_freqs])
+                shaper_smoothing = np.maximum(
+                        np.outer(scvs, c_scv) + c_90 * SMOOTHING_ACCEL,
+                        c_180 * SMOOTHING_ACCEL)
+                indices = self._select_sweep_indices(
+                        shaper_vibrs, shaper_smoothing, max_smoothings)
+                fit_vibrs = shaper_vibrs[indices]
+                fit_smoothing = shaper_smoothing[scv_indices, indices]
+                fit_scores = _get_shaper_scores(fit_smoothing, fit_vibrs)
+                better = _is_better_shaper(fit_scores, fit_smoothing,
+                                           scores[i], smoothing[i])
+                selected[i][better] = j
+                for values, fit_values in [
+                        (freqs, test_freqs[indices]), (vibrs, fit_vibrs),
+                        (smoothing, fit_smoothing), (scores, fit_scores),
+                        (max_accels, self._find_max_accels(
+                            c_scv[indices], c_90[indices], c_180[indices],
+                            scvs[:, None]))]:
+                    values[i] = np.where(better, fit_values, values[i])
+        return ShaperSweep(
+                damping_ratios=damping_ratios, scvs=scvs,
+                max_smoothings=max_smoothings,
+                names=[shaper_cfg.name for shaper_cfg in shaper_cfgs],
+                selected=selected, freqs=freqs, vibrs=vibrs,
+                smoothing=smoothing, max_accels=max_accels)
+
+    def get_confidence_interval(self, values, confidence=.9):
+        # Percentile interval of the bootstrapped values
+        tail = (1. - confidence) * 50.
+        low, high = self.numpy.percentile(values, [tail, 100. - tail])
+        return low, high
 
     def save_params(self, configfile, axis, shaper_name, shaper_freq):
         if axis == 'xy':
@@ -379,6 +1234,17 @@ class ShaperCalibrate:
                 if shapers:
                     for shaper in shapers:
                         csvfile.write(",%s(%.1f)" % (shaper.name, shaper.freq))
+                # Magnitudes of cross-spectral densities and the coherence
+                cross_spectra = []
+                if calibration_data.has_cross_spectra():
+                    for pair in CROSS_SPECTRA_PAIRS:
+                        csvfile.write(",csd_%s" % (pair,))
+                        cross_spectra.append(
+                                abs(calibration_data.get_csd(pair)))
+                    for pair in CROSS_SPECTRA_PAIRS:
+                        csvfile.write(",coh_%s" % (pair,))
+                        cross_spectra.append(
+                                calibration_data.get_coherence(pair))
                 csvfile.write("\n")
                 num_freqs = calibration_data.freq_bins.shape[0]
                 for i in range(num_freqs):
@@ -393,6 +1259,25 @@ class ShaperCalibrate:
                     if shapers:
                         for shaper in shapers:
                             csvfile.write(",%.3f" % (shaper.vals[i],))
+                    for j, values in enumerate(cross_spectra):
+                        csvfile.write((",%.3e" if j < len(CROSS_SPECTRA_PAIRS)
+                                       else ",%.3f") % (values[i],))
                     csvfile.write("\n")
         except IOError as e:
-            raise self.error("Error writing to file '%s': %s", output, str(e))
\ No newline at end of file
+            raise self.error("Error writing to file '%s': %s", output, str(e))
+    def save_sweep(self, output, sweep):
+        try:
+            with open(output, "w") as csvfile:
+                csvfile.write("damping_ratio,scv,max_smoothing,shaper,freq,"
+                              "vibrations,smoothing,max_accel\n")
+                for index in self.numpy.ndindex(sweep.selected.shape):
+                    max_smoothing = sweep.max_smoothings[index[2]]
+                    csvfile.write("%.3f,%.2f,%s,%s,%.1f,%.4f,%.4f,%.0f\n" % (
+                        sweep.damping_ratios[index[0]], sweep.scvs[index[1]],
+                        "%.3f" % (max_smoothing,)
+                        if self.numpy.isfinite(max_smoothing) else "",
+                        sweep.names[sweep.selected[index]],
+                        sweep.freqs[index], sweep.vibrs[index],
+                        sweep.smoothing[index], sweep.max_accels[index]))
+        except IOError as e:
+            raise self.error("Error writing to file '%s': %s", output, str(e))
@@ -0,0 +1,294 @@
+# Optimization of custom input shapers for the measured resonances
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections, importlib, math
+shaper_defs = importlib.import_module('.shaper_defs', 'extras')
+shaper_calibrate = importlib.import_module('.shaper_calibrate', 'extras')
+
+DEFAULT_IMPULSES = 4
+# Candidates are optimized at once by gradient descent (Adam) from random
+# starts and from the built-in shapers with the same number of impulses
+POPULATION_SIZE = 64
+ITERATIONS = 300
+LEARNING_RATE = .05
+# Frequencies (relative to the main resonance) of the built-in shapers
+# used as the initial candidates
+SEED_FREQ_SCALES = (.8, 1., 1.2, 1.4, 1.6, 1.8, 2.1, 2.5)
+# Built-in shapers with fewer impulses are padded by splitting their
+# largest impulses into two halves this far apart (in periods)
+SEED_SPLIT_INTERVAL = .01
+ADAM_BETAS = (.9, .999)
+# The remaining vibrations are estimated after the last impulse, so
+# a long shaper could simply wait for the vibrations to decay. Like the
+# built-in shapers, custom ones last at most this many periods of the main
+# resonance per interval between the impulses.
+MAX_INTERVAL_PERIODS = .5
+# For the same reason, negligible impulses are not allowed: the amplitude
+# of each impulse is at least the vibration reduction limit
+MIN_IMPULSE_AMPL = 1. / shaper_defs.SHAPER_VIBRATION_REDUCTION
+# Impulses closer than this (in periods) act as one and are merged
+MERGE_INTERVAL_PERIODS = .05
+# Weight of the squared relative violation of the smoothing constraint
+CONSTRAINT_WEIGHT = 100.
+# Violations below this relative tolerance are still feasible
+CONSTRAINT_TOLERANCE = 1e-3
+
+# As for the built-in shapers, min_freq of a custom shaper is chosen to
+# have projected max_accel ~= 1500 (at the default square corner velocity)
+MIN_FREQ_MAX_ACCEL = 1500.
+DEFAULT_SCV = 5.
+
+OptimizedShaper = collections.namedtuple(
+        'OptimizedShaper',
+        ('A', 'T', 'ref_freq', 'vibrs', 'smoothing', 'constraints'))
+
+def _get_responses(np, A, T, omegas, damping_ratios):
+    # Responses (candidates x damping ratios x freqs) of shapers with unit
+    # gains, as in ShaperCalibrate._estimate_shaper, and their gradients
+    # with respect to A and T (with an extra trailing axis of impulses)
+    zw = damping_ratios[:, None] * omegas
+    wd = np.sqrt(1. - damping_ratios**2)[:, None] * omegas
+    zw, wd = zw[None, :, :, None], wd[None, :, :, None]
+    T = T[:, None, None, :]
+    E = np.exp(zw * (T - T[..., -1:]))
+    W = A[:, None, None, :] * E
+    sin, cos = np.sin(wd * T), np.cos(wd * T)
+    S, C = (W * sin).sum(axis=-1), (W * cos).sum(axis=-1)
+    R = np.maximum(np.sqrt(S**2 + C**2), np.finfo(float).tiny)
+    S, C, R = S[..., None], C[..., None], R[..., None]
+    dR_dA = E * (S * sin + C * cos) / R
+    dR_dT = W * (S * (zw * sin + wd * cos) + C * (zw * cos - wd * sin)) / R
+    # All other impulses decay until the last one
+    dR_dT[..., -1] -= (zw * R)[..., 0]
+    return R[..., 0], dR_dA, dR_dT
+
+def _get_smoothing(np, A, T, accel, scv):
+    # ShaperCalibrate._get_shaper_smoothing of shapers with unit gains
+    # (candidates x impulses), and its gradients with respect to A and T
+    half_accel = accel * .5
+    ts = (A * T).sum(axis=-1, keepdims=True)
+    d = T - ts
+    after = d >= 0.
+    offset_90 = math.sqrt(2.) * (A * after * (scv + half_accel * d) * d).sum(
+            axis=-1)
+    offset_180 = half_accel * (A * d**2).sum(axis=-1)
+    # Shifts of the impulses are relative to the shaper shift ts, which
+    # does not affect offset_180 as sum(A * d) == 0
+    K = math.sqrt(2.) * (A * after * (scv + 2. * half_accel * d)).sum(
+            axis=-1, keepdims=True)
+    d90_dA = math.sqrt(2.) * after * (scv + half_accel * d) * d - K * T
+    d90_dT = math.sqrt(2.) * after * A * (scv + 2. * half_accel * d) - K * A
+    d180_dA = half_accel * d**2
+    d180_dT = 2. * half_accel * A * d
+    use_90 = (offset_90 >= offset_180)[:, None]
+    return (np.maximum(offset_90, offset_180),
+            np.where(use_90, d90_dA, d180_dA),
+            np.where(use_90, d90_dT, d180_dT))
+
+def _get_constraints(max_smoothing, min_accel):
+    # A minimum max_accel bounds the smoothing at that acceleration, as in
+    # ShaperCalibrate.find_shaper_max_accel
+    constraints = []
+    if max_smoothing:
+        constraints.append((shaper_calibrate.SMOOTHING_ACCEL, max_smoothing))
+    if min_accel:
+        constraints.append((min_accel, shaper_calibrate.TARGET_SMOOTHING))
+    return constraints or [(shaper_calibrate.SMOOTHING_ACCEL,
+                            shaper_calibrate.TARGET_SMOOTHING)]
+
+def _evaluate(np, A, T, omegas, psd, vibr_threshold, all_vibrations,
+              damping_ratios, constraints, scv):
+    # Pessimized remaining vibrations over the test damping ratios, as in
+    # ShaperCalibrate.fit_shaper_psds, the penalty for violating the
+    # smoothing constraints and the gradients of their sum
+    R, dR_dA, dR_dT = _get_responses(np, A, T, omegas, damping_ratios)
+    excess = R * psd - vibr_threshold
+    vibrations = np.maximum(excess, 0.).sum(axis=-1) / all_vibrations
+    worst = vibrations.argmax(axis=-1)[:, None, None]
+    dV_dR = np.where(excess > 0., psd / all_vibrations, 0.)
+    dV_dR = np.take_along_axis(dV_dR, worst, axis=1)[:, 0, :, None]
+    grad_A = (dV_dR * np.take_along_axis(
+        dR_dA, worst[..., None], axis=1)[:, 0]).sum(axis=1)
+    grad_T = (dV_dR * np.take_along_axis(
+        dR_dT, worst[..., None], axis=1)[:, 0]).sum(axis=1)
+    vibrations = np.take_along_axis(vibrations, worst[:, :, 0], axis=1)[:, 0]
+    penalty = np.zeros(len(A))
+    smoothings = []
+    for accel, limit in constraints:
+        smoothing, ds_dA, ds_dT = _get_smoothing(np, A, T, accel, scv)
+        violation = np.maximum(smoothing / limit - 1., 0.)
+        penalty += CONSTRAINT_WEIGHT * violation**2
+        dP_ds = (2. * CONSTRAINT_WEIGHT * violation / limit)[:, None]
+        grad_A += dP_ds * ds_dA
+        grad_T += dP_ds * ds_dT
+        smoothings.append(smoothing)
+    return vibrations, penalty, np.array(smoothings), grad_A, grad_T
+
+def _split_impulses(np, A, T, n_impulses, split_interval):
+    # Splits the largest impulses until there are `n_impulses` of them
+    A, T = list(A), list(T)
+    while len(A) < n_impulses:
+        i = int(np.argmax(A))
+        t = T[i] + split_interval
+        if i + 1 < len(T):
+            t = min(t, .5 * (T[i] + T[i + 1]))
+        A[i:i+1] = [.5 * A[i]] * 2
+        T.insert(i + 1, t)
+    return np.array(A), np.array(T)
+
+def _get_initial_params(np, rng, n_impulses, ref_freq, damping_ratio):
+    # Amplitudes are MIN_IMPULSE_AMPL plus the rest shared by a softmax of
+    # `a`, the intervals between the impulses (in periods of ref_freq) are
+    # exp(g). The first candidates are the built-in shapers with at most
+    # `n_impulses` impulses at a range of frequencies, the rest are random.
+    a = rng.normal(scale=.5, size=(POPULATION_SIZE, n_impulses))
+    g = np.log(rng.uniform(.2, .8, size=(POPULATION_SIZE, n_impulses - 1)))
+    i = 0
+    for shaper_cfg in shaper_defs.INPUT_SHAPERS:
+        for scale in SEED_FREQ_SCALES:
+            A, T = shaper_cfg.init_func(ref_freq * scale, damping_ratio)
+            if len(A) > n_impulses or i >= POPULATION_SIZE:
+                continue
+            A, T = _split_impulses(np, np.asarray(A) / sum(A),
+                                   np.asarray(T) * ref_freq, n_impulses,
+                                   SEED_SPLIT_INTERVAL)
+            shares = np.maximum(A - MIN_IMPULSE_AMPL, 1e-3)
+            a[i] = np.log(shares / shares.sum())
+            g[i] = np.log(np.diff(T))
+            i += 1
+    return a, g
+
+def _get_shapers(np, a, g, ref_freq):
+    # Returns the shapers and the softmax of `a` (the amplitude shares)
+    shares = np.exp(a - a.max(axis=-1, keepdims=True))
+    shares /= shares.sum(axis=-1, keepdims=True)
+    A = MIN_IMPULSE_AMPL + (1. - MIN_IMPULSE_AMPL * a.shape[-1]) * shares
+    intervals = np.exp(g) / ref_freq
+    T = np.concatenate([np.zeros((len(g), 1)), intervals.cumsum(axis=-1)],
+                       axis=-1)
+    return A, T, intervals, shares
+
+def _merge_impulses(np, A, T, min_interval):
+    # Merges the impulses closer than `min_interval` to the previous one,
+    # keeping their total amplitude and mean time
+    merged_A, merged_T = [A[0]], [T[0]]
+    for a, t in zip(A[1:], T[1:]):
+        if t - merged_T[-1] < min_interval:
+            total = merged_A[-1] + a
+            merged_T[-1] = (merged_A[-1] * merged_T[-1] + a * t) / total
+            merged_A[-1] = total
+        else:
+            merged_A.append(a)
+            merged_T.append(t)
+    return np.array(merged_A), np.array(merged_T) - merged_T[0]
+
+def _limit_duration(np, g, max_duration):
+    # Projects the candidates onto the maximum duration (in periods of
+    # ref_freq) by shrinking all their intervals proportionally
+    excess = np.log(np.exp(g).sum(axis=-1, keepdims=True) / max_duration)
+    g -= np.maximum(excess, 0.)
+
+def optimize_shaper(np, calibration_data, n_impulses=DEFAULT_IMPULSES,
+                    max_smoothing=None, min_accel=None, scv=None,
+                    damping_ratio=None, test_damping_ratios=None,
+                    max_freq=None, seed=None):
+    # Designs a custom shaper of up to `n_impulses` (the impulses which end
+    # up next to each other are merged) minimizing the remaining vibrations
+    # of the measured PSD with the smoothing bounded by `max_smoothing`
+    # and / or the projected max_accel bounded by `min_accel` (by the
+    # defaults of find_shaper_max_accel otherwise)
+    scv = scv or DEFAULT_SCV
+    damping_ratio = damping_ratio or shaper_defs.DEFAULT_DAMPING_RATIO
+    damping_ratios = np.array(test_damping_ratios
+                              or shaper_calibrate.TEST_DAMPING_RATIOS)
+    constraints = _get_constraints(max_smoothing, min_accel)
+    freq_bins = calibration_data.freq_bins
+    psd = calibration_data.get_psd('all')
+    in_range = freq_bins <= (max_freq or shaper_calibrate.MAX_FREQ)
+    freq_bins, psd = freq_bins[in_range], psd[in_range].astype(float)
+    peaks = calibration_data.get_peaks()
+    ref_freq = float(peaks.freqs[0] if len(peaks.freqs)
+                     else freq_bins[psd.argmax()])
+
+    # Only the frequencies above the vibration threshold contribute to
+    # the remaining vibrations, as shaper responses never exceed 1
+    vibr_threshold = psd.max() / shaper_defs.SHAPER_VIBRATION_REDUCTION
+    active = psd > vibr_threshold
+    all_vibrations = (psd[active] - vibr_threshold).sum()
+    omegas = 2. * math.pi * freq_bins[active]
+    psd = psd[active]
+
+    rng = np.random.default_rng(seed)
+    params = _get_initial_params(np, rng, n_impulses, ref_freq,
+                                 damping_ratio)
+    max_duration = MAX_INTERVAL_PERIODS * (n_impulses - 1)
+    _limit_duration(np, params[1], max_duration)
+    moments = [(np.zeros_like(p), np.zeros_like(p)) for p in params]
+    beta1, beta2 = ADAM_BETAS
+    best = None
+    for iteration in range(ITERATIONS + 1):
+        A, T, intervals, shares = _get_shapers(np, *params, ref_freq)
+        vibrations, penalty, smoothings, grad_A, grad_T = _evaluate(
+                np, A, T, omegas, psd, vibr_threshold, all_vibrations,
+                damping_ratios, constraints, scv)
+        # The best feasible candidate seen so far, or the least infeasible
+        # one if none of them satisfies the constraints yet
+        limits = np.array([limit for _, limit in constraints])[:, None]
+        feasible = (smoothings <= limits * (1. + CONSTRAINT_TOLERANCE)).all(
+                axis=0)
+        objective = np.where(feasible, vibrations, 1. + vibrations + penalty)
+        i = int(objective.argmin())
+        if best is None or objective[i] < best[0]:
+            best = (objective[i], A[i], T[i], vibrations[i], smoothings[:, i])
+        if iteration == ITERATIONS:
+            break
+        # Gradients of the unconstrained parameters
+        grad_a = (1. - MIN_IMPULSE_AMPL * n_impulses) * shares * (
+                grad_A - (shares * grad_A).sum(axis=-1, keepdims=True))
+        grad_g = intervals * grad_T[:, :0:-1].cumsum(axis=-1)[:, ::-1]
+        for p, grad, (m, v) in zip(params, (grad_a, grad_g), moments):
+            m *= beta1
+            m += (1. - beta1) * grad
+            v *= beta2
+            v += (1. - beta2) * grad**2
+            m_hat = m / (1. - beta1**(iteration + 1))
+            v_hat = v / (1. - beta2**(iteration + 1))
+            p -= LEARNING_RATE * m_hat / (np.sqrt(v_hat) + 1e-12)
+        _limit_duration(np, params[1], max_duration)
+    _, A, T, vibrations, smoothings = best
+    A, T = _merge_impulses(np, A, T, MERGE_INTERVAL_PERIODS / ref_freq)
+    if len(A) < n_impulses:
+        vibrations, _, smoothings, _, _ = _evaluate(
+                np, A[None], T[None], omegas, psd, vibr_threshold,
+                all_vibrations, damping_ratios, constraints, scv)
+        vibrations, smoothings = vibrations[0], smoothings[:, 0]
+    return OptimizedShaper(A=A, T=T, ref_freq=ref_freq,
+                           vibrs=float(vibrations),
+                           smoothing=[float(s) for s in smoothings],
+                           constraints=constraints)
+
+def get_min_freq(np, shaper, scv=DEFAULT_SCV):
+    # The lowest frequency the shaper can be scaled to with the projected
+    # max_accel of at least MIN_FREQ_MAX_ACCEL. Smoothing offsets scale as
+    # 1/freq (scv terms) and 1/freq^2 (accel terms), so the bounds on the
+    # ratio x = ref_freq / freq are the roots of quadratic polynomials.
+    c_scv, c_90, c_180 = [float(c[0]) for c in
+                          shaper_calibrate.get_smoothing_coeffs(
+                              np, [(shaper.A, shaper.T)])]
+    target = shaper_calibrate.TARGET_SMOOTHING
+    a = MIN_FREQ_MAX_ACCEL * c_90
+    x = min((math.sqrt((c_scv * scv)**2 + 4. * a * target) - c_scv * scv)
+            / (2. * a), math.sqrt(target / (MIN_FREQ_MAX_ACCEL * c_180)))
+    return shaper.ref_freq / x
+
+def make_shaper_cfg(np, shaper, name='custom'):
+    # An InputShaperCfg scaling the optimized shaper to other frequencies,
+    # to fit it like the built-in shapers. The shaper is designed for the
+    # measured resonances, so it ignores the damping ratio.
+    A = [float(a) for a in shaper.A]
+    periods = [float(t) * shaper.ref_freq for t in shaper.T]
+    def init_func(shaper_freq, damping_ratio):
+        return (A, [p / shaper_freq for p in periods])
+    return shaper_defs.InputShaperCfg(
+            name=name, init_func=init_func,
+            min_freq=get_min_freq(np, shaper), max_damping_ratio=.99)
@@ -0,0 +1,173 @@
+# Time-domain simulation of residual vibrations with input shapers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections, importlib, math
+shaper_defs = importlib.import_module('.shaper_defs', 'extras')
+
+SIMULATION_RATE = 5000.
+
+# Resonance modes of the printer model are limited in number and in
+# damping ratios estimated from the bandwidths of the peaks
+MAX_MODES = 3
+MIN_MODE_DAMPING_RATIO = 0.01
+MAX_MODE_DAMPING_RATIO = 0.5
+# Lowest frequency of the mode placed at the PSD maximum without any peaks
+MIN_MODE_FREQ = 5.
+
+# Vibrations are simulated until they decay by SETTLE_DECAY times (but at
+# most for MAX_SETTLE_TIME) after the end of the motion. The FFTs still
+# cover the whole decay, so that the vibrations remaining at the end of the
+# simulated time do not wrap around onto its start.
+SETTLE_DECAY = 1000.
+MAX_SETTLE_TIME = 2.
+
+# A zig-zag toolpath of (distance, velocity) moves used by default
+DEFAULT_MOVES = [(40., 150.), (-40., 150.)] * 10
+DEFAULT_ACCEL = 5000.
+
+ResonanceMode = collections.namedtuple(
+        'ResonanceMode', ('freq', 'damping_ratio', 'weight'))
+
+SimulationResult = collections.namedtuple(
+        'SimulationResult',
+        ('times', 'positions', 'names', 'deflections', 'errors',
+         'residual_vibrations', 'max_errors'))
+
+def fit_resonance_modes(calibration_data, axis='all', max_modes=MAX_MODES):
+    # Models the printer as a sum of damped oscillators at the most
+    # prominent PSD peaks. The damping ratio follows from the half-power
+    # bandwidth of a peak, the relative participation of the modes from
+    # their prominences (the PSD is not calibrated as a transfer function).
+    # Without any peaks, a single mode is placed at the PSD maximum.
+    peaks = calibration_data.get_peaks(axis)
+    if not len(peaks.freqs):
+        freq_bins = calibration_data.freq_bins
+        psd = calibration_data.get_psd(axis)[freq_bins >= MIN_MODE_FREQ]
+        freq = freq_bins[freq_bins >= MIN_MODE_FREQ][psd.argmax()]
+        return [ResonanceMode(float(freq), shaper_defs.DEFAULT_DAMPING_RATIO,
+                              1.)]
+    freqs = peaks.freqs[:max_modes]
+    damping_ratios = (peaks.bandwidths[:max_modes] / (2. * freqs)).clip(
+            MIN_MODE_DAMPING_RATIO, MAX_MODE_DAMPING_RATIO)
+    weights = peaks.prominences[:max_modes]**.5
+    weights = weights / weights.sum()
+    return [ResonanceMode(float(f), float(dr), float(w))
+            for f, dr, w in zip(freqs, damping_ratios, weights)]
+
+def make_motion_profile(np, moves=DEFAULT_MOVES, accel=DEFAULT_ACCEL,
+                        fs=SIMULATION_RATE):
+    # Velocities (mm/sec) of a series of rest-to-rest (distance, velocity)
+    # moves with trapezoidal velocity profiles
+    segments = []
+    for distance, velocity in moves:
+        velocity = min(velocity, math.sqrt(abs(distance) * accel))
+        accel_t = velocity / accel
+        move_t = 2. * accel_t + (abs(distance) - velocity * accel_t) / velocity
+        t = np.arange(0., move_t, 1. / fs)
+        v = np.minimum(np.minimum(t, move_t - t) * accel, velocity)
+        segments.append(math.copysign(1., distance) * v)
+    return np.concatenate(segments)
+
+def load_motion_profile(np, filename, fs=SIMULATION_RATE):
+    # Reads a 'time,position' CSV file (an optional header is skipped) and
+    # resamples it to velocities at the simulation rate
+    skiprows = 0
+    with open(filename) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                [float(value) for value in line.split(',')]
+            except ValueError:
+                # The first data line is not numeric, it is the header
+                skiprows = i + 1
+            break
+    data = np.loadtxt(filename, delimiter=',', comments='#',
+                      skiprows=skiprows, ndmin=2)
+    times = np.arange(data[0, 0], data[-1, 0], 1. / fs)
+    positions = np.interp(times, data[:, 0], data[:, 1])
+    return np.diff(positions, prepend=positions[0]) * fs
+
+def get_shaper_impulses(np, shapers):
+    # Impulse trains of all shapers padded to the same length, with unit
+    # gains and centered around the shaper shift (as the shapers are
+    # applied to the motion)
+    n = max(len(A) for A, T in shapers)
+    A = np.zeros(shape=(len(shapers), n))
+    T = np.zeros(shape=(len(shapers), n))
+    for i, (shaper_A, shaper_T) in enumerate(shapers):
+        A[i, :len(shaper_A)] = shaper_A
+        T[i, :len(shaper_T)] = shaper_T
+    A /= A.sum(axis=-1, keepdims=True)
+    T -= (A * T).sum(axis=-1, keepdims=True)
+    return A, T
+
+def simulate_shapers(np, shapers, velocities, modes, fs=SIMULATION_RATE,
+                     names=None):
+    # Applies every shaper (A, T) to the motion and drives the resonance
+    # modes with the shaped motion. All shapers are simulated at once as
+    # products of spectra, so convolutions become a single batched FFT.
+    if not modes:
+        raise ValueError("No resonance modes to simulate")
+    A, T = get_shaper_impulses(np, shapers)
+    mode_omegas = 2. * math.pi * np.array([m.freq for m in modes])
+    mode_drs = np.array([m.damping_ratio for m in modes])
+    mode_weights = np.array([m.weight for m in modes])
+    decay_time = math.log(SETTLE_DECAY) / (mode_drs * mode_omegas).min()
+    settle_time = min(decay_time, MAX_SETTLE_TIME)
+    lead = int(math.ceil(-T.min() * fs)) + 1
+    n = lead + len(velocities) + int(math.ceil((T.max() + settle_time) * fs))
+    n_fft = 1 << (n + int(math.ceil((decay_time - settle_time) * fs))
+                  - 1).bit_length()
+    omega = 2. * math.pi * np.fft.rfftfreq(n_fft, 1. / fs)
+    V = np.fft.rfft(np.concatenate([np.zeros(lead), velocities]), n_fft)
+
+    # Frequency responses of the shapers, the impulses need not be aligned
+    # with the samples
+    H = (A[:, :, None] * np.exp(-1j * T[:, :, None] * omega)).sum(axis=1)
+    # Relative displacement z of base-excited oscillators with the shaped
+    # motion x: z'' + 2 * dr * w * z' + w^2 * z = -x''
+    G = (mode_weights[:, None] / (
+        mode_omegas[:, None]**2 - omega**2
+        + 2j * (mode_drs * mode_omegas)[:, None] * omega)).sum(axis=0)
+    shaped_V = H * V
+    deflections = np.fft.irfft(-1j * omega * G * shaped_V, n_fft)[:, :n]
+    # Shaped motion lags behind (or leads) the commanded one
+    lags = np.fft.irfft(shaped_V - V, n_fft)[:, :n].cumsum(axis=-1) / fs
+    errors = lags + deflections
+
+    times = (np.arange(n) - lead) / fs
+    positions = np.concatenate([np.zeros(lead), velocities.cumsum() / fs])
+    positions = np.concatenate([positions,
+                                np.full(n - len(positions), positions[-1])])
+    # Residual vibrations remain after the end of the shaped motion
+    moving = velocities.nonzero()[0]
+    motion_end = (moving[-1] + 1) / fs if len(moving) else 0.
+    residual = times > motion_end + T.max(axis=-1, keepdims=True)
+    return SimulationResult(
+            times=times, positions=positions,
+            names=names or ['shaper %d' % (i,) for i in range(len(shapers))],
+            deflections=deflections, errors=errors,
+            residual_vibrations=np.where(
+                residual, np.abs(deflections), 0.).max(axis=-1),
+            max_errors=np.abs(errors).max(axis=-1))
+
+def simulate_fitted_shapers(np, calibration_data, shapers, damping_ratio=None,
+                            velocities=None, axis='all', fs=SIMULATION_RATE,
+                            custom_shapers=None):
+    # Simulates the fitted shapers (CalibrationResult-s) and, for the
+    # reference, the motion without input shaping. The fitted shapers may
+    # include `custom_shapers` (InputShaperCfg-s) as well.
+    damping_ratio = damping_ratio or shaper_defs.DEFAULT_DAMPING_RATIO
+    shaper_cfgs = {cfg.name: cfg for cfg in (shaper_defs.INPUT_SHAPERS
+                                             + list(custom_shapers or []))}
+    if velocities is None:
+        velocities = make_motion_profile(np, fs=fs)
+    names = ['none'] + [s.name for s in shapers]
+    impulses = [([1.], [0.])] + [
+            shaper_cfgs[s.name].init_func(s.freq, damping_ratio)
+            for s in shapers]
+    return simulate_shapers(np, impulses, velocities,
+                            fit_resonance_modes(calibration_data, axis),
+                            fs=fs, names=names)
@@ -6,20 +6,33 @@ from tkinter import filedialog
 import calibrate_shaper
 import matplotlib
 import threading
-from typing import List, Any, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from matplotlib.figure import Figure
-import numpy as np
 import queue
 import contextlib
 import io
 import pyperclip
 
+from dataset_cache import Dataset, DatasetCache
 from theme import CatppuccinMocha
 
+MAX_FREQ: float = 200.
+
 # Use TkAgg backend
 matplotlib.use('TkAgg')
 customtkinter.set_appearance_mode("dark")  # Modes: "System" (standard), "Dark", "Light"
 
+# Analyzed captures, kept across runs so that re-running or comparing files
+# does not parse and fit them again
+dataset_cache: DatasetCache = DatasetCache(max_entries=16)
+# Files chosen in the file dialog
+selected_files: List[str] = []
+# Datasets available for comparison (the most recently added last, at
+# most as many as the cache holds), their on/off toggles and checkboxes
+compare_datasets: Dict[str, Dataset] = {}
+compare_vars: Dict[str, customtkinter.BooleanVar] = {}
+compare_checkboxes: Dict[str, customtkinter.CTkCheckBox] = {}
+
 
 class QueueIO(io.TextIOBase):
     """
@@ -35,67 +48,121 @@ class QueueIO(io.TextIOBase):
 
 def browse_files() -> None:
     """
-    Opens a file dialog to select a CSV file and updates the GUI to reflect
-    the selected file.
+    Opens a file dialog to select one or more CSV files and updates the GUI
+    to reflect the selection.
     """
-    filename: str = filedialog.askopenfilename(
+    filenames: Tuple[str, ...] = filedialog.askopenfilenames(
         initialdir="/",
-        title="Select a File",
+        title="Select Files",
         filetypes=(
             ("CSV files", "*.csv*"),
             ("all files", "*.*")
         )
     )
-    if filename:
+    if filenames:
+        selected_files[:] = filenames
         # Change label contents
-        label_file_explorer.configure(text="File Opened: " + filename)
+        if len(filenames) == 1:
+            label_file_explorer.configure(text="File Opened: " + filenames[0])
+        else:
+            label_file_explorer.configure(text=f"{len(filenames)} files selected for comparison")
         button_run.configure(state="normal")
 
 
-def run_shaper(filename: str) -> Tuple[List[str], Any, Any, str, int]:
+def run_shaper(filename: str,
+               on_preview: Optional[Callable[[Dataset], None]] = None) -> Dataset:
     """
-    Runs the shaper calibration process on the given file and returns the
-    data needed for plotting.
+    Runs the shaper calibration process on the given file, unless it was
+    already analyzed, and prints its output.
 
     Args:
         filename (str): The path to the CSV file to analyze.
+        on_preview (Callable): Receives a quick preview of the analysis,
+            printed beforehand, when the file has to be analyzed.
 
     Returns:
-        A tuple containing the data needed for plotting:
-        (args, calibration_data, shapers, selected_shaper, max_freq)
+        The analyzed dataset with the data needed for plotting.
     """
-    max_freq: int = 200
-    # Parse data
-    args: List[str] = [f'{filename}']
-    datas: List[Union[np.ndarray, Any]] = [calibrate_shaper.parse_log(fn) for fn in args]
-    # Calibrate shaper and generate outputs
-    selected_shaper: str
-    shapers: Any
-    calibration_data: Any
-    selected_shaper, shapers, calibration_data = calibrate_shaper.calibrate_shaper(
-        datas,
-        None,  # csv_output
-        shapers=None,  # Let the calibrator choose the best shapers
-        damping_ratio=None,  # Use default damping ratio
-        scv=5.0,  # Square corner velocity (standard default)
-        shaper_freqs=[],  # No specific frequencies to test
-        max_smoothing=None,  # No smoothing limit
-        test_damping_ratios=None,  # Use default damping ratios
-        max_freq=max_freq  # Maximum frequency to analyze
-    )
-    return args, calibration_data, shapers, selected_shaper, max_freq
+    def show_preview(preview: Dataset) -> None:
+        print(f"=== {preview.name} (preview) ===")
+        print(preview.log, end="")
+        on_preview(preview)
 
+    dataset: Dataset = dataset_cache.get(
+        filename, MAX_FREQ, on_preview=show_preview if on_preview else None)
+    print(f"=== {dataset.name} ===")
+    print(dataset.log, end="")
+    return dataset
 
-def create_and_show_plot(plot_data: Tuple[List[str], Any, Any, str, int]) -> None:
+
+def create_and_show_plot(dataset: Dataset) -> None:
     """
-    Creates and shows the matplotlib plot on the main thread.
+    Creates and shows the matplotlib plot on the main thread. A preview and
+    the full analysis of the same file share a figure, so the full results
+    replace the preview once they are ready.
 
     Args:
-        plot_data (Tuple): A tuple containing the data needed for plotting.
+        dataset (Dataset): The analyzed dataset to plot.
     """
-    args, calibration_data, shapers, selected_shaper, max_freq = plot_data
     calibrate_shaper.setup_matplotlib(None)
-    fig: Figure = calibrate_shaper.plot_freq_response(args, calibration_data, shapers, selected_shaper, max_freq)
+    fig: Figure = matplotlib.pyplot.figure(num=dataset.name)
+    fig.clear()
+    title: str = f"{dataset.name} (preview)" if dataset.preview else dataset.name
+    calibrate_shaper.plot_freq_response(
+        [title], dataset.calibration_data, dataset.shapers, dataset.selected_shaper, MAX_FREQ, fig=fig)
+    fig.canvas.draw_idle()
+    fig.show()
+
+
+def add_compare_dataset(dataset: Dataset) -> None:
+    """
+    Adds an analyzed dataset to the comparison list with its toggle enabled.
+    The least recently added datasets beyond the cache size are dropped.
+
+    Args:
+        dataset (Dataset): The analyzed dataset to add.
+    """
+    compare_datasets.pop(dataset.name, None)
+    compare_datasets[dataset.name] = dataset
+    if dataset.name in compare_vars:
+        compare_vars[dataset.name].set(True)
+    else:
+        var = customtkinter.BooleanVar(value=True)
+        compare_vars[dataset.name] = var
+        checkbox = customtkinter.CTkCheckBox(
+            frame_datasets,
+            text=dataset.name,
+            variable=var,
+            command=draw_comparison,
+            text_color=CatppuccinMocha.TEXT,
+            fg_color=CatppuccinMocha.BLUE,
+            hover_color=CatppuccinMocha.SAPPHIRE,
+        )
+        checkbox.pack(anchor="w", padx=10, pady=2)
+        compare_checkboxes[dataset.name] = checkbox
+    while len(compare_datasets) > dataset_cache.max_entries:
+        name: str = next(iter(compare_datasets))
+        del compare_datasets[name]
+        del compare_vars[name]
+        compare_checkboxes.pop(name).destroy()
+
+
+def draw_comparison() -> None:
+    """
+    Redraws the overlay of all enabled datasets from the cached results,
+    without parsing or fitting them again.
+    """
+    datasets: List[Tuple[str, Any, Any, str]] = [
+        (name, dataset.calibration_data, dataset.shapers, dataset.selected_shaper)
+        for name, dataset in compare_datasets.items()
+        if compare_vars[name].get() and dataset.selected_shaper is not None
+    ]
+    calibrate_shaper.setup_matplotlib(None)
+    fig: Figure = matplotlib.pyplot.figure(num="Comparison")
+    fig.clear()
+    if datasets:
+        calibrate_shaper.plot_datasets_overlay(datasets, MAX_FREQ, fig=fig)
+    fig.canvas.draw_idle()
     fig.show()
 
 
@@ -105,9 +172,8 @@ def run_shaper_threaded() -> None:
     freezing. Disables the run button during execution and re-enables it
     when finished.
     """
-    try:
-        filepath: str = label_file_explorer.cget("text").split(": ")[1]
-    except IndexError:
+    filepaths: List[str] = list(selected_files)
+    if not filepaths:
         label_file_explorer.configure(text="Please select a file first!")
         return
 
@@ -120,17 +186,24 @@ def run_shaper_threaded() -> None:
     q = queue.Queue()
     q_io = QueueIO(q)
 
+    compare: bool = len(filepaths) > 1
+
     def task() -> None:
         """The actual task to be run in the thread."""
         try:
-            # Run the data processing in the background
-            with contextlib.redirect_stdout(q_io):
-                plot_data = run_shaper(filepath)
-            # Pass the plot data to the main thread
-            q.put(plot_data)
-        except Exception as e:
-            # Also print exceptions to the queue
-            print(f"An error occurred: {e}")
+            # Run the data processing in the background, previews are only
+            # plotted for single files
+            for filepath in filepaths:
+                with contextlib.redirect_stdout(q_io):
+                    try:
+                        dataset = run_shaper(filepath, None if compare else q.put)
+                    except Exception as e:
+                        # Also print exceptions to the queue, the remaining
+                        # files are still analyzed
+                        print(f"An error occurred in {filepath}: {e}")
+                        continue
+                # Pass the plot data to the main thread
+                q.put(dataset)
         finally:
             # Signal that the task is done
             q.put(None)
@@ -139,23 +212,34 @@ def run_shaper_threaded() -> None:
     thread: threading.Thread = threading.Thread(target=task)
     thread.start()
     # Start processing the queue
-    process_queue(q)
+    process_queue(q, compare=compare)
 
 
-def process_queue(q: queue.Queue) -> None:
+def process_queue(q: queue.Queue, compare: bool = False) -> None:
     """
     Processes the queue of messages from the background thread and updates
     the GUI.
+
+    Args:
+        q (queue.Queue): The queue of messages from the background thread.
+        compare (bool): Whether to overlay all datasets once the task is done
+            instead of plotting every dataset separately.
     """
     try:
         message = q.get_nowait()
         if message is None:
             # Task is done, re-enable the run button
             button_run.configure(state="normal", text="🚀 Run Calibration")
+            if compare:
+                draw_comparison()
             return
-        elif isinstance(message, tuple):
-            # If the message is a tuple, it's our plot data
-            create_and_show_plot(message)
+        elif isinstance(message, Dataset):
+            # If the message is a dataset, it's our plot data. Previews
+            # are only shown until the full analysis is done.
+            if not message.preview:
+                add_compare_dataset(message)
+            if not compare and message.selected_shaper is not None:
+                create_and_show_plot(message)
         else:
             # Otherwise, it's a string, so insert it into the textbox
             output_textbox.configure(state="normal")
@@ -165,7 +249,7 @@ def process_queue(q: queue.Queue) -> None:
         pass  # Queue is empty, do nothing
 
     # Check again after 100ms
-    window.after(100, lambda: process_queue(q))
+    window.after(100, lambda: process_queue(q, compare))
 
 
 def _exit() -> None:
@@ -189,7 +273,7 @@ def copy_to_clipboard() -> None:
 # GUI root window
 window: customtkinter.CTk = customtkinter.CTk()
 window.title("Shaper Calibration Assistant")
-window.geometry("700x550")
+window.geometry("700x700")
 window.configure(fg_color=CatppuccinMocha.BASE)
 
 # --- Configure grid layout for responsiveness ---
@@ -248,6 +332,14 @@ button_exit: customtkinter.CTkButton = customtkinter.CTkButton(
     font=("Arial", 12, "bold")
 )
 
+frame_datasets: customtkinter.CTkScrollableFrame = customtkinter.CTkScrollableFrame(
+    window,
+    label_text="Compare datasets",
+    label_text_color=CatppuccinMocha.TEXT,
+    fg_color=CatppuccinMocha.MANTLE,
+    height=100,
+)
+
 output_textbox: customtkinter.CTkTextbox = customtkinter.CTkTextbox(
     window,
     state="disabled",
@@ -267,8 +359,10 @@ button_run.grid(row=1, column=1, padx=(10, 20), pady=10, sticky="ew")
 
 output_textbox.grid(row=2, column=0, padx=20, pady=10, columnspan=2, sticky="nsew")
 
-button_copy.grid(row=3, column=0, padx=(20, 10), pady=10, sticky="ew")
-button_exit.grid(row=3, column=1, padx=(10, 20), pady=10, sticky="ew")
+frame_datasets.grid(row=3, column=0, padx=20, pady=10, columnspan=2, sticky="ew")
+
+button_copy.grid(row=4, column=0, padx=(20, 10), pady=10, sticky="ew")
+button_exit.grid(row=4, column=1, padx=(10, 20), pady=10, sticky="ew")
 
 # Drive it like you stole it
 window.mainloop()
\ No newline at end of file
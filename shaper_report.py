@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# Parallel rendering of shaper calibration reports
+#
+# Every worker process keeps a single Agg figure which is cleared and
+# reused for each page, the pyplot state machine is never used. Pages are
+# written to disk as soon as they are rendered. The combined reports (HTML
+# and a multi-page PDF) are written by the main process in page order. Only
+# for the PDF report the workers return the analyzed pages, which are drawn
+# again while the workers render the following pages (matplotlib cannot
+# merge the PDF pages rendered by the workers).
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import collections, concurrent.futures, contextlib, html, io, optparse, os
+import re, sys, traceback
+import calibrate_shaper
+
+REPORT_FORMATS = ('png', 'svg', 'pdf')
+
+ReportPage = collections.namedtuple(
+        'ReportPage',
+        ('name', 'lognames', 'calibration_data', 'shapers', 'selected_shaper',
+         'max_freq'))
+
+######################################################################
+# Worker processes
+######################################################################
+
+_figure = _helper = None
+
+def _init_worker(figsize):
+    global _figure, _helper
+    import matplotlib.figure, matplotlib.font_manager, matplotlib.ticker
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    _figure = matplotlib.figure.Figure(figsize=figsize)
+    FigureCanvasAgg(_figure)
+    _helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+
+def _render_page(page, path, with_page):
+    _figure.clear()
+    calibrate_shaper.plot_freq_response(
+            page.lognames, page.calibration_data, page.shapers,
+            page.selected_shaper, page.max_freq, fig=_figure)
+    _figure.savefig(path)
+    return page.name, page.selected_shaper, path, page if with_page else None
+
+def _render_named_page(name, path, with_page, page):
+    return _render_page(page, path, with_page)
+
+def _analyze_and_render(name, path, with_page, lognames, calibrate_args):
+    try:
+        datas = [calibrate_shaper.parse_log(fn, validate=True)
+                 for fn in lognames]
+        with contextlib.redirect_stdout(io.StringIO()):
+            selected_shaper, shapers, calibration_data = \
+                    calibrate_shaper.calibrate_shaper(
+                            datas, None, helper=_helper, **calibrate_args)
+        if selected_shaper is None:
+            return name, None, None, None
+        page = ReportPage(name, [os.path.basename(fn) for fn in lognames],
+                          calibration_data, shapers, selected_shaper,
+                          calibrate_args['max_freq'])
+        return _render_page(page, path, with_page)
+    except Exception as e:
+        # Skip the page, the rest of the batch is still rendered
+        print("%s: %s" % (name, "".join(traceback.format_exception_only(
+            type(e), e)).strip()), file=sys.stderr)
+        return name, None, None, None
+
+######################################################################
+# Report generation
+######################################################################
+
+def _get_page_paths(output_dir, names, fmt):
+    # Different names may map to the same file name, those get a suffix
+    paths, used = [], set()
+    for name in names:
+        base = re.sub(r'[^\w.-]+', '_', name)
+        filename, i = base, 1
+        while filename.lower() in used:
+            i += 1
+            filename = "%s_%d" % (base, i)
+        used.add(filename.lower())
+        paths.append(os.path.join(output_dir, "%s.%s" % (filename, fmt)))
+    return paths
+
+class HtmlReport:
+    # Combined report linking all rendered pages, written incrementally
+    def __init__(self, filename, title):
+        self.filename = filename
+        self.f = open(filename, 'w')
+        self.f.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">"
+                     "<title>%s</title></head><body>\n<h1>%s</h1>\n" % (
+                         html.escape(title), html.escape(title)))
+    def add_page(self, name, selected_shaper, path):
+        if path is None:
+            self.f.write("<h2>%s</h2>\n<p>No recommended shaper</p>\n" % (
+                html.escape(name),))
+        else:
+            src = os.path.relpath(path, os.path.dirname(self.filename))
+            if path.endswith('.pdf'):
+                # Browsers do not render PDFs as images
+                page = "<a href=\"%s\">%s</a>" % (html.escape(src),
+                                                   html.escape(src))
+            else:
+                page = "<img src=\"%s\" alt=\"%s\">" % (html.escape(src),
+                                                         html.escape(name))
+            self.f.write("<h2>%s</h2>\n<p>Recommended shaper: %s</p>\n"
+                         "%s\n" % (html.escape(name),
+                                   html.escape(selected_shaper), page))
+        self.f.flush()
+    def close(self):
+        self.f.write("</body></html>\n")
+        self.f.close()
+
+class PdfReport:
+    # Combined multi-page PDF report. The pages are drawn again from the
+    # analysis results, on a single figure of the main process.
+    def __init__(self, filename, figsize):
+        import matplotlib.figure
+        from matplotlib.backends.backend_pdf import FigureCanvasPdf, PdfPages
+        self.pdf = PdfPages(filename)
+        self.figure = matplotlib.figure.Figure(figsize=figsize)
+        FigureCanvasPdf(self.figure)
+    def add_page(self, name, selected_shaper, path, page):
+        self.figure.clear()
+        if page is None:
+            self.figure.text(.5, .5, "%s\nNo recommended shaper" % (name,),
+                             ha='center', va='center', fontsize='large')
+        else:
+            calibrate_shaper.plot_freq_response(
+                    page.lognames, page.calibration_data, page.shapers,
+                    page.selected_shaper, page.max_freq, fig=self.figure)
+        self.pdf.savefig(self.figure)
+    def close(self):
+        self.pdf.close()
+
+def _run_tasks(func, tasks, output_dir, fmt, html_report, pdf_report,
+               workers, figsize):
+    # Every task starts with the page name, `func` gets the page path and
+    # whether the ReportPage is needed after it, and returns the page name,
+    # selected shaper, path and ReportPage (if needed)
+    if fmt not in REPORT_FORMATS:
+        raise ValueError("Unsupported report format '%s'" % (fmt,))
+    os.makedirs(output_dir, exist_ok=True)
+    report = pdf = None
+    if html_report:
+        report = HtmlReport(html_report, "Shaper calibration report")
+    if pdf_report:
+        pdf = PdfReport(pdf_report, figsize)
+    results = []
+    try:
+        with concurrent.futures.ProcessPoolExecutor(
+                workers, initializer=_init_worker,
+                initargs=(figsize,)) as executor:
+            # The results arrive in the order of pages, so that the combined
+            # report can be written while the remaining pages are rendered
+            paths = _get_page_paths(output_dir, [task[0] for task in tasks],
+                                    fmt)
+            futures = [executor.submit(
+                           func, *(task[:1] + (path, pdf is not None)
+                                   + task[1:]))
+                       for task, path in zip(tasks, paths)]
+            for future in futures:
+                res = future.result()
+                if report is not None:
+                    report.add_page(*res[:3])
+                if pdf is not None:
+                    pdf.add_page(*res)
+                results.append(res[:3])
+    finally:
+        if report is not None:
+            report.close()
+        if pdf is not None:
+            pdf.close()
+    return results
+
+def render_pages(pages, output_dir, fmt='png', html_report=None,
+                 pdf_report=None, workers=None, figsize=(8, 6)):
+    # Renders already analyzed ReportPage-s
+    tasks = [(page.name, page) for page in pages]
+    return _run_tasks(_render_named_page, tasks, output_dir, fmt,
+                      html_report, pdf_report, workers, figsize)
+
+def analyze_and_render(lognames_by_name, output_dir, fmt='png',
+                       html_report=None, pdf_report=None, workers=None,
+                       figsize=(8, 6), **calibrate_args):
+    # Analyzes and renders every named set of logs in the worker processes
+    tasks = [(name, lognames, calibrate_args)
+             for name, lognames in lognames_by_name]
+    return _run_tasks(_analyze_and_render, tasks, output_dir, fmt,
+                      html_report, pdf_report, workers, figsize)
+
+######################################################################
+# Startup
+######################################################################
+
+def main():
+    usage = "%prog [options] <logs>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--output_dir", type="string", dest="output_dir",
+                    default=".", help="directory to write report pages to")
+    opts.add_option("--format", type="choice", dest="format", default="png",
+                    choices=REPORT_FORMATS, help="format of report pages")
+    opts.add_option("--html", type="string", dest="html", default=None,
+                    help="filename of the combined HTML report")
+    opts.add_option("--pdf", type="string", dest="pdf", default=None,
+                    help="filename of the combined multi-page PDF report")
+    opts.add_option("-j", "--jobs", type="int", dest="jobs", default=None,
+                    help="number of worker processes")
+    opts.add_option("-f", "--max_freq", type="float", default=200.,
+                    help="maximum frequency to plot")
+    opts.add_option("--scv", "--square_corner_velocity", type="float",
+                    dest="scv", default=5., help="square corner velocity")
+    opts.add_option("-s", "--max_smoothing", type="float", dest="max_smoothing",
+                    default=None, help="maximum shaper smoothing to allow")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+
+    # Every log is a separate report page
+    lognames_by_name = [(os.path.splitext(os.path.basename(fn))[0], [fn])
+                        for fn in args]
+    results = analyze_and_render(
+            lognames_by_name, options.output_dir, fmt=options.format,
+            html_report=options.html, pdf_report=options.pdf,
+            workers=options.jobs,
+            shapers=None, damping_ratio=None, scv=options.scv,
+            shaper_freqs=[], max_smoothing=options.max_smoothing,
+            test_damping_ratios=None, max_freq=options.max_freq)
+    for name, selected_shaper, path in results:
+        print("%s: %s" % (name, path or "no recommended shaper"))
+
+if __name__ == '__main__':
+    main()
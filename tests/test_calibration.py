@@ -1,3 +1,6 @@
+import bz2
+import gzip
+import lzma
 import numpy as np
 import pytest
 import calibrate_shaper
@@ -51,4 +54,538 @@ def test_parse_log_raw_accelerometer_data():
     # Check that the parsed data is a numpy array with the correct shape and values
     assert isinstance(data, np.ndarray)
     assert data.shape == (2, 3)
-    assert np.array_equal(data, np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]))
\ No newline at end of file
+    assert np.array_equal(data, np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]]))
+
+def make_raw_data(fs=3200., duration=4., resonances=(42., 57., 30.), seed=0):
+    """
+    Generates synthetic raw accelerometer data (time, x, y, z) with a
+    single resonance per axis buried in white noise.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(0., duration, 1. / fs)
+    columns = [t]
+    for freq in resonances:
+        envelope = np.exp(-((t % 1.) - .5)**2 * 20.)
+        columns.append(rng.normal(size=t.size) * 50. +
+                       3000. * np.sin(2. * np.pi * freq * t) * envelope)
+    return np.stack(columns, axis=1)
+
+
+def make_calibration_data(**kwargs):
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    calibration_data = helper.process_accelerometer_data(
+            make_raw_data(**kwargs))
+    calibration_data.normalize_to_frequencies()
+    return helper, calibration_data
+
+
+def test_fit_shaper_multi_matches_single_axis_fits():
+    """
+    Tests that fitting several axes in a single pass gives the same results
+    as fitting every axis separately.
+    """
+    helper, calibration_data = make_calibration_data()
+    shaper_cfg = calibrate_shaper.shaper_calibrate.shaper_defs.INPUT_SHAPERS[1]
+    fit_args = ((20., 80., .5), None, 5., None, None, None)
+    axes = ['x', 'y', 'all']
+    multi = helper.fit_shaper_multi(
+            shaper_cfg, calibration_data, axes, *fit_args)
+    for axis, res in zip(axes, multi):
+        single = helper.fit_shaper_multi(
+                shaper_cfg, calibration_data, [axis], *fit_args)[0]
+        assert res.freq == single.freq
+        assert res.vibrs == pytest.approx(single.vibrs)
+        assert res.score == pytest.approx(single.score)
+    # Each axis should get a shaper near its own resonance
+    assert multi[0].freq != multi[1].freq
+
+
+def test_shaper_response_bank_persists_tables(tmp_path):
+    """
+    Tests that the shaper response bank matches the per-frequency shaper
+    estimation, reuses the tables persisted on disk for other freq_bins and
+    keeps the bank directory within its size limit.
+    """
+    helper, calibration_data = make_calibration_data()
+    shaper_calibrate = calibrate_shaper.shaper_calibrate
+    shaper_cfg = shaper_calibrate.shaper_defs.INPUT_SHAPERS[3]
+    test_freqs = np.arange(30., 60., 1.)
+    freq_bins = calibration_data.freq_bins[calibration_data.freq_bins <= 200.]
+    bank = shaper_calibrate.shaper_bank.ShaperResponseBank(np, str(tmp_path))
+    table = bank.get_responses(shaper_cfg, .1, test_freqs, [.05, .1],
+                               freq_bins)
+    assert table.shape == (2, len(test_freqs), len(freq_bins))
+    shaper = shaper_cfg.init_func(test_freqs[7], .1)
+    assert np.allclose(table[1, 7],
+                       helper._estimate_shaper(shaper, .1, freq_bins),
+                       atol=1e-3)
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+
+    # A new bank must load the table from disk instead of recomputing it,
+    # also for the slightly different freq_bins of another capture
+    bank = shaper_calibrate.shaper_bank.ShaperResponseBank(np, str(tmp_path))
+    bank.compute = None
+    loaded = bank.get_responses(shaper_cfg, .1, test_freqs, [.05, .1],
+                                freq_bins)
+    assert np.array_equal(loaded, table)
+    other_bins = freq_bins * 1.003
+    other = bank.get_responses(shaper_cfg, .1, test_freqs, [.05, .1],
+                               other_bins, rows=[7])
+    assert np.allclose(other[1, 0],
+                       helper._estimate_shaper(shaper, .1, other_bins),
+                       atol=1e-3)
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+
+    size = next(tmp_path.glob('*.npy')).stat().st_size
+    bank = shaper_calibrate.shaper_bank.ShaperResponseBank(
+            np, str(tmp_path), max_dir_size=size)
+    bank.get_responses(shaper_cfg, .1, test_freqs, [.1], freq_bins)
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+
+
+def test_fit_shaper_table_columns():
+    """
+    Tests that the columnar fit table covers all tested frequencies and that
+    its selection matches fit_shaper, including the max_smoothing cut-off.
+    """
+    helper, calibration_data = make_calibration_data()
+    shaper_cfg = calibrate_shaper.shaper_calibrate.shaper_defs.INPUT_SHAPERS[0]
+    for max_smoothing in (None, .1):
+        fit_args = ((20., 80., .5), None, 5., max_smoothing, None, None)
+        table = helper.fit_shaper_table(
+                shaper_cfg, calibration_data, ['all'], *fit_args)
+        n_freqs = len(table.freqs)
+        assert np.all(np.diff(table.freqs) > 0)
+        assert table.vibrs.shape == table.scores.shape == (n_freqs, 1)
+        assert table.smoothing.shape == table.max_accels.shape == (n_freqs,)
+        assert table.smoothing_limited == (max_smoothing is not None)
+        shaper = helper.fit_shaper(shaper_cfg, calibration_data, *fit_args)
+        assert shaper.freq == table.select().freq
+        assert shaper.score == table.select().score
+        assert shaper.vals.shape == calibration_data.freq_bins[
+                calibration_data.freq_bins <= 200.].shape
+
+
+def test_band_limited_freq_response():
+    """
+    Tests that the decimated (band-limited) frequency response matches the
+    full-band one below max_freq.
+    """
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    raw_data = make_raw_data(duration=10.)
+    full = helper.calc_freq_response(raw_data)
+    limited = helper.calc_freq_response(raw_data, max_freq=200.)
+    band = full.freq_bins <= 200.
+    assert np.allclose(limited.freq_bins, full.freq_bins[band])
+    for axis in ('x', 'y', 'z', 'all'):
+        assert np.allclose(limited.get_psd(axis), full.get_psd(axis)[band],
+                           rtol=.05)
+
+
+def test_preview_freq_response():
+    """
+    Tests that the preview frequency response is coarser but still finds the
+    resonances of the full analysis.
+    """
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    raw_data = make_raw_data(duration=10.)
+    full = helper.process_accelerometer_data(raw_data, max_freq=200.,
+                                             spectrogram=True)
+    preview = helper.process_accelerometer_data(raw_data, max_freq=200.,
+                                                spectrogram=True, preview=True)
+    assert len(preview.freq_bins) < len(full.freq_bins)
+    assert len(preview.spectrogram_times) < len(full.spectrogram_times)
+    freq_step = preview.freq_bins[1] - preview.freq_bins[0]
+    for axis, freq in zip('xyz', (42., 57., 30.)):
+        assert abs(preview.get_peaks(axis).freqs[0] - freq) <= freq_step
+
+
+def test_calibrate_merged_psds_twice():
+    """
+    Tests that merging PSD captures leaves them intact, so that they can be
+    calibrated again after a preview.
+    """
+    datas = [make_calibration_data(resonances=resonances)[1]
+             for resonances in [(42., 57., 30.), (45., 57., 30.)]]
+    results = [calibrate_shaper.calibrate_shaper(
+                   datas, None, shapers=None, damping_ratio=None, scv=5.,
+                   shaper_freqs=[], max_smoothing=None,
+                   test_damping_ratios=None, max_freq=200., preview=preview)
+               for preview in (True, False, False)]
+    assert [data.data_sets for data in datas] == [1, 1]
+    assert results[2][2].data_sets == 2
+    assert results[1][0] == results[2][0]
+    assert results[1][1][0].freq == results[2][1][0].freq
+
+
+@pytest.mark.parametrize("opener", [gzip.open, bz2.open, lzma.open])
+def test_parse_log_compressed(opener, tmp_path):
+    """
+    Tests that compressed raw and PSD captures are decompressed on the fly
+    regardless of their file extension.
+    """
+    raw_data = make_raw_data(duration=1.)
+    plain = tmp_path / "raw.csv"
+    np.savetxt(plain, raw_data, delimiter=",", fmt="%.6f")
+    compressed = tmp_path / "raw.bin"
+    with opener(compressed, "wb") as f:
+        f.write(plain.read_bytes())
+    assert np.array_equal(calibrate_shaper.parse_log(str(compressed)),
+                          calibrate_shaper.parse_log(str(plain)))
+
+    psd_log = tmp_path / "psd.csv.gz"
+    with opener(psd_log, "wt") as f:
+        f.write("freq,psd_x,psd_y,psd_z,psd_xyz,mzv\n"
+                "10.0,1.0,2.0,3.0,6.0,0\n20.0,2.0,3.0,4.0,9.0,0\n")
+    calibration_data = calibrate_shaper.parse_log(str(psd_log))
+    assert np.array_equal(calibration_data.psd_sum, [6., 9.])
+
+
+def test_spectrogram_from_welch_windows():
+    """
+    Tests that the kept per-window spectra average to the Welch PSD and
+    that spectrograms of joined captures follow each other in time.
+    """
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    raw_data = make_raw_data(duration=3.)
+    calibration_data = helper.process_accelerometer_data(
+            raw_data, spectrogram=True)
+    assert helper.calc_freq_response(raw_data).spectrogram_times is None
+    times = calibration_data.spectrogram_times
+    for axis in ('x', 'y', 'z', 'all'):
+        spectrogram = calibration_data.get_spectrogram(axis)
+        assert spectrogram.shape == (len(times),
+                                     len(calibration_data.freq_bins))
+        assert np.allclose(spectrogram.mean(axis=0),
+                           calibration_data.get_psd(axis))
+    assert np.all(np.diff(times) > 0) and times[-1] < 3.
+
+    calibration_data.add_data(helper.process_accelerometer_data(
+            raw_data, spectrogram=True))
+    calibration_data.normalize_to_frequencies()
+    joined_times = calibration_data.spectrogram_times
+    assert len(joined_times) == 2 * len(times)
+    assert np.all(np.diff(joined_times) > 0)
+    assert np.allclose(calibration_data.get_spectrogram('x').mean(axis=0),
+                       calibration_data.psd_x)
+
+
+def test_bootstrap_best_shaper():
+    """
+    Tests that the bootstrap confidence interval of the shaper frequency
+    brackets the point estimate.
+    """
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    calibration_data = helper.process_accelerometer_data(
+            make_raw_data(), spectrogram=True)
+    calibration_data.normalize_to_frequencies()
+    best_shaper, _ = helper.find_best_shaper(
+            calibration_data, shapers=['mzv', 'ei'], scv=5.)
+
+    best, bootstraps = helper.bootstrap_best_shaper(
+            calibration_data, 50, shapers=['mzv', 'ei'], scv=5., seed=0)
+    assert [b.name for b in bootstraps] == ['mzv', 'ei']
+    assert best.shape == (50,)
+    bootstrap = bootstraps[[b.name for b in bootstraps].index(
+        best_shaper.name)]
+    low, high = helper.get_confidence_interval(bootstrap.freqs, .98)
+    assert low - .5 <= best_shaper.freq <= high + .5
+
+    # Overlapping windows are resampled in blocks of consecutive windows
+    counts = calibrate_shaper.shaper_calibrate.get_block_bootstrap_counts(
+            np, np.random.default_rng(0), 27, 100)
+    assert counts.shape == (100, 27)
+    assert np.all(counts.sum(axis=1) == 27)
+    used = np.diff(counts > 0, prepend=False, append=False, axis=1)
+    runs = np.diff(used.nonzero()[1].reshape(-1, 2), axis=1)
+    assert np.all(runs >= 3)
+
+
+
+def test_sweep_shaper_params(tmp_path):
+    """
+    Tests that every combination of the parameter sweep recommends the same
+    shaper as a separate calibration run with these parameters.
+    """
+    helper, calibration_data = make_calibration_data()
+    damping_ratios, scvs, max_smoothings = [.05, .1], [3., 10.], [None, .1]
+    sweep = helper.sweep_shaper_params(
+            calibration_data, scvs, max_smoothings, damping_ratios,
+            shaper_freqs=(None, None, 1.))
+    assert sweep.selected.shape == (2, 2, 2)
+    for i, j, k in np.ndindex(sweep.selected.shape):
+        best_shaper, _ = helper.find_best_shaper(
+                calibration_data, damping_ratio=damping_ratios[i],
+                scv=scvs[j], max_smoothing=max_smoothings[k],
+                shaper_freqs=(None, None, 1.))
+        assert sweep.names[sweep.selected[i, j, k]] == best_shaper.name
+        assert sweep.freqs[i, j, k] == best_shaper.freq
+        assert np.isclose(sweep.smoothing[i, j, k], best_shaper.smoothing)
+        assert np.isclose(sweep.max_accels[i, j, k], best_shaper.max_accel)
+
+    output = tmp_path / "sweep.csv"
+    helper.save_sweep(str(output), sweep)
+    assert len(output.read_text().splitlines()) == 1 + sweep.selected.size
+
+
+def test_optimize_custom_shaper():
+    """
+    Tests that the optimized custom shaper satisfies the smoothing
+    constraint, leaves no more vibrations than the built-in shapers with
+    as many impulses and is fitted along with them.
+    """
+    helper, calibration_data = make_calibration_data()
+    shaper_optimizer = calibrate_shaper.shaper_optimizer
+    _, builtin_shapers = helper.find_best_shaper(
+            calibration_data, shapers=['mzv', 'ei'], max_smoothing=.12,
+            scv=5.)
+    shaper = shaper_optimizer.optimize_shaper(
+            np, calibration_data, 3, max_smoothing=.12, seed=0)
+    assert np.isclose(shaper.A.sum(), 1.)
+    # No negligible impulses or impulses next to each other
+    assert shaper.A.min() >= shaper_optimizer.MIN_IMPULSE_AMPL - 1e-9
+    assert (np.diff(shaper.T) * shaper.ref_freq
+            >= shaper_optimizer.MERGE_INTERVAL_PERIODS).all()
+    assert shaper.smoothing[0] <= .12 * 1.001
+    assert shaper.vibrs <= min(s.vibrs for s in builtin_shapers) + 1e-6
+    smoothing = helper._get_shaper_smoothing((shaper.A, shaper.T))
+    assert np.isclose(smoothing, shaper.smoothing[0])
+
+    shaper_cfg = shaper_optimizer.make_shaper_cfg(np, shaper)
+    best_shaper, all_shapers = helper.find_best_shaper(
+            calibration_data, shapers=['mzv', 'ei'], max_smoothing=.12,
+            scv=5., custom_shapers=[shaper_cfg])
+    assert [s.name for s in all_shapers] == ['mzv', 'ei', 'custom']
+    assert all_shapers[-1].smoothing <= .12 + 1e-3
+    # Klipper cannot be configured with a custom shaper
+    assert best_shaper.name in ('mzv', 'ei')
+
+
+def test_save_figure_keeps_backend(tmp_path):
+    """
+    Tests that extra graphs are saved without switching the pyplot backend
+    the main graph is shown with.
+    """
+    helper, calibration_data = make_calibration_data()
+    fit_tables = []
+    best_shaper, _ = helper.find_best_shaper(
+            calibration_data, shapers=['zv', 'mzv'], scv=5.,
+            fit_tables=fit_tables)
+    calibrate_shaper.setup_matplotlib(False)
+    backend = calibrate_shaper.matplotlib.get_backend()
+    calibrate_shaper.matplotlib.use('svg')
+    try:
+        output = tmp_path / "scores.png"
+        calibrate_shaper.save_figure(
+                str(output), (8, 6), calibrate_shaper.plot_shaper_scores,
+                ["raw.csv"], fit_tables, best_shaper.name)
+        assert calibrate_shaper.matplotlib.get_backend() == 'svg'
+    finally:
+        calibrate_shaper.matplotlib.use(backend)
+    assert output.read_bytes().startswith(b"\x89PNG")
+
+
+def make_multi_test_data(fs=3200., test_axes='xyx', duration=3., idle=2.,
+                         seed=0):
+    """
+    Generates a synthetic raw recording of several single-axis resonance
+    tests separated by idle periods with sensor noise only.
+    """
+    rng = np.random.default_rng(seed)
+    n_test, n_idle = int(duration * fs), int(idle * fs)
+    t = np.arange(n_test) / fs
+    parts = [rng.normal(size=(n_idle, 3)) * 40.]
+    for axis in test_axes:
+        test = rng.normal(size=(n_test, 3)) * 40.
+        test[:, 'xyz'.index(axis)] += 3000. * np.sin(2. * np.pi * 42. * t)
+        parts += [test, rng.normal(size=(n_idle, 3)) * 40.]
+    accels = np.concatenate(parts)
+    return np.column_stack([np.arange(len(accels)) / fs, accels])
+
+
+def test_segment_multi_test_recording():
+    """
+    Tests that the tests of a multi-test recording are found between the
+    idle periods and that the repeated tests of an axis are merged.
+    """
+    find_test_segments = calibrate_shaper.shaper_calibrate.find_test_segments
+    data = make_multi_test_data()
+    segments = find_test_segments(np, data)
+    assert [segment.axis for segment in segments] == ['x', 'y', 'x']
+    for i, segment in enumerate(segments):
+        assert abs(segment.start_time - (2. + i * 5.)) < .15
+        assert abs(segment.end_time - (5. + i * 5.)) < .15
+    # Sensor noise alone is not a test
+    assert find_test_segments(np, make_multi_test_data(test_axes='')) == []
+
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    tests = calibrate_shaper.load_resonance_tests(
+            helper, [data], 200., False, merge_repeats=True)
+    assert [(test.axis, len(test.segments)) for test in tests] == [
+            ('x', 2), ('y', 1)]
+    assert tests[0].calibration_data.data_sets == 2
+    for test in tests:
+        peaks = test.calibration_data.get_peaks(test.axis)
+        assert abs(peaks.freqs[0] - 42.) < 2.
+
+
+def test_segment_single_sweep_recording():
+    """
+    Tests that a recording of a single sweep without idle periods, with
+    the test acceleration growing with frequency, is kept as one test.
+    """
+    fs, duration = 3200., 20.
+    rng = np.random.default_rng(0)
+    t = np.arange(0., duration, 1. / fs)
+    freqs = 5. + t * (100. / duration)
+    accels = rng.normal(size=(t.size, 3)) * 40.
+    accels[:, 1] += 75. * freqs * np.sin(2. * np.pi * np.cumsum(freqs) / fs)
+    data = np.column_stack([t, accels])
+    segments = calibrate_shaper.shaper_calibrate.find_test_segments(np, data)
+    assert [(segment.start, segment.end, segment.axis)
+            for segment in segments] == [(0, len(t), 'y')]
+
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    tests = helper.process_test_segments(data, segments)
+    assert [test.axis for test in tests] == ['y']
+
+
+def test_resonance_peaks():
+    """
+    Tests that the peak index finds the synthetic resonances of every axis
+    and is recomputed when the PSD changes.
+    """
+    helper, calibration_data = make_calibration_data()
+    for axis, resonance in zip('xyz', (42., 57., 30.)):
+        peaks = calibration_data.get_peaks(axis)
+        assert abs(peaks.freqs[0] - resonance) < 2.
+        assert np.all(np.diff(peaks.prominences) <= 0)
+        assert np.all(peaks.prominences <= peaks.amplitudes)
+        assert np.all((peaks.bandwidths > 0.) & (peaks.bandwidths < 10.))
+    peaks = calibration_data.get_peaks()
+    assert calibration_data.get_peaks() is peaks
+    assert sorted(np.round(peaks.freqs[:3] / 10.)) == [3., 4., 6.]
+    assert "Hz (bandwidth" in calibrate_shaper.format_peaks(peaks)
+
+    calibration_data.add_data(helper.process_accelerometer_data(
+            make_raw_data(resonances=(70., 70., 70.))))
+    assert calibration_data.get_peaks() is not peaks
+
+
+def test_fit_shaper_pruned_to_peaks():
+    """
+    Tests that shapers are fitted only at the test frequencies around the
+    indexed peaks and that the pruning does not change the fitted shapers.
+    """
+    helper, calibration_data = make_calibration_data()
+    freq_start, freq_end = helper.get_test_freq_range(
+            calibration_data, ['x', 'y'])
+    assert 10. < freq_start < 42. and 57. < freq_end < 150.
+    psds = np.array([calibration_data.get_psd(axis) for axis in 'xy'])
+    shaper_defs = calibrate_shaper.shaper_calibrate.shaper_defs
+    for shaper_cfg in shaper_defs.INPUT_SHAPERS:
+        for max_smoothing in (None, .1):
+            fit_args = (None, None, 5., max_smoothing, None, None)
+            table = helper.fit_shaper_table(
+                    shaper_cfg, calibration_data, ['x', 'y'], *fit_args)
+            full = helper.fit_shaper_psds(
+                    shaper_cfg, calibration_data.freq_bins, psds, *fit_args)
+            assert table.freqs.max() <= freq_end < full.freqs.max()
+            for target in range(2):
+                assert table.select(target).freq == full.select(target).freq
+    explicit = helper.fit_shaper_table(
+            shaper_cfg, calibration_data, ['x'], [20., 140.], None, 5., None,
+            None, None)
+    assert list(explicit.freqs) == [20., 140.]
+
+    # The pruned fits share the full bank tables, and pruning can be
+    # disabled
+    n_tables = len(helper.response_bank._tables)
+    helper.fit_shaper_psds(shaper_cfg, calibration_data.freq_bins, psds,
+                           *fit_args)
+    assert len(helper.response_bank._tables) == n_tables
+    helper.prune_test_freqs = False
+    table = helper.fit_shaper_table(
+            shaper_cfg, calibration_data, ['x', 'y'], *fit_args)
+    assert np.array_equal(table.freqs, full.freqs)
+
+
+def test_validate_accelerometer_data(tmp_path):
+    """
+    Tests that corrupted raw captures are reported before processing.
+    """
+    validate = calibrate_shaper.shaper_calibrate.validate_accelerometer_data
+    raw_data = make_raw_data()
+    report = validate(np, raw_data)
+    assert report.problems == []
+    assert abs(report.sampling_freq - 3200.) < 1.
+    assert report.gaps == report.dropped_samples == report.non_monotonic == 0
+
+    corrupted = raw_data.copy()
+    corrupted[:, 1] = corrupted[:, 1].clip(-1000., 1000.)
+    corrupted[:, 3] = 0.
+    corrupted[1000:1100, 0] += 1.
+    corrupted[5000, 0] = corrupted[4999, 0]
+    report = validate(np, corrupted)
+    assert report.clipped[0] > 100 and report.clipped[1] == 0
+    assert report.axis_std[2] == 0.
+    assert report.non_monotonic == 2 and report.gaps == 1
+    assert len(report.problems) == 3
+    assert report.warnings == [
+            "axis x clipped in %d samples" % (report.clipped[0],)]
+
+    # Single extremes of a quiet axis with a coarse quantization are not
+    # clipping
+    quantized = raw_data.copy()
+    lsb = 38.3
+    for std in (10., 20.):
+        quantized[:, 3] = np.round(np.random.default_rng(1).normal(
+                size=len(quantized)) * std / lsb) * lsb
+        report = validate(np, quantized)
+        assert report.problems == report.warnings == []
+
+    assert validate(np, raw_data[:1000]).problems[0].startswith(
+            "capture too short")
+    assert validate(np, raw_data[:, :3]).problems
+
+    logname = tmp_path / "raw.csv"
+    np.savetxt(logname, corrupted, delimiter=',')
+    with pytest.raises(calibrate_shaper.InvalidCaptureError,
+                       match="axis z is dead"):
+        calibrate_shaper.parse_log(str(logname), validate=True)
+    assert calibrate_shaper.parse_log(str(logname)).shape == corrupted.shape
+
+
+def test_cross_spectra_coupling(tmp_path):
+    """
+    Tests that a resonance shared by two axes shows up in their coherence,
+    and that the cross-spectra are joined, normalized and saved with PSDs.
+    """
+    helper = calibrate_shaper.shaper_calibrate.ShaperCalibrate(printer=None)
+    raw_data = make_raw_data()
+    # The Y resonance (57 Hz) also shakes the X axis
+    raw_data[:, 1] += .8 * raw_data[:, 2]
+    calibration_data = helper.process_accelerometer_data(
+            raw_data, cross_spectra=True)
+    assert not helper.process_accelerometer_data(
+            raw_data).has_cross_spectra()
+    freq_bins = calibration_data.freq_bins
+    coupled = np.abs(freq_bins - 57.) < 1.
+    coherence = calibration_data.get_coherence('xy')
+    assert np.all(coherence[coupled] > .95)
+    assert np.all(calibration_data.get_coherence('xz')[coupled] < .5)
+    assert np.all((coherence >= 0.) & (coherence <= 1. + 1e-9))
+
+    calibration_data.add_data(helper.process_accelerometer_data(
+            raw_data, cross_spectra=True))
+    calibration_data.normalize_to_frequencies()
+    # Normalization does not change the coherence (except at 0 Hz)
+    assert np.allclose(calibration_data.get_coherence('xy')[1:],
+                       coherence[1:])
+
+    csv_output = tmp_path / "psd.csv"
+    helper.save_calibration_data(str(csv_output), calibration_data)
+    header = csv_output.read_text().splitlines()[0].split(',')
+    assert header[5:] == ['csd_xy', 'csd_xz', 'csd_yz',
+                          'coh_xy', 'coh_xz', 'coh_yz']
+    assert calibrate_shaper.parse_log(str(csv_output)).psd_x.shape[0] > 0
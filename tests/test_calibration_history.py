@@ -0,0 +1,64 @@
+import numpy as np
+import calibrate_shaper
+import calibration_history
+from test_calibration import make_calibration_data
+
+CalibrationResult = calibrate_shaper.shaper_calibrate.CalibrationResult
+
+
+def make_runs(printer_id, count, calibration_data=None):
+    runs = []
+    for i in range(count):
+        shapers = [CalibrationResult(
+            name=name, freq=40. + j + i * .1, vals=None, vibrs=.05,
+            smoothing=.1, score=.01, max_accel=5000.)
+            for j, name in enumerate(['zv', 'mzv', 'ei'])]
+        runs.append(calibration_history.HistoryRun(
+            printer_id, i * 3600., {'scv': 5.}, 'mzv', shapers,
+            calibration_data if i == 0 else None))
+    return runs
+
+
+def test_history_records_and_queries_runs(tmp_path):
+    """
+    Tests that bulk-inserted runs are queried per printer and time range,
+    with the downsampled PSD and parameters stored alongside.
+    """
+    _, calibration_data = make_calibration_data(duration=1.)
+    history = calibration_history.CalibrationHistory(
+            str(tmp_path / "history.db"))
+    run_ids = history.record_runs(
+            make_runs('printer1', 2000, calibration_data)
+            + make_runs('printer2', 10))
+    assert len(run_ids) == 2010
+    assert history.get_printers() == ['printer1', 'printer2']
+
+    drift = history.get_frequency_drift('printer1', since=3600. * 100,
+                                        until=3600. * 199)
+    assert len(drift) == 100
+    assert drift[0] == (3600. * 100, 'mzv', 41. + 100 * .1)
+    trend = history.get_shaper_trend('printer2', 'ei')
+    assert [row[1] for row in trend] == [42. + i * .1 for i in range(10)]
+
+    assert history.get_params(run_ids[0]) == {'scv': 5.}
+    freqs, psds = history.get_psd(run_ids[0])
+    assert psds.shape == (3, len(freqs))
+    expected = np.interp(freqs, calibration_data.freq_bins,
+                         calibration_data.psd_x)
+    assert np.allclose(psds[0], expected, rtol=1e-6)
+    assert history.get_psd(run_ids[1]) is None
+
+    # Drift queries are answered from the index alone
+    plan = history.db.execute(
+            "EXPLAIN QUERY PLAN SELECT timestamp, selected_shaper,"
+            " selected_freq FROM runs WHERE printer_id = ? AND"
+            " timestamp >= ? AND timestamp <= ? ORDER BY timestamp",
+            ('printer1', 0., 1.)).fetchall()
+    assert any('COVERING INDEX runs_by_printer' in row[-1] for row in plan)
+    history.close()
+
+    history = calibration_history.CalibrationHistory(
+            str(tmp_path / "history.db"))
+    history.record_run('printer2', [], None, timestamp=1e9)
+    assert len(history.get_frequency_drift('printer2')) == 11
+    history.close()
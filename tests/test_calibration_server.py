@@ -0,0 +1,92 @@
+import base64
+import threading
+import urllib.error
+import numpy as np
+import pytest
+import calibration_server
+from test_calibration import make_raw_data
+
+
+@pytest.fixture(scope="module")
+def service_url():
+    service = calibration_server.CalibrationService(workers=1)
+    server = calibration_server.start_server(service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%d" % (server.server_address[1],)
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+
+def test_calibration_job_roundtrip(service_url, tmp_path):
+    """
+    Tests that a queued calibration job returns the recommendation, the
+    plot and updates the service metrics.
+    """
+    raw_path = tmp_path / "raw.csv"
+    np.savetxt(raw_path, make_raw_data(), delimiter=",")
+    job = {"files": [str(raw_path)], "shapers": ["zv", "mzv"], "plot": True}
+    submitted = calibration_server.call_service(service_url, "/jobs", job)
+    status = calibration_server.call_service(
+            service_url, "/jobs/%d?wait=60" % (submitted["id"],))
+    assert status["status"] == "done"
+    result = status["result"]
+    assert result["selected_shaper"] in ("zv", "mzv")
+    assert [s["name"] for s in result["shapers"]] == ["zv", "mzv"]
+    assert base64.b64decode(result["png"]).startswith(b"\x89PNG")
+
+    # The same job again, synchronously on the already warm worker
+    del job["plot"]
+    status = calibration_server.call_service(service_url, "/calibrate", job)
+    assert status["result"]["shapers"] == result["shapers"]
+
+    metrics = calibration_server.call_service(service_url, "/metrics")
+    assert metrics["completed"] >= 2
+    assert metrics["queue_depth"] == 0
+    assert metrics["latency"]["max"] >= status["latency"]
+
+
+def test_calibration_job_errors(service_url, tmp_path):
+    """
+    Tests that invalid jobs are rejected and failing jobs are reported.
+    """
+    with pytest.raises(urllib.error.HTTPError) as e:
+        calibration_server.call_service(service_url, "/jobs", {"files": []})
+    assert e.value.code == 400
+    status = calibration_server.call_service(
+            service_url, "/calibrate", {"files": [str(tmp_path / "none")]})
+    assert status["status"] == "failed"
+    assert "FileNotFoundError" in status["error"]
+    for wait in ("abc", "inf", "nan", "-1"):
+        with pytest.raises(urllib.error.HTTPError) as e:
+            calibration_server.call_service(service_url,
+                                            "/jobs/1?wait=" + wait)
+        assert e.value.code == 400
+    # Waits are clamped, so a very long one returns the finished job
+    assert calibration_server.call_service(
+            service_url, "/jobs/%d?wait=1e12" % (status["id"],)) == status
+    # Params of wrong types are rejected before queueing the job
+    for params in ({"files": "raw.csv"}, {"shapers": "mzv"},
+                   {"axes": "x"}, {"test_damping_ratios": [.1, "x"]},
+                   {"scv": "5"}, {"plot": 1},
+                   {"shaper_freqs": {"start": 20, "stop": 80}}):
+        job = dict({"files": [str(tmp_path / "none")]}, **params)
+        with pytest.raises(urllib.error.HTTPError) as e:
+            calibration_server.call_service(service_url, "/jobs", job)
+        assert e.value.code == 400
+
+
+def test_calibration_job_broken_pool(tmp_path):
+    """
+    Tests that jobs fail instead of hanging when the worker pool is broken.
+    """
+    service = calibration_server.CalibrationService(workers=1)
+    service.executor.shutdown()
+    try:
+        for _ in range(2):
+            job_id = service.submit({"files": [str(tmp_path / "raw.csv")]})
+            status = service.get_job(job_id, timeout=10.)
+            assert status["status"] == "failed"
+    finally:
+        service.shutdown()
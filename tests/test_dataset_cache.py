@@ -0,0 +1,86 @@
+import shutil
+import matplotlib.figure
+import calibrate_shaper
+import dataset_cache
+from test_calibration import make_calibration_data
+
+
+def test_dataset_cache_reuses_analysis(tmp_path):
+    """
+    Tests that captures are analyzed once per file contents and that the
+    least recently used entries are evicted.
+    """
+    analyzed = []
+
+    def analyze(filename, max_freq):
+        analyzed.append(filename)
+        return dataset_cache.Dataset(filename, '', None, [], None, '')
+
+    files = []
+    for i in range(3):
+        path = tmp_path / ("capture%d.csv" % (i,))
+        path.write_text("%d\n" % (i,))
+        files.append(str(path))
+    cache = dataset_cache.DatasetCache(max_entries=2, analyze=analyze)
+    cache.get(files[0])
+    cache.get(files[1])
+    # The same contents under a different name are not analyzed again
+    renamed = str(tmp_path / "renamed.csv")
+    shutil.copy(files[0], renamed)
+    assert cache.get(renamed).name == renamed
+    assert analyzed == files[:2]
+    # files[1] is the least recently used one now
+    cache.get(files[2])
+    assert len(cache) == 2
+    cache.get(files[0])
+    cache.get(files[1])
+    assert analyzed == files + files[1:2]
+
+
+def test_dataset_cache_previews_misses(tmp_path):
+    """
+    Tests that a preview is only analyzed for captures missing from the
+    cache, that it is not cached itself and that the capture is parsed
+    only once for both analyses.
+    """
+    analyzed, parsed = [], []
+
+    def analyze(filename, max_freq, preview=False, data=None):
+        analyzed.append(preview)
+        assert data is parsed[-1]
+        return dataset_cache.Dataset(filename, '', None, [], None, '', preview)
+
+    def parse(filename):
+        parsed.append(object())
+        return parsed[-1]
+
+    path = tmp_path / "capture.csv"
+    path.write_text("0\n")
+    previews = []
+    cache = dataset_cache.DatasetCache(analyze=analyze, parse=parse)
+    dataset = cache.get(str(path), on_preview=previews.append)
+    assert [p.preview for p in previews] == [True]
+    assert previews[0].key == dataset.key and not dataset.preview
+    assert cache.get(str(path), on_preview=previews.append) == dataset
+    assert len(previews) == 1 and analyzed == [True, False]
+    assert len(parsed) == 1
+
+
+def test_plot_datasets_overlay():
+    """
+    Tests that several analyzed captures are overlaid on a single figure.
+    """
+    datasets = []
+    for i, resonances in enumerate([(42., 57., 30.), (47., 60., 30.)]):
+        helper, calibration_data = make_calibration_data(
+                resonances=resonances)
+        best, shapers = helper.find_best_shaper(
+                calibration_data, shapers=['zv', 'mzv'], scv=5.)
+        datasets.append(("capture%d" % (i,), calibration_data, shapers,
+                         best.name))
+    calibrate_shaper.setup_matplotlib(True)
+    fig = matplotlib.figure.Figure()
+    calibrate_shaper.plot_datasets_overlay(datasets, 200., fig=fig)
+    ax, ax2 = fig.axes
+    assert len(ax.get_lines()) == 2
+    assert len(ax2.get_lines()) == 2
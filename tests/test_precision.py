@@ -0,0 +1,104 @@
+"""
+Differential tests of the float32 precision mode against the default
+float64 analysis, run end to end from parsing to the shaper fit.
+
+Real captures can be added to the corpus by pointing the
+SHAPER_CAPTURES_DIR environment variable to a directory with raw
+accelerometer or PSD CSV files.
+
+Documented tolerances of the float32 mode:
+  * the recommended shaper and every fitted shaper frequency are the same,
+  * remaining vibrations differ by at most VIBRS_ATOL (absolute ratio),
+  * smoothing and max_accel differ by at most SMOOTHING_RTOL (relative),
+    they only depend on the fitted frequency.
+"""
+import glob
+import os
+import numpy as np
+import pytest
+import calibrate_shaper
+from test_calibration import make_raw_data
+
+VIBRS_ATOL = 1e-3
+SMOOTHING_RTOL = 1e-9
+
+SYNTHETIC_CAPTURES = [
+    dict(fs=3200., resonances=(42., 57., 30.), captures=2),
+    dict(fs=1600., resonances=(35., 48., 70.), captures=1),
+    dict(fs=6400., resonances=(61., 44., 25.), captures=1),
+    dict(fs=3200., resonances=(80., 95., 110.), captures=1),
+]
+
+
+def real_captures():
+    captures_dir = os.environ.get("SHAPER_CAPTURES_DIR")
+    if not captures_dir:
+        return []
+    return sorted(glob.glob(os.path.join(captures_dir, "*.csv")))
+
+
+def analyze(lognames, dtype):
+    datas = [calibrate_shaper.parse_log(fn, dtype) for fn in lognames]
+    selected_shaper, shapers, calibration_data = \
+            calibrate_shaper.calibrate_shaper(
+                    datas, None, shapers=None, damping_ratio=None, scv=5.,
+                    shaper_freqs=[], max_smoothing=None,
+                    test_damping_ratios=None, max_freq=200.,
+                    dtype=dtype)
+    assert calibration_data.psd_sum.dtype == np.dtype(dtype or np.float64)
+    return selected_shaper, shapers
+
+
+def assert_same_recommendation(lognames):
+    selected64, shapers64 = analyze(lognames, None)
+    selected32, shapers32 = analyze(lognames, np.float32)
+    assert selected32 == selected64
+    for shaper64, shaper32 in zip(shapers64, shapers32):
+        assert shaper32.name == shaper64.name
+        assert shaper32.freq == pytest.approx(shaper64.freq)
+        assert abs(shaper32.vibrs - shaper64.vibrs) <= VIBRS_ATOL
+        assert shaper32.smoothing == pytest.approx(shaper64.smoothing,
+                                                   rel=SMOOTHING_RTOL)
+        assert shaper32.max_accel == pytest.approx(shaper64.max_accel,
+                                                   rel=SMOOTHING_RTOL)
+
+
+@pytest.mark.parametrize("capture", SYNTHETIC_CAPTURES)
+def test_float32_synthetic_captures(capture, tmp_path):
+    """
+    Tests float32 mode on synthetic raw captures, including merging of
+    several captures of the same printer.
+    """
+    lognames = []
+    for i in range(capture["captures"]):
+        logname = str(tmp_path / ("raw%d.csv" % (i,)))
+        raw_data = make_raw_data(fs=capture["fs"],
+                                 resonances=capture["resonances"], seed=i)
+        np.savetxt(logname, raw_data, delimiter=",", fmt="%.6f")
+        lognames.append(logname)
+    assert_same_recommendation(lognames)
+
+
+@pytest.mark.parametrize("logname", real_captures())
+def test_float32_real_captures(logname):
+    """
+    Tests float32 mode on the real captures from SHAPER_CAPTURES_DIR.
+    """
+    assert_same_recommendation([logname])
+
+
+def test_float32_uptime_timestamps(tmp_path):
+    """
+    Tests that float32 mode keeps the timestamps of captures taken long
+    after the printer start in double precision.
+    """
+    logname = str(tmp_path / "raw.csv")
+    raw_data = make_raw_data()
+    raw_data[:, 0] += 5000.
+    np.savetxt(logname, raw_data, delimiter=",", fmt="%.6f")
+    data = calibrate_shaper.parse_log(logname, np.float32, validate=True)
+    assert data.dtype == np.float64
+    assert (np.diff(data[:, 0]) > 0.).all()
+    segments = calibrate_shaper.shaper_calibrate.find_test_segments(np, data)
+    assert segments[0].start_time == pytest.approx(5000., abs=1.)
+    assert_same_recommendation([logname])
@@ -0,0 +1,66 @@
+import os
+import pickle
+import numpy as np
+import shaper_report
+from test_calibration import make_calibration_data, make_raw_data
+
+
+def test_render_pages_in_parallel(tmp_path):
+    """
+    Tests that pre-analyzed pages are rendered by the worker pool and
+    linked from the combined HTML report in the original order.
+    """
+    helper, calibration_data = make_calibration_data()
+    # CalibrationData must survive the trip to the worker processes
+    assert pickle.loads(pickle.dumps(calibration_data)).numpy is not None
+    best, shapers = helper.find_best_shaper(
+            calibration_data, shapers=['zv', 'mzv'], scv=5.)
+    pages = [shaper_report.ReportPage("printer %d" % (i,), ["raw.csv"],
+                                      calibration_data, shapers, best.name,
+                                      200.)
+             for i in range(3)]
+    html_report = tmp_path / "report.html"
+    results = shaper_report.render_pages(
+            pages, str(tmp_path), fmt='svg', html_report=str(html_report),
+            workers=2)
+    assert [name for name, _, _ in results] == [p.name for p in pages]
+    for _, selected_shaper, path in results:
+        assert selected_shaper == best.name
+        with open(path) as f:
+            assert "<svg" in f.read()
+    report = html_report.read_text()
+    assert report.index("printer_0.svg") < report.index("printer_2.svg")
+
+    # The analyzed pages only go back to the main process for a PDF report
+    shaper_report._init_worker((8, 6))
+    path = str(tmp_path / "page.png")
+    assert shaper_report._render_page(pages[0], path, False)[3] is None
+    assert shaper_report._render_page(pages[0], path, True)[3] is pages[0]
+
+
+def test_combined_pdf_report(tmp_path):
+    """
+    Tests that all pages go to a multi-page PDF report, that pages with
+    clashing file names do not overwrite each other and that a failing page
+    does not abort the batch.
+    """
+    raw_path = tmp_path / "raw.csv"
+    np.savetxt(raw_path, make_raw_data(), delimiter=",")
+    lognames_by_name = [("printer 1", [str(raw_path)]),
+                        ("printer/1", [str(raw_path)]),
+                        ("broken", [str(tmp_path / "none.csv")])]
+    html_report = tmp_path / "report.html"
+    pdf_report = tmp_path / "report.pdf"
+    results = shaper_report.analyze_and_render(
+            lognames_by_name, str(tmp_path / "pages"), fmt='pdf',
+            html_report=str(html_report), pdf_report=str(pdf_report),
+            workers=2, shapers=['zv', 'mzv'], damping_ratio=None, scv=5.,
+            shaper_freqs=[], max_smoothing=None, test_damping_ratios=None,
+            max_freq=200.)
+    paths = [path for _, _, path in results]
+    assert paths[0] != paths[1] and paths[2] is None
+    assert all(os.path.exists(path) for path in paths[:2])
+    report = html_report.read_text()
+    assert "<img" not in report and 'href="pages/printer_1_2.pdf"' in report
+    pdf = pdf_report.read_bytes()
+    assert pdf.startswith(b"%PDF") and b"/Count 3" in pdf
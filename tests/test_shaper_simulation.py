@@ -0,0 +1,96 @@
+import math
+import numpy as np
+import calibrate_shaper
+from test_calibration import make_calibration_data
+
+shaper_simulation = calibrate_shaper.shaper_simulation
+shaper_defs = shaper_simulation.shaper_defs
+
+
+def test_simulation_matches_time_stepping():
+    """
+    Tests that the FFT-based simulation of an unshaped move matches a
+    direct integration of the oscillator and that shapers tuned to the
+    resonance cancel the residual vibrations.
+    """
+    fs = shaper_simulation.SIMULATION_RATE
+    modes = [shaper_simulation.ResonanceMode(40., .1, 1.)]
+    velocities = shaper_simulation.make_motion_profile(
+            np, moves=[(20., 100.)], accel=3000.)
+    shapers = [([1.], [0.])] + [cfg.init_func(40., .1)
+                                for cfg in shaper_defs.INPUT_SHAPERS]
+    result = shaper_simulation.simulate_shapers(np, shapers, velocities,
+                                                modes)
+    assert result.deflections.shape == (len(shapers), len(result.times))
+
+    omega = 2. * math.pi * 40.
+    accels = np.diff(velocities, prepend=0., append=0.) * fs
+    z = z_d = 0.
+    deflections = []
+    for accel in accels:
+        z_d += (-accel - .2 * omega * z_d - omega**2 * z) / fs
+        z += z_d / fs
+        deflections.append(z)
+    expected = np.abs(deflections).max()
+    assert abs(np.abs(result.deflections[0]).max() - expected) < .02 * expected
+
+    assert result.residual_vibrations[0] > 1e-2
+    assert np.all(result.residual_vibrations[1:4] < 1e-5)
+    assert abs(result.positions[-1] - 20.) < .01
+
+
+def test_simulate_fitted_shapers():
+    """
+    Tests that every fitted shaper reduces the residual vibrations of the
+    modes fitted to the measured resonances.
+    """
+    helper, calibration_data = make_calibration_data()
+    _, shapers = helper.find_best_shaper(calibration_data, scv=5.)
+    result = shaper_simulation.simulate_fitted_shapers(
+            np, calibration_data, shapers)
+    assert result.names == ['none'] + [s.name for s in shapers]
+    assert np.all(result.residual_vibrations[1:] <
+                  result.residual_vibrations[0])
+
+
+def test_simulation_of_slowly_decaying_modes():
+    """
+    Tests that vibrations outlasting the simulated time do not wrap around
+    onto the start of the motion.
+    """
+    modes = [shaper_simulation.ResonanceMode(
+            20., shaper_simulation.MIN_MODE_DAMPING_RATIO, 1.)]
+    velocities = shaper_simulation.make_motion_profile(
+            np, moves=[(20., 100.)], accel=3000.)
+    result = shaper_simulation.simulate_shapers(np, [([1.], [0.])],
+                                                velocities, modes)
+    assert result.times[-1] < 3.
+    before_motion = result.times <= 0.
+    wrapped = np.abs(result.deflections[0, before_motion]).max()
+    assert wrapped < 1e-3 * np.abs(result.deflections[0]).max()
+
+
+def test_simulation_without_peaks(tmp_path):
+    """
+    Tests that a frequency response without resonance peaks is simulated
+    with a single mode at its maximum and that motion profiles with leading
+    blank lines and headers are loaded.
+    """
+    helper, calibration_data = make_calibration_data()
+    freq_bins = calibration_data.freq_bins
+    flat = calibrate_shaper.shaper_calibrate.CalibrationData(
+            freq_bins, freq_bins, freq_bins, np.zeros_like(freq_bins),
+            np.zeros_like(freq_bins))
+    flat.set_numpy(np)
+    assert not len(flat.get_peaks().freqs)
+    modes = shaper_simulation.fit_resonance_modes(flat)
+    assert [m.freq for m in modes] == [freq_bins[-1]]
+
+    profile = tmp_path / "profile.csv"
+    profile.write_text("\n# toolpath\ntime,position\n0,0\n0.5,10\n1,10\n")
+    velocities = shaper_simulation.load_motion_profile(np, str(profile))
+    assert abs(velocities.sum() / shaper_simulation.SIMULATION_RATE
+               - 10.) < 1e-6
+    result = shaper_simulation.simulate_fitted_shapers(
+            np, flat, [], velocities=velocities)
+    assert result.names == ['none']